@@ -218,10 +218,14 @@ class BaseNotebookWindow(BaseWindow):
         builder.name_entry.set_text(self.notebook.info.name)
         builder.name_entry.set_sensitive(False)
         builder.description_text_view.get_buffer().props.text = self.notebook.info.description
+        builder.hot_swap_check_button.set_active(self.notebook.info.hot_swap)
+        builder.checkpoints_check_button.set_active(self.notebook.info.checkpoints)
 
         response = builder.dialog.run()
         if response == gtk.RESPONSE_OK:
             self.notebook.info.description = builder.description_text_view.get_buffer().props.text
+            self.notebook.info.hot_swap = builder.hot_swap_check_button.get_active()
+            self.notebook.info.checkpoints = builder.checkpoints_check_button.get_active()
 
         builder.dialog.destroy()
 
@@ -243,6 +247,7 @@ class BaseNotebookWindow(BaseWindow):
                 self.current_editor = editor
                 self.__update_title()
                 self._update_current_file()
+                self._update_focused_worksheet()
                 self.update_sensitivity()
                 break
 
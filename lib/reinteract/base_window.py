@@ -13,6 +13,7 @@ import sys
 import gtk
 
 from application import application
+from execution_scheduler import execution_scheduler
 from file_list import FileList
 from format_escaped import format_escaped
 from global_settings import global_settings
@@ -84,6 +85,7 @@ class BaseWindow:
             ('save',          gtk.STOCK_SAVE,  None,             None,         None, self.on_save),
             ('rename',        None,            "_Rename...",     None,         None, self.on_rename),
             ('print',         gtk.STOCK_PRINT, "_Print...",      "<control>p", None, self.on_print),
+            ('export-timings', None,           "Export _Timings...", None,     None, self.on_export_timings),
             ('close',         gtk.STOCK_CLOSE, None,             "<control>w", None, self.on_close),
 
             ('quit',          gtk.STOCK_QUIT, None,                None,         None, self.on_quit),
@@ -97,6 +99,7 @@ class BaseWindow:
             ('delete',  gtk.STOCK_DELETE,    None,         None,              None,  self.on_delete),
             ('about',   gtk.STOCK_ABOUT,     None,         None,              None, self.on_about),
             ('calculate', gtk.STOCK_REFRESH, "Ca_lculate", '<control>Return', None,  self.on_calculate),
+            ('calculate-to-cursor', None,    "Calculate to C_ursor", '<control><alt>Return', None, self.on_calculate_to_cursor),
             ('break',   gtk.STOCK_CANCEL,    "_Break",     '<control>Break',  None,  self.on_break),
             ('preferences', gtk.STOCK_PREFERENCES, "Prefere_nces",     None,  None,  self.on_preferences),
         ])
@@ -110,6 +113,7 @@ class BaseWindow:
 
         application.window_closed(self)
         self.window.destroy()
+        self.notebook.close()
 
     #######################################################
     # Utility
@@ -243,10 +247,42 @@ class BaseWindow:
         if self.current_editor and self.current_editor.needs_calculate:
             self.current_editor.calculate()
 
+    def on_calculate_to_cursor(self, action):
+        if self.current_editor and self.current_editor.needs_calculate:
+            self.current_editor.calculate(up_to_cursor=True)
+
     def on_break(self, action):
         if self.current_editor:
             self.current_editor.buf.worksheet.interrupt()
 
+    def on_export_timings(self, action):
+        if not isinstance(self.current_editor, WorksheetEditor):
+            return
+
+        chooser = gtk.FileChooserDialog("Export Timings...", self.window, gtk.FILE_CHOOSER_ACTION_SAVE,
+                                        (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                                         gtk.STOCK_SAVE,   gtk.RESPONSE_OK))
+        chooser.set_default_response(gtk.RESPONSE_OK)
+        chooser.set_current_name("timings.csv")
+        response = chooser.run()
+        filename = None
+        if response == gtk.RESPONSE_OK:
+            filename = chooser.get_filename()
+        chooser.destroy()
+
+        if filename is None:
+            return
+
+        try:
+            self.current_editor.export_timings(filename)
+        except IOError, e:
+            dialog = gtk.MessageDialog(buttons=gtk.BUTTONS_OK,
+                                       type=gtk.MESSAGE_ERROR)
+            dialog.set_markup(format_escaped("<big><b>Cannot export timings to '%s'</b></big>", os.path.basename(filename)))
+            dialog.format_secondary_text(str(e))
+            dialog.run()
+            dialog.destroy()
+
     def on_preferences(self, action):
         show_preferences(parent=self.window)
 
@@ -262,7 +298,8 @@ class BaseWindow:
         # maybe someone wants that
         if ((event.keyval == gtk.keysyms.Return or event.keyval == gtk.keysyms.KP_Enter) and
             (event.state & gtk.gdk.CONTROL_MASK != 0) and
-            (event.state & gtk.gdk.SHIFT_MASK == 0)):
+            (event.state & gtk.gdk.SHIFT_MASK == 0) and
+            (event.state & gtk.gdk.MOD1_MASK == 0)):
             if self.current_editor and self.current_editor.needs_calculate:
                 self.current_editor.calculate()
             return True
@@ -273,6 +310,8 @@ class BaseWindow:
         return True
 
     def on_notify_is_active(self, window, paramspec):
+        self._update_focused_worksheet()
+
         if global_settings.main_menu_mode:
             if window.is_active():
                 main_menu.window_activated(self)
@@ -286,9 +325,18 @@ class BaseWindow:
     def show(self):
         self.window.show()
 
+    def _update_focused_worksheet(self):
+        # Calculations of the worksheet that the user is working in are started first
+        if self.window.is_active() and isinstance(self.current_editor, WorksheetEditor):
+            execution_scheduler.focused_worksheet = self.current_editor.buf.worksheet
+
     def update_sensitivity(self):
         self._set_action_sensitive('calculate', self.current_editor is not None and self.current_editor.needs_calculate)
-        self._set_action_sensitive('break', self.current_editor is not None and self.current_editor.state == NotebookFile.EXECUTING)
+        self._set_action_sensitive('calculate-to-cursor', self.current_editor is not None and self.current_editor.needs_calculate)
+        self._set_action_sensitive('export-timings', isinstance(self.current_editor, WorksheetEditor))
+        self._set_action_sensitive('break', self.current_editor is not None and
+                                   (self.current_editor.state == NotebookFile.EXECUTING or
+                                    self.current_editor.state == NotebookFile.QUEUED))
 
         # This seems more annoying than useful. gedit doesn't desensitize save
         # self._set_action_sensitive('save', self.current_editor is not None and self.current_editor.modified)
@@ -0,0 +1,633 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Running worksheets without a user interface; this is the implementation
+# of the reinteract-run command.
+#
+
+import base64
+import difflib
+import logging
+import opcode
+import os
+import re
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+_debug = logging.getLogger("BatchRun").debug
+
+def find_notebook_folder(filename):
+    """Find the notebook folder for a worksheet file
+
+    This is the closest parent directory containing an index.rnb file; if there
+    is none, the directory containing the worksheet.
+
+    """
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    folder = dirname
+    while True:
+        if os.path.exists(os.path.join(folder, "index.rnb")):
+            return folder
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return dirname
+        folder = parent
+
+def find_worksheets(folder):
+    """Return a sorted list of the worksheet files within a notebook folder"""
+
+    result = []
+    for root, dirs, files in os.walk(folder):
+        # Hidden files and directories aren't part of the notebook; see Notebook
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if name.lower().endswith('.rws') and not name.startswith('.'):
+                result.append(os.path.join(root, name))
+
+    result.sort()
+    return result
+
+def _format_result(result):
+    # Results are normally strings, but can also be objects that the user
+    # interface displays specially; we can only describe those
+    from custom_result import CustomResult
+    from notebook import HelpResult
+    from statement import WarningResult
+
+    if isinstance(result, basestring):
+        return unicode(result)
+    elif isinstance(result, WarningResult):
+        return u"Warning: " + result.message
+    elif isinstance(result, HelpResult):
+        return u"<help for %s>" % getattr(result.arg, '__name__', type(result.arg).__name__)
+    elif isinstance(result, CustomResult):
+        return u"<%s>" % type(result).__name__
+    else:
+        return unicode(repr(result))
+
+def _render_image(result):
+    from custom_result import CustomResult
+
+    if not isinstance(result, CustomResult):
+        return None
+
+    try:
+        data = result.render_png()
+    except Exception, e:
+        _debug("Can't render %s: %s", type(result).__name__, e)
+        return None
+
+    if data is None:
+        return None
+
+    return base64.b64encode(data)
+
+# A statement that starts by assigning to a single name
+_ASSIGNMENT_RE = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)\s*=(?!=)')
+
+_STORE_NAME = opcode.opmap['STORE_NAME']
+
+def _get_stored_names(text):
+    # Return the set of names that the top-level code of a statement binds
+    try:
+        code = compile(text, "<statement>", "exec")
+    except SyntaxError:
+        return set()
+
+    names = set()
+    co_code = code.co_code
+    i = 0
+    while i < len(co_code):
+        op = ord(co_code[i])
+        if op >= opcode.HAVE_ARGUMENT:
+            if op == _STORE_NAME:
+                names.add(code.co_names[ord(co_code[i + 1]) + 256 * ord(co_code[i + 2])])
+            i += 3
+        else:
+            i += 1
+
+    return names
+
+def bind_parameters(worksheet, parameters):
+    """Set the values of worksheet parameters before calculating the worksheet
+
+    The first top-level statement that assigns to a parameter (like 'n = 10')
+    is replaced by an assignment of the given value, so that a worksheet can
+    define a default for each parameter. Parameters that the worksheet doesn't
+    assign to are defined in the worksheet's global scope instead.
+
+    Only a statement that starts with a simple assignment can be replaced. If the
+    first statement that binds a parameter binds it in some other way (like
+    'a = n = 1', 'n, m = 1, 2' or 'for n in ...'), ValueError is raised, since
+    the worksheet would otherwise silently ignore the given value.
+
+    @param worksheet: a loaded L{Worksheet}
+    @param parameters: dictionary of parameter names to values. The values
+       must have a repr() that evaluates to an equal value, like the values that
+       can be represented in JSON.
+    @raises ValueError: if a parameter is bound in a way that can't be replaced
+
+    """
+
+    from chunks import StatementChunk
+
+    unbound = dict(parameters)
+    assignments = []
+    for chunk in worksheet.iterate_chunks():
+        if not isinstance(chunk, StatementChunk):
+            continue
+        m = _ASSIGNMENT_RE.match(worksheet.get_line(chunk.start))
+        if m and m.group(1) in unbound:
+            name = m.group(1)
+            assignments.append((chunk.start, chunk.end, name, unbound.pop(name)))
+            continue
+
+        for name in sorted(_get_stored_names(chunk.tokenized.get_text())):
+            if name in unbound:
+                raise ValueError("Can't set parameter '%s': line %d assigns it other than as '%s = ...'" %
+                                 (name, chunk.start + 1, name))
+
+    # Replace from the end, so that the line numbers of the earlier statements
+    # stay valid
+    for start, end, name, value in reversed(assignments):
+        worksheet.delete_range(start, 0, end - 1, len(worksheet.get_line(end - 1)))
+        worksheet.insert(start, 0, "%s = %r" % (name, value))
+
+    worksheet.global_scope.update(unbound)
+
+def statement_record_for_chunk(chunk, render_images=False):
+    """Describe the result of executing a statement chunk; see L{run_worksheet}"""
+
+    from statement import Statement
+    from statement_timing import StatementTiming
+
+    state = chunk.statement.state
+    if state == Statement.COMPILE_ERROR:
+        state_name = 'compile-error'
+    elif state == Statement.EXECUTE_ERROR:
+        state_name = 'execute-error'
+    elif state == Statement.INTERRUPTED:
+        state_name = 'interrupted'
+    else:
+        state_name = 'success'
+
+    results = []
+    if chunk.results is not None:
+        results = [_format_result(r) for r in chunk.results]
+
+    timing = StatementTiming.for_statement(chunk.statement)
+
+    statement_record = {
+        'line': chunk.start + 1,
+        'state': state_name,
+        'results': results,
+        'error': chunk.error_message,
+        'timing': timing.to_dict() if timing is not None else None
+    }
+    if render_images:
+        images = []
+        if chunk.results is not None:
+            images = [_render_image(r) for r in chunk.results]
+        statement_record['images'] = [image for image in images if image is not None]
+
+    return statement_record
+
+def run_worksheet(filename, folder=None, parameters=None, render_images=False):
+    """Load and execute a worksheet, and collect the results
+
+    @param filename: the worksheet file to run
+    @param folder: the notebook folder the worksheet belongs to; library modules
+       are imported from this folder. If None, found with L{find_notebook_folder}.
+    @param parameters: if not None, a dictionary of parameter values to
+       bind before executing the worksheet; see L{bind_parameters}
+    @param render_images: if True, results that can be rendered as images, such
+       as plots, are rendered, and stored in the 'images' key of each statement
+       as a list of base64-encoded PNG images
+    @returns: a dictionary with the keys:
+       file: the filename passed in
+       error: an error message if the file couldn't be loaded, otherwise None
+       errors: the number of statements that failed
+       elapsed: the time taken to run the worksheet, in seconds
+       statements: list of dictionaries describing each statement, with keys
+          line (the first line of the statement, starting from 1), state
+          ('success', 'compile-error', 'execute-error' or 'interrupted'),
+          results (list of strings), error (the error message, or None), and
+          timing (a dictionary of the fields of L{StatementTiming}, or None if
+          the statement wasn't executed)
+
+    """
+
+    from notebook import Notebook
+    from worksheet import Worksheet
+    from chunks import StatementChunk
+    import reunicode
+
+    if folder is None:
+        folder = find_notebook_folder(filename)
+
+    record = {
+        'file': filename,
+        'error': None,
+        'errors': 0,
+        'elapsed': 0.,
+        'statements': []
+    }
+
+    start = time.time()
+    notebook = Notebook(folder)
+    worksheet = Worksheet(notebook)
+    try:
+        try:
+            worksheet.load(filename, with_results=False)
+        except (IOError, reunicode.ConversionError), e:
+            record['error'] = str(e)
+            record['errors'] = 1
+            return record
+
+        if parameters:
+            try:
+                bind_parameters(worksheet, parameters)
+            except ValueError, e:
+                record['error'] = str(e)
+                record['errors'] = 1
+                return record
+
+        worksheet.calculate(wait=True)
+
+        for chunk in worksheet.iterate_chunks():
+            if not isinstance(chunk, StatementChunk) or chunk.statement is None:
+                continue
+
+            statement_record = statement_record_for_chunk(chunk, render_images)
+            if statement_record['error'] is not None:
+                record['errors'] += 1
+            record['statements'].append(statement_record)
+    finally:
+        worksheet.close()
+        notebook.close()
+        record['elapsed'] = time.time() - start
+
+    return record
+
+def format_text(record, with_filename=True):
+    """Format the results of L{run_worksheet} as text
+
+    @param with_filename: if True, the output starts with the worksheet filename,
+        and the results are indented.
+
+    """
+
+    if with_filename:
+        lines = [record['file'] + ":"]
+        indent = "    "
+    else:
+        lines = []
+        indent = ""
+
+    if record['error'] is not None:
+        lines.append(indent + "Error: " + record['error'])
+
+    for statement in record['statements']:
+        prefix = "%s%d: " % (indent, statement['line'])
+        if statement['error'] is not None:
+            for i, error_line in enumerate(statement['error'].split("\n")):
+                if i == 0:
+                    lines.append(prefix + "Error: " + error_line)
+                else:
+                    lines.append(indent + "    " + error_line)
+        for result in statement['results']:
+            lines.append(prefix + result)
+
+    return u"\n".join(lines) + u"\n"
+
+def golden_filename(golden_dir, filename, folder):
+    """Get the name of the file holding the expected output for a worksheet
+
+    The name is the path of the worksheet relative to its notebook folder, with
+    .out instead of .rws, so worksheets with the same name in different
+    subdirectories of the notebook have different files.
+
+    """
+
+    path = os.path.abspath(filename)
+    folder = os.path.abspath(folder)
+    if path.startswith(folder + os.sep):
+        path = path[len(folder) + 1:]
+    else:
+        path = os.path.basename(path)
+    return os.path.join(golden_dir, os.path.splitext(path)[0] + ".out")
+
+def compare_golden(record, golden_dir, folder, update=False):
+    """Compare the output of a worksheet against the stored expected output
+
+    @param record: the results of L{run_worksheet}
+    @param golden_dir: directory holding the expected outputs
+    @param folder: the notebook folder of the worksheet; see L{golden_filename}
+    @param update: if True, store the current output as the expected output
+       rather than comparing
+    @returns: None if the output matches, otherwise a description of the differences
+
+    """
+
+    golden_file = golden_filename(golden_dir, record['file'], folder)
+    output = format_text(record, with_filename=False).encode("utf8")
+
+    if update:
+        dirname = os.path.dirname(golden_file)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        f = open(golden_file, "wb")
+        try:
+            f.write(output)
+        finally:
+            f.close()
+        return None
+
+    try:
+        f = open(golden_file, "rb")
+    except IOError, e:
+        return "Can't read expected output: %s" % e
+
+    try:
+        expected = f.read()
+    finally:
+        f.close()
+
+    if expected == output:
+        return None
+
+    diff = difflib.unified_diff(expected.splitlines(True), output.splitlines(True),
+                                golden_file, record['file'])
+    return "".join(diff).rstrip()
+
+def _run_one(args):
+    # Entry point for worker processes
+    filename, folder = args
+
+    try:
+        return run_worksheet(filename, folder)
+    except Exception, e:
+        # Something went wrong outside of the user's code; report it the same
+        # way as a worksheet that can't be loaded
+        _debug("Error running %s: %s", filename, e)
+        return {
+            'file': filename,
+            'error': "%s: %s" % (type(e).__name__, e),
+            'errors': 1,
+            'elapsed': 0.,
+            'statements': []
+        }
+
+def run_worksheets(jobs, n_processes=1):
+    """Run a list of worksheets, possibly in parallel
+
+    Each worksheet is run with a separate Notebook object, so worksheets can't
+    affect each other through the modules they import, whether they run in the
+    same process or not.
+
+    @param jobs: list of (filename, notebook_folder)
+    @param n_processes: number of worker processes to use. If 1, or if the
+       multiprocessing module isn't available, the worksheets are run one after
+       another in the current process.
+    @returns: list of results from L{run_worksheet}, in the same order as jobs
+
+    """
+
+    if n_processes > 1 and len(jobs) > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(min(n_processes, len(jobs)))
+        try:
+            return pool.map(_run_one, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [_run_one(job) for job in jobs]
+
+def main(argv=None):
+    """Run the reinteract-run command. Returns the exit status."""
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = OptionParser(usage="%prog [options] (WORKSHEET.rws | NOTEBOOK_FOLDER)...",
+                          description="Execute Reinteract worksheets without a user interface")
+    parser.add_option("-f", "--format", choices=('text', 'json'), default='text',
+                      help="output format: 'text' (default) or 'json'")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write results to FILE rather than standard output")
+    parser.add_option("-j", "--jobs", type="int", default=None,
+                      help="number of worksheets to run in parallel (default: number of CPUs)")
+    parser.add_option("-g", "--golden", metavar="DIR",
+                      help="compare the output of each worksheet against DIR/PATH.out, where PATH is the worksheet's path in its notebook")
+    parser.add_option("--update-golden", action="store_true", default=False,
+                      help="with --golden, store the current output as the expected output")
+    parser.add_option("-s", "--sweep", metavar="NAME=VALUES",
+                      help="run a single worksheet for each value in VALUES, a JSON list, of the parameter NAME")
+    parser.add_option("-d", "--debug", action="store_true", default=False,
+                      help="enable internal debug messages")
+
+    options, args = parser.parse_args(argv)
+    if len(args) == 0:
+        parser.error("No worksheets or notebooks specified")
+    if options.format == 'json' and json is None:
+        parser.error("JSON output requires the json or simplejson module")
+    if options.update_golden and options.golden is None:
+        parser.error("--update-golden requires --golden")
+    if options.sweep is not None:
+        if json is None:
+            parser.error("--sweep requires the json or simplejson module")
+        if len(args) != 1 or not os.path.isfile(args[0]):
+            parser.error("--sweep requires a single worksheet")
+        if options.golden is not None:
+            parser.error("--sweep can't be used with --golden")
+        try:
+            sweep_name, sweep_values = options.sweep.split("=", 1)
+            sweep_values = json.loads(sweep_values)
+        except ValueError:
+            sweep_values = None
+        if not isinstance(sweep_values, list) or not _ASSIGNMENT_RE.match(sweep_name + "="):
+            parser.error("--sweep must be NAME=VALUES, where VALUES is a JSON list")
+
+    if options.debug:
+        logging.basicConfig(level=logging.DEBUG, format="DEBUG: %(message)s")
+
+    import stdout_capture
+    stdout_capture.init()
+
+    jobs = []
+    for arg in args:
+        if os.path.isdir(arg):
+            folder = os.path.abspath(arg)
+            jobs.extend(((filename, folder) for filename in find_worksheets(arg)))
+        elif os.path.exists(arg):
+            jobs.append((arg, find_notebook_folder(arg)))
+        else:
+            parser.error("%s does not exist" % arg)
+
+    n_processes = options.jobs
+    if n_processes is None:
+        if multiprocessing is not None:
+            n_processes = multiprocessing.cpu_count()
+        else:
+            n_processes = 1
+
+    if options.sweep is not None:
+        import sweep
+        record = sweep.run_sweep(args[0], sweep_name, sweep_values, jobs[0][1], n_processes)
+        failed = record['errors'] > 0
+        if options.format == 'json':
+            output = json.dumps(record, indent=2) + "\n"
+        else:
+            output = sweep.format_table(record).encode("utf8")
+    else:
+        records = run_worksheets(jobs, n_processes)
+
+        failed = False
+        for (filename, folder), record in zip(jobs, records):
+            if record['errors'] > 0:
+                failed = True
+            if options.golden is not None:
+                differences = compare_golden(record, options.golden, folder, update=options.update_golden)
+                record['golden_differences'] = differences
+                if differences is not None:
+                    print >>sys.stderr, "%s: output differs from expected output\n%s" % (record['file'], differences)
+                    failed = True
+
+        if options.format == 'json':
+            output = json.dumps(records, indent=2) + "\n"
+        else:
+            output = u"".join(format_text(record) for record in records).encode("utf8")
+
+    if options.output is not None:
+        f = open(options.output, "w")
+        try:
+            f.write(output)
+        finally:
+            f.close()
+    else:
+        sys.stdout.write(output)
+
+    if failed:
+        return 1
+    else:
+        return 0
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    import stdout_capture
+    from test_utils import assert_equals
+
+    stdout_capture.init()
+
+    base = tempfile.mkdtemp("", "batch_run")
+    try:
+        def write_file(name, contents):
+            absname = os.path.join(base, name)
+            dirname = os.path.dirname(absname)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            f = open(absname, "w")
+            f.write(contents)
+            f.close()
+
+        write_file("notebook/index.rnb", "[Notebook]\n")
+        write_file("notebook/lib.py", "def double(x):\n    return 2 * x\n")
+        write_file("notebook/good.rws", "import lib\nlib.double(21)\nprint 'hello'\n")
+        write_file("notebook/sub/bad.rws", "a = 1\n1/0\na\n")
+
+        assert_equals(find_notebook_folder(os.path.join(base, "notebook/sub/bad.rws")),
+                      os.path.join(base, "notebook"))
+        assert_equals(find_worksheets(os.path.join(base, "notebook")),
+                      [os.path.join(base, "notebook/good.rws"), os.path.join(base, "notebook/sub/bad.rws")])
+
+        # The worksheet code can be used without gobject and GTK+
+        assert not 'gobject' in sys.modules and not 'gtk' in sys.modules
+
+        records = run_worksheets([(f, os.path.join(base, "notebook"))
+                                  for f in find_worksheets(os.path.join(base, "notebook"))])
+        good, bad = records
+        assert_equals(good['errors'], 0)
+        assert_equals([(s['line'], s['results']) for s in good['statements']],
+                      [(1, []), (2, ['42']), (3, ['hello'])])
+        assert_equals(format_text(good, with_filename=False), "2: 42\n3: hello\n")
+
+        assert_equals(bad['errors'], 1)
+        assert_equals([s['state'] for s in bad['statements']], ['success', 'execute-error', 'success'])
+        assert bad['statements'][1]['error'].endswith("ZeroDivisionError: integer division or modulo by zero")
+        assert good['statements'][1]['timing']['wall_time'] >= 0
+        assert_equals(bad['statements'][2]['timing'], None)
+
+        # Parameters replace the first assignment, or are defined as globals
+        write_file("params/params.rws", "n = 10\nn * m\nn = 3\nn\n")
+        record = run_worksheet(os.path.join(base, "params/params.rws"),
+                               parameters={ 'n': 2, 'm': 'a' }, render_images=True)
+        assert_equals([s['results'] for s in record['statements']], [[], ["'aa'"], [], ['3']])
+        assert_equals(record['statements'][1]['images'], [])
+
+        # Parameters bound in a way that can't be replaced are an error
+        write_file("params/chained.rws", "m = n = 10\nn\n")
+        record = run_worksheet(os.path.join(base, "params/chained.rws"), parameters={ 'n': 2 })
+        assert_equals(record['error'], "Can't set parameter 'n': line 1 assigns it other than as 'n = ...'")
+        write_file("params/tuple.rws", "x = 1\nif x:\n    n, m = 1, 2\nn\n")
+        record = run_worksheet(os.path.join(base, "params/tuple.rws"), parameters={ 'n': 2 })
+        assert_equals(record['error'], "Can't set parameter 'n': line 2 assigns it other than as 'n = ...'")
+
+        # Golden output
+        golden_dir = os.path.join(base, "golden")
+        assert_equals(compare_golden(good, golden_dir, os.path.join(base, "notebook"), update=True), None)
+        assert_equals(compare_golden(good, golden_dir, os.path.join(base, "notebook")), None)
+        good['statements'][1]['results'] = ['43']
+        assert compare_golden(good, golden_dir, os.path.join(base, "notebook")).find("-2: 42\n+2: 43") >= 0
+
+        # The command line
+        output_file = os.path.join(base, "output.txt")
+        assert_equals(main(["-j", "1", "-o", output_file, os.path.join(base, "notebook/good.rws")]), 0)
+        assert_equals(open(output_file).read(), os.path.join(base, "notebook/good.rws") + ":\n    2: 42\n    3: hello\n")
+        assert_equals(main(["-j", "1", "-o", output_file, os.path.join(base, "notebook")]), 1)
+        if json is not None:
+            assert_equals(main(["-j", "2", "-f", "json", "-o", output_file, os.path.join(base, "notebook")]), 1)
+            records = json.load(open(output_file))
+            assert_equals([r['errors'] for r in records], [0, 1])
+
+            # Parameter sweeps
+            assert_equals(main(["-j", "1", "-s", "n=[1, 3]", "-o", output_file, os.path.join(base, "params/params.rws")]), 1)
+            assert_equals(open(output_file).read().split("\n")[:3],
+                          ["n  line 2", "1  Error: NameError: name 'm' is not defined", "3  Error: NameError: name 'm' is not defined"])
+
+        # Worksheets with the same name in different directories have different golden files
+        write_file("same/index.rnb", "[Notebook]\n")
+        write_file("same/a/w.rws", "1\n")
+        write_file("same/b/w.rws", "2\n")
+        golden_dir = os.path.join(base, "same-golden")
+        assert_equals(main(["-j", "1", "-g", golden_dir, "--update-golden", "-o", output_file, os.path.join(base, "same")]), 0)
+        assert_equals(sorted(os.listdir(golden_dir)), ["a", "b"])
+        assert_equals(main(["-j", "1", "-g", golden_dir, "-o", output_file, os.path.join(base, "same")]), 0)
+        assert_equals(main(["-j", "1", "-g", golden_dir, "-o", output_file, os.path.join(base, "same/b/w.rws")]), 0)
+        assert_equals(open(os.path.join(golden_dir, "b", "w.out")).read(), "1: 2\n")
+    finally:
+        shutil.rmtree(base)
@@ -0,0 +1,172 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import hashlib
+import imp
+import logging
+import marshal
+import os
+
+_debug = logging.getLogger("BytecodeCache").debug
+
+class BytecodeCache(object):
+
+    """
+    Cache of compiled code for the library modules of notebooks.
+
+    When Python imports a module from source, it writes a .pyc file next to
+    the source file. For a notebook, that means that the user's folder fills
+    up with files they didn't create, so we compile notebook modules ourselves
+    and store the compiled code in a private directory instead.
+
+    Entries are keyed by a hash of the source code, the filename the code is
+    compiled for (which ends up in tracebacks), and the magic number of the
+    Python interpreter, so they never need to be explicitly invalidated: a
+    changed module or a different version of Python just misses the cache.
+    """
+
+    def __init__(self):
+        self.__cache_dir = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def set_cache_dir(self, dirname):
+        """Set the directory to store compiled code in. Until this is called, nothing is cached."""
+
+        self.__cache_dir = dirname
+
+    def __get_cache_file(self, filename, source):
+        h = hashlib.sha1(imp.get_magic())
+        h.update(os.path.abspath(filename))
+        h.update('\0')
+        h.update(source)
+
+        return os.path.join(self.__cache_dir, h.hexdigest() + ".pyc")
+
+    def __load(self, cache_file):
+        try:
+            f = open(cache_file, "rb")
+        except IOError:
+            return None
+
+        try:
+            try:
+                return marshal.load(f)
+            except (EOFError, ValueError, TypeError), e:
+                _debug("Can't load compiled code from %s: %s", cache_file, e)
+                return None
+        finally:
+            f.close()
+
+    def __save(self, cache_file, code):
+        # Write to a temporary file and rename, so that another Reinteract process
+        # never sees a partial file
+        tmpname = "%s.%d.tmp" % (cache_file, os.getpid())
+        try:
+            if not os.path.exists(self.__cache_dir):
+                os.makedirs(self.__cache_dir)
+            f = open(tmpname, "wb")
+            try:
+                marshal.dump(code, f)
+            finally:
+                f.close()
+            if os.path.exists(cache_file):
+                os.unlink(cache_file)
+            os.rename(tmpname, cache_file)
+        except (OSError, IOError), e:
+            _debug("Can't save compiled code to %s: %s", cache_file, e)
+
+    def compile_file(self, filename):
+        """Get the compiled code for a Python source file
+
+        @param filename: the source file to compile
+        @returns: a code object for the contents of the file
+        @raises IOError: if the file can't be read
+        @raises SyntaxError: if the file can't be compiled
+
+        """
+
+        f = open(filename, "rU")
+        try:
+            source = f.read()
+        finally:
+            f.close()
+
+        # compile() requires a trailing newline
+        if not source.endswith("\n"):
+            source += "\n"
+
+        if self.__cache_dir is None:
+            return compile(source, filename, 'exec')
+
+        cache_file = self.__get_cache_file(filename, source)
+        code = self.__load(cache_file)
+        if code is not None:
+            self.hits += 1
+            return code
+
+        self.misses += 1
+        code = compile(source, filename, 'exec')
+        self.__save(cache_file, code)
+
+        return code
+
+# The global singleton
+bytecode_cache = BytecodeCache()
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "bytecode_cache")
+    try:
+        source_file = os.path.join(base, "mod.py")
+        def write_source(contents):
+            f = open(source_file, "w")
+            f.write(contents)
+            f.close()
+
+        cache = BytecodeCache()
+        cache.set_cache_dir(os.path.join(base, "cache"))
+
+        write_source("a = 1")
+        scope = {}
+        exec cache.compile_file(source_file) in scope
+        assert_equals(scope['a'], 1)
+        assert_equals((cache.hits, cache.misses), (0, 1))
+
+        # A second compile, even from a new cache object, is a hit
+        cache = BytecodeCache()
+        cache.set_cache_dir(os.path.join(base, "cache"))
+        code = cache.compile_file(source_file)
+        assert_equals(code.co_filename, source_file)
+        assert_equals((cache.hits, cache.misses), (1, 0))
+
+        # Changing the source misses the cache
+        write_source("a = 2")
+        scope = {}
+        exec cache.compile_file(source_file) in scope
+        assert_equals(scope['a'], 2)
+        assert_equals((cache.hits, cache.misses), (1, 1))
+
+        # Nothing was written next to the source
+        assert_equals(sorted(os.listdir(base)), ["cache", "mod.py"])
+
+        write_source("= 1")
+        try:
+            cache.compile_file(source_file)
+            raise AssertionError("Expected SyntaxError")
+        except SyntaxError:
+            pass
+    finally:
+        shutil.rmtree(base)
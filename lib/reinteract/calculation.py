@@ -0,0 +1,151 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import threading
+
+class Calculation(object):
+
+    """
+    A Calculation tracks a calculation of a worksheet started with
+    L{Worksheet.calculate_async}.
+
+    The worksheet is calculated in the background by a ThreadExecutor, and
+    the Calculation is updated from the main loop (see the signals module) as
+    statements complete. There are two ways of following a calculation:
+
+     - From the main loop thread, by adding callbacks with add_statement_callback()
+       and add_done_callback(). Since each worksheet executes in its own
+       thread, many worksheets can be calculated at once this way by a service
+       running a single main loop.
+
+     - From another thread, by calling wait() or iterating over
+       iter_statements(). Neither may be called from the main loop thread,
+       since the calculation can't progress while the main loop is blocked.
+
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+        self.__cond = threading.Condition()
+        self.__done = False
+        self.__success = None
+        self.__statements = []  # Statements completed so far, in order
+
+        self.__statement_callbacks = []
+        self.__done_callbacks = []
+
+    def _statement_complete(self, statement):
+        # Called from the main loop by the worksheet
+        self.__cond.acquire()
+        try:
+            self.__statements.append(statement)
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+        for callback in self.__statement_callbacks:
+            callback(self, statement)
+
+    def _complete(self, success):
+        # Called from the main loop by the worksheet
+        self.__cond.acquire()
+        try:
+            self.__done = True
+            self.__success = success
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+        callbacks = self.__done_callbacks
+        self.__done_callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def add_statement_callback(self, callback):
+        """Call callback(calculation, statement) from the main loop each time a statement
+        is complete. The statement's state is one of the final states of L{Statement}"""
+
+        self.__statement_callbacks.append(callback)
+
+    def add_done_callback(self, callback):
+        """Call callback(calculation) from the main loop when the calculation is complete.
+        If it is already complete, callback is called immediately."""
+
+        if self.done():
+            callback(self)
+        else:
+            self.__done_callbacks.append(callback)
+
+    def done(self):
+        """Return True if the calculation is complete"""
+
+        self.__cond.acquire()
+        try:
+            return self.__done
+        finally:
+            self.__cond.release()
+
+    def wait(self, timeout=None):
+        """Block until the calculation is complete. Must not be called from the main loop thread.
+
+        @param timeout: maximum time to wait, in seconds, or None to wait indefinitely
+        @returns: True if the calculation is complete
+
+        """
+
+        self.__cond.acquire()
+        try:
+            if not self.__done:
+                self.__cond.wait(timeout)
+            return self.__done
+        finally:
+            self.__cond.release()
+
+    def result(self, timeout=None):
+        """Wait for the calculation to complete and return whether it succeeded
+
+        @param timeout: maximum time to wait, in seconds, or None to wait indefinitely
+        @returns: True if all statements executed successfully, otherwise False
+        @raises RuntimeError: if the timeout expired first
+
+        """
+
+        if not self.wait(timeout):
+            raise RuntimeError("Calculation did not complete within %s seconds" % timeout)
+
+        return self.__success
+
+    def iter_statements(self, timeout=None):
+        """Iterate over the statements of the calculation as they complete
+
+        Must not be called from the main loop thread.
+
+        @param timeout: maximum time to wait for each statement, in seconds, or None
+           to wait indefinitely
+        @raises RuntimeError: if a timeout expires
+
+        """
+
+        i = 0
+        while True:
+            self.__cond.acquire()
+            try:
+                if i == len(self.__statements) and not self.__done:
+                    self.__cond.wait(timeout)
+                    if i == len(self.__statements) and not self.__done:
+                        raise RuntimeError("No statement completed within %s seconds" % timeout)
+                if i < len(self.__statements):
+                    statement = self.__statements[i]
+                else:
+                    return
+            finally:
+                self.__cond.release()
+
+            yield statement
+            i += 1
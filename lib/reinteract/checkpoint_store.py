@@ -0,0 +1,476 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import __builtin__
+import cPickle
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import time
+import types
+from cStringIO import StringIO
+
+from memo_cache import is_internal_name, list_store_entries, remove_store_entry
+
+_debug = logging.getLogger("CheckpointStore").debug
+
+# Numpy arrays at least this big are saved as separate .npy files, and
+# memory-mapped when restored, rather than pickled
+_ARRAY_FILE_SIZE = 64 * 1024
+
+class _NotCheckpointable(Exception):
+    pass
+
+def _get_entry_key(filename):
+    # The files of a checkpoint are <key>.checkpoint and <key>-<index>.npy
+    return filename.split('.')[0].split('-')[0]
+
+class CheckpointStore(object):
+
+    """
+    Persistent store of the scopes that result from executing slow statements.
+
+    Reopening a worksheet normally means executing all of its statements again.
+    When checkpoints are enabled for a notebook (see L{NotebookInfo.checkpoints}),
+    the result scope of each statement that takes longer than a threshold to
+    execute is saved in a hidden directory in the notebook folder, and when the
+    worksheet is calculated again, execution starts after the last statement
+    that has a checkpoint.
+
+    A checkpoint is keyed by a hash of the text of the statement and the
+    text of all the statements before it in the worksheet (see L{make_key}),
+    so editing a statement invalidates the checkpoints of all the following
+    statements. Changes to library modules don't invalidate checkpoints.
+
+    To save space, a checkpoint only stores the names that changed since the
+    previous checkpoint of the worksheet. Values are pickled, except that:
+
+     - Modules are stored by name and imported again when restoring
+     - Functions defined in the worksheet are stored as their code
+     - Large numpy arrays are stored in .npy files that are memory-mapped
+       (copy-on-write) when restoring
+
+    If a value can't be stored, no checkpoint is saved for the statement. Objects
+    shared between the values of different checkpoints are no longer shared after
+    restoring.
+
+    When the total size of the store exceeds max_size, the least recently used
+    checkpoints are removed, along with the checkpoints that depend on them. A
+    new checkpoint that doesn't fit in the store along with the checkpoints it
+    depends on isn't saved.
+    """
+
+    def __init__(self, directory, threshold=10., max_size=1024 * 1024 * 1024):
+        """
+        @param directory: directory to store checkpoints in
+        @param threshold: minimum execution time, in seconds, of a statement for it
+           to be checkpointed
+        @param max_size: maximum total size of the store, in bytes
+
+        """
+
+        self.directory = directory
+        self.threshold = threshold
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(parent_key, text):
+        """Compute the key for a statement
+
+        @param parent_key: the key of the previous statement in the worksheet, or None
+        @param text: the text of the statement
+
+        """
+
+        h = hashlib.sha1(parent_key or '')
+        h.update('\0')
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+        h.update(text)
+
+        return h.hexdigest()
+
+    def __get_filename(self, key):
+        return os.path.join(self.directory, key + ".checkpoint")
+
+    def __get_array_filename(self, key, index):
+        return os.path.join(self.directory, "%s-%d.npy" % (key, index))
+
+    def __read(self, key):
+        # Returns (base_key, pickled data); the first line of the file is the key of
+        # the base checkpoint, so we can follow the chain without unpickling
+        try:
+            f = open(self.__get_filename(key), "rb")
+        except IOError:
+            return None, None
+
+        try:
+            base, data = f.read().split("\n", 1)
+        except ValueError:
+            _debug("Can't read checkpoint %s", key)
+            return None, None
+        finally:
+            f.close()
+
+        return base or None, data
+
+    def __read_base(self, key):
+        # Returns (True, base_key) if the checkpoint is stored, otherwise (False, None)
+        try:
+            f = open(self.__get_filename(key), "rb")
+        except IOError:
+            return False, None
+        try:
+            return True, f.readline().rstrip("\n") or None
+        finally:
+            f.close()
+
+    def contains(self, key):
+        """Check whether a checkpoint and all the checkpoints it depends on are stored"""
+
+        while key is not None:
+            found, key = self.__read_base(key)
+            if not found:
+                return False
+
+        return True
+
+    def save(self, key, base_key, base_scope, scope, notebook):
+        """Save a checkpoint
+
+        @param key: the key of the statement (see L{make_key})
+        @param base_key: the key of the closest previous statement in the worksheet
+          with a checkpoint, or None
+        @param base_scope: the result scope of the statement for base_key, or the global
+          scope of the worksheet if base_key is None
+        @param scope: the result scope of the statement
+        @param notebook: the notebook that the worksheet belongs to
+        @returns: True if the checkpoint was saved
+
+        """
+
+        changed = {}
+        for name, value in scope.iteritems():
+            if is_internal_name(name):
+                continue
+            if not name in base_scope or base_scope[name] is not value:
+                changed[name] = value
+        deleted = [name for name in base_scope if not name in scope and not is_internal_name(name)]
+
+        arrays = []
+        numpy = sys.modules.get('numpy')
+
+        def persistent_id(obj):
+            t = type(obj)
+            if t is types.ModuleType:
+                name = notebook.get_local_module_name(obj.__name__) or obj.__name__
+                return ('module', name)
+            elif t is types.FunctionType and obj.func_globals.get('__name__') is None:
+                # Defined in the worksheet
+                if obj.func_closure is not None:
+                    raise _NotCheckpointable("%s has a closure" % obj.__name__)
+                return ('function', marshal.dumps(obj.func_code), obj.__name__, obj.func_defaults)
+            elif t in (types.FunctionType, types.ClassType, type):
+                # Functions and classes from library modules are pickled by name. The name of
+                # the module in sys.modules changes each time the notebook is loaded
+                module_name = notebook.get_local_module_name(obj.__module__)
+                if module_name is not None:
+                    return ('global', module_name, obj.__name__)
+                elif obj.__module__ is None:
+                    raise _NotCheckpointable("%s is defined in the worksheet" % obj.__name__)
+            elif numpy is not None and t is numpy.ndarray and \
+                    obj.nbytes >= _ARRAY_FILE_SIZE and not obj.dtype.hasobject:
+                arrays.append(obj)
+                return ('array', len(arrays) - 1)
+
+            return None
+
+        f = StringIO()
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        try:
+            pickler.dump({
+                'changed': changed,
+                'deleted': deleted,
+                'wrappers': list(scope.get('__reinteract_wrappers', ()))
+            })
+        except (_NotCheckpointable, cPickle.PicklingError, TypeError), e:
+            _debug("Can't checkpoint %s: %s", key, e)
+            return False
+
+        filename = self.__get_filename(key)
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            for i, array in enumerate(arrays):
+                numpy.save(self.__get_array_filename(key, i), array)
+
+            # The checkpoint file is written last, so it only exists if the arrays were saved
+            out = open(tmpname, "wb")
+            try:
+                out.write((base_key or '') + "\n")
+                out.write(f.getvalue())
+            finally:
+                out.close()
+            if os.path.exists(filename):
+                os.unlink(filename)
+            os.rename(tmpname, filename)
+        except (OSError, IOError), e:
+            _debug("Can't save checkpoint %s: %s", key, e)
+            return False
+
+        # The checkpoints that this one depends on are now used as recently as it is
+        now = time.time()
+        base = base_key
+        while base is not None:
+            try:
+                os.utime(self.__get_filename(base), (now, now))
+            except OSError:
+                break
+            base = self.__read_base(base)[1]
+
+        if not self.__evict(keep=key):
+            _debug("Checkpoint %s doesn't fit in the store along with its base checkpoints", key)
+            remove_store_entry(self.directory, [filename for filename in os.listdir(self.directory)
+                                                if _get_entry_key(filename) == key])
+            return False
+
+        _debug("Saved checkpoint %s, %d names changed", key, len(changed))
+
+        return True
+
+    def __load_one(self, key, data, scope, notebook):
+        def import_module(name):
+            module = notebook.do_import(name)
+            for component in name.split('.')[1:]:
+                module = getattr(module, component)
+            return module
+
+        def persistent_load(pid):
+            kind = pid[0]
+            if kind == 'module':
+                return import_module(pid[1])
+            elif kind == 'function':
+                return types.FunctionType(marshal.loads(pid[1]), scope, pid[2], pid[3])
+            elif kind == 'global':
+                return getattr(import_module(pid[1]), pid[2])
+            elif kind == 'array':
+                import numpy
+                return numpy.load(self.__get_array_filename(key, pid[1]), mmap_mode='c')
+            else:
+                raise cPickle.UnpicklingError("Unknown persistent id %r" % (pid,))
+
+        unpickler = cPickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+    def restore(self, key, global_scope, notebook):
+        """Restore the result scope of a statement from a checkpoint
+
+        @param key: the key of the statement
+        @param global_scope: the global scope of the worksheet
+        @param notebook: the notebook that the worksheet belongs to
+        @returns: the restored scope, or None if it couldn't be restored
+
+        """
+
+        chain = []
+        base = key
+        while base is not None:
+            next_base, data = self.__read(base)
+            if data is None:
+                return None
+            chain.append((base, data))
+            base = next_base
+
+        scope = dict(global_scope)
+        # Needed for restored functions, if the global scope hasn't been used yet
+        scope.setdefault('__builtins__', __builtin__)
+        now = time.time()
+        for base, data in reversed(chain):
+            try:
+                checkpoint = self.__load_one(base, data, scope, notebook)
+            except Exception, e:
+                _debug("Can't restore checkpoint %s: %s", base, e)
+                return None
+
+            for name in checkpoint['deleted']:
+                scope.pop(name, None)
+            scope.update(checkpoint['changed'])
+
+            wrappers = scope['__reinteract_wrappers']
+            for wrapper in checkpoint['wrappers']:
+                if not wrapper in wrappers:
+                    wrappers.append(wrapper)
+
+            try:
+                os.utime(self.__get_filename(base), (now, now))
+            except OSError:
+                pass
+
+        _debug("Restored checkpoint %s", key)
+
+        return scope
+
+    def __evict(self, keep=None):
+        # Remove checkpoints whose base checkpoint is gone, then the least recently used
+        # checkpoints until the store is smaller than max_size; the time a checkpoint was
+        # last used is the modification time of its file. Removing a checkpoint removes
+        # the checkpoints that depend on it, and keep and the checkpoints it depends on
+        # are never removed. Returns False if the store is still too big.
+        entries = list_store_entries(self.directory, _get_entry_key)
+        total = sum(size for _, size, _ in entries.itervalues())
+
+        # Entries without a checkpoint file are partially written or removed
+        bases = {}
+        dependents = {}
+        for key in entries:
+            found, base = self.__read_base(key)
+            if found:
+                bases[key] = base
+                dependents.setdefault(base, []).append(key)
+            else:
+                entries[key][0] = 0
+
+        removed = set()
+        def remove(key):
+            # Returns the total size of the removed files
+            if key in removed:
+                return 0
+            _debug("Removing checkpoint %s", key)
+            removed.add(key)
+            remove_store_entry(self.directory, entries[key][2])
+            size = entries[key][1]
+            for dependent in dependents.get(key, ()):
+                size += remove(dependent)
+            return size
+
+        for key, base in bases.iteritems():
+            if base is not None and not base in bases:
+                total -= remove(key)
+
+        kept = set()
+        key = keep
+        while key is not None and not key in kept:
+            kept.add(key)
+            key = bases.get(key)
+
+        for key in sorted(entries.iterkeys(), key=lambda k: entries[k][0]):
+            if total <= self.max_size:
+                break
+            if not key in kept:
+                total -= remove(key)
+
+        return total <= self.max_size
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from notebook import Notebook
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "checkpoint_store")
+    try:
+        f = open(os.path.join(base, "lib.py"), "w")
+        f.write("class Point(object):\n    def __init__(self, x):\n        self.x = x\n")
+        f.close()
+
+        notebook = Notebook(base)
+        global_scope = {}
+        notebook.setup_globals(global_scope)
+
+        def execute(parent_scope, code):
+            scope = dict(parent_scope)
+            exec code in scope
+            return scope
+
+        store = CheckpointStore(os.path.join(base, ".checkpoints"))
+
+        key1 = CheckpointStore.make_key(None, "a = ...")
+        key2 = CheckpointStore.make_key(key1, "b = ...")
+        key3 = CheckpointStore.make_key(key2, "c = ...")
+        assert key1 != CheckpointStore.make_key(None, "b = ...")
+        assert not store.contains(key1)
+
+        scope1 = execute(global_scope, "import os.path\nimport lib\na = [1, 2, 3]\np = lib.Point(1)\n")
+        assert store.save(key1, None, global_scope, scope1, notebook)
+        assert store.contains(key1)
+
+        scope2 = execute(scope1, "def f(x, y=2):\n    return x + y + len(a)\nb = f(1)\ndel p\n")
+        assert store.save(key2, key1, scope1, scope2, notebook)
+
+        # A fresh notebook, as if the notebook was opened again
+        notebook.close()
+        notebook = Notebook(base)
+        global_scope = {}
+        notebook.setup_globals(global_scope)
+
+        scope = store.restore(key2, global_scope, notebook)
+        assert_equals((scope['a'], scope['b'], scope['f'](2)), ([1, 2, 3], 6, 7))
+        assert_equals(scope['os'].path, os.path)
+        assert not 'p' in scope
+        assert scope['lib'] is notebook.do_import('lib')
+
+        scope = store.restore(key1, global_scope, notebook)
+        assert isinstance(scope['p'], notebook.do_import('lib').Point)
+
+        # Without the base checkpoint, a checkpoint can't be restored
+        os.remove(os.path.join(base, ".checkpoints", key1 + ".checkpoint"))
+        assert not store.contains(key2)
+        assert_equals(store.restore(key2, global_scope, notebook), None)
+
+        # Objects from classes defined in the worksheet can't be checkpointed
+        scope3 = execute(scope2, "class A(object): pass\nc = A()\n")
+        assert not store.save(key3, key2, scope2, scope3, notebook)
+        assert not os.path.exists(os.path.join(base, ".checkpoints", key3 + ".checkpoint"))
+
+        # The least recently used checkpoints are removed when the store is too big
+        store = CheckpointStore(os.path.join(base, ".checkpoints"), max_size=2500)
+        for i in xrange(10):
+            key = CheckpointStore.make_key(None, "x = %d" % i)
+            assert store.save(key, None, global_scope, { 'x': "x" * 1000 }, notebook)
+        keys = [CheckpointStore.make_key(None, "x = %d" % i) for i in xrange(10)]
+        assert store.contains(keys[-1])
+        assert not store.contains(keys[0])
+        assert sum(os.path.getsize(os.path.join(base, ".checkpoints", f))
+                   for f in os.listdir(os.path.join(base, ".checkpoints"))) <= 2500
+
+        # A checkpoint is removed along with the checkpoints that depend on it, and a
+        # checkpoint that doesn't fit along with its base isn't saved
+        shutil.rmtree(os.path.join(base, ".checkpoints"))
+        store = CheckpointStore(os.path.join(base, ".checkpoints"), max_size=3000)
+        scope1 = { 'x': "x" * 1000 }
+        assert store.save(key1, None, global_scope, scope1, notebook)
+        assert store.save(key2, key1, scope1, { 'x': scope1['x'], 'y': "y" * 1000 }, notebook)
+        for i, key in enumerate((key1, key2)):
+            os.utime(store._CheckpointStore__get_filename(key), (1000 + i, 1000 + i))
+        assert store.save(key3, None, global_scope, { 'z': "z" * 1000 }, notebook)
+        assert_equals([store.contains(key) for key in (key1, key2, key3)], [False, False, True])
+        assert_equals(len(os.listdir(store.directory)), 1)
+
+        assert store.save(key1, None, global_scope, { 'x': "x" * 2000 }, notebook)
+        assert not store.save(key2, key1, global_scope, { 'x': "x" * 2000, 'y': "y" * 1500 }, notebook)
+        assert store.contains(key1) and not store.contains(key2)
+        assert_equals(len(os.listdir(store.directory)), 1)
+
+        # Checkpoints whose base is gone are removed
+        store = CheckpointStore(os.path.join(base, ".checkpoints"))
+        assert store.save(key2, key1, scope1, { 'x': scope1['x'], 'y': "y" }, notebook)
+        os.remove(store._CheckpointStore__get_filename(key1))
+        assert store.save(key3, None, global_scope, { 'z': "z" }, notebook)
+        assert_equals(os.listdir(store.directory), [key3 + ".checkpoint"])
+
+        notebook.close()
+    finally:
+        shutil.rmtree(base)
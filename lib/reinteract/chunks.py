@@ -10,6 +10,7 @@ import traceback
 
 from change_range import ChangeRange
 from statement import Statement, WarningResult
+from statement_timing import StatementTiming, add_to_history
 from tokenized_statement import TokenizedStatement;
 
 class Chunk(object):
@@ -91,6 +92,12 @@ class StatementChunk(Chunk):
         self.error_line = None
         self.error_offset = None
 
+        # History of the timings of executions of the chunk, oldest first. This is kept when
+        # the text of the chunk changes, so the effects of edits on the timing can be seen.
+        self.timings = []
+        # (statement, finish_time) for the last timing added to self.timings
+        self.__last_timed = None
+
     def __repr__(self):
         return "StatementChunk(%d,%d,%r,%r,%r)" % (self.start, self.end, self.needs_compile, self.needs_execute, self.tokenized.get_text())
 
@@ -127,9 +134,22 @@ class StatementChunk(Chunk):
 
         return self.statement
 
+    def __add_timing(self):
+        statement = self.statement
+        if (statement, statement.finish_time) == self.__last_timed:
+            return
+
+        timing = StatementTiming.for_statement(statement)
+        if timing is not None:
+            add_to_history(self.timings, timing)
+            self.__last_timed = (statement, statement.finish_time)
+
     def update_statement(self):
         self.status_changed = True
 
+        if self.statement.state in (Statement.EXECUTE_SUCCESS, Statement.EXECUTE_ERROR, Statement.INTERRUPTED):
+            self.__add_timing()
+
         if self.statement.state == Statement.COMPILE_SUCCESS:
             self.needs_compile = False
             self.needs_execute = True
@@ -0,0 +1,377 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Support for updating the functions and classes of a module in place
+# when the source code of the module changes, rather than reloading the
+# module. See Notebook.reset_module_by_filename()
+#
+
+import types
+
+# Simple values that we can compare for equality between the old and new
+# versions of a module
+_SIMPLE_TYPES = (types.NoneType, bool, int, long, float, complex, str, unicode)
+
+def get_code_names(code):
+    """Return the set of global and attribute names referenced by a code object
+    (including code objects nested inside it, like function definitions)"""
+
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(get_code_names(const))
+
+    return names
+
+def code_equal(a, b):
+    """Check if two code objects do the same thing, ignoring line numbers"""
+
+    if (a.co_argcount != b.co_argcount or
+        a.co_flags != b.co_flags or
+        a.co_code != b.co_code or
+        a.co_names != b.co_names or
+        a.co_varnames != b.co_varnames or
+        a.co_freevars != b.co_freevars or
+        a.co_cellvars != b.co_cellvars or
+        len(a.co_consts) != len(b.co_consts)):
+        return False
+
+    for const_a, const_b in zip(a.co_consts, b.co_consts):
+        if isinstance(const_a, types.CodeType):
+            if not (isinstance(const_b, types.CodeType) and code_equal(const_a, const_b)):
+                return False
+        elif type(const_a) != type(const_b) or const_a != const_b:
+            return False
+
+    return True
+
+def _values_equal(a, b):
+    if a is b:
+        return True
+    if type(a) != type(b):
+        return False
+    if isinstance(a, types.ModuleType):
+        return a.__name__ == b.__name__
+    if isinstance(a, _SIMPLE_TYPES):
+        return a == b
+    # Containers are compared by contents; if the old version was modified
+    # since the module was loaded, they won't compare equal and we'll reset
+    # the module, which is what we want.
+    if isinstance(a, (tuple, list, set, frozenset)):
+        if len(a) != len(b):
+            return False
+        if isinstance(a, (set, frozenset)):
+            a = sorted(a)
+            b = sorted(b)
+        for item_a, item_b in zip(a, b):
+            if not _values_equal(item_a, item_b):
+                return False
+        return True
+    if isinstance(a, dict):
+        if set(a) != set(b):
+            return False
+        for key in a:
+            if not _values_equal(a[key], b[key]):
+                return False
+        return True
+
+    return False
+
+class _Patcher(object):
+    # Collects the changes needed to turn the old versions of functions
+    # and classes into the new versions. Nothing is changed until apply()
+    # so that we can give up without leaving things half-updated.
+
+    def __init__(self):
+        self.patches = []       # list of (old_function, new_function)
+        self.changed = set()    # names of changed functions, classes, and methods
+
+    def check_function(self, name, old, new):
+        if len(old.func_code.co_freevars) != len(new.func_code.co_freevars):
+            return False
+
+        changed = not code_equal(old.func_code, new.func_code)
+
+        # The function might be a wrapper created by a decorator, in which case
+        # the code that changed is the function it wraps
+        if old.func_closure is not None:
+            for old_cell, new_cell in zip(old.func_closure, new.func_closure):
+                old_value = old_cell.cell_contents
+                new_value = new_cell.cell_contents
+                if isinstance(old_value, types.FunctionType) and isinstance(new_value, types.FunctionType):
+                    if not self.check_function(name, old_value, new_value):
+                        return False
+                elif not _values_equal(old_value, new_value):
+                    return False
+
+        if old.func_defaults is None or new.func_defaults is None:
+            defaults_changed = old.func_defaults is not new.func_defaults
+        else:
+            defaults_changed = not _values_equal(old.func_defaults, new.func_defaults)
+
+        if changed or defaults_changed:
+            self.changed.add(name)
+
+        self.patches.append((old, new))
+
+        return True
+
+    def check_value(self, name, old, new):
+        if isinstance(old, types.FunctionType) and isinstance(new, types.FunctionType):
+            return self.check_function(name, old, new)
+        elif isinstance(old, (type, types.ClassType)) and type(old) == type(new):
+            return self.check_class(name, old, new)
+        elif isinstance(old, (staticmethod, classmethod)) and type(old) == type(new):
+            # There's no public way to get at the function in Python 2.5, but
+            # we can fetch it through a dummy class
+            old_func = old.__get__(None, object)
+            new_func = new.__get__(None, object)
+            if isinstance(old, classmethod):
+                old_func = old_func.im_func
+                new_func = new_func.im_func
+            return self.check_function(name, old_func, new_func)
+        elif isinstance(old, types.MethodType) and isinstance(new, types.MethodType):
+            return self.check_function(name, old.im_func, new.im_func)
+        elif isinstance(old, property) and isinstance(new, property):
+            for accessor in ('fget', 'fset', 'fdel'):
+                if not self.check_value(name, getattr(old, accessor), getattr(new, accessor)):
+                    return False
+            return True
+        else:
+            return _values_equal(old, new)
+
+    def check_class(self, name, old, new):
+        if old.__name__ != new.__name__:
+            return False
+
+        if [b.__name__ for b in old.__bases__] != [b.__name__ for b in new.__bases__]:
+            return False
+
+        old_dict = dict((k, v) for k, v in old.__dict__.iteritems() if not k in ('__dict__', '__weakref__', '__doc__'))
+        new_dict = dict((k, v) for k, v in new.__dict__.iteritems() if not k in ('__dict__', '__weakref__', '__doc__'))
+        if set(old_dict) != set(new_dict):
+            return False
+
+        old_changed = len(self.changed)
+        for attr in old_dict:
+            if not self.check_value(attr, old_dict[attr], new_dict[attr]):
+                return False
+
+        # Statements that create instances might store results of methods
+        if len(self.changed) != old_changed:
+            self.changed.add(name)
+
+        return True
+
+    def apply(self):
+        for old, new in self.patches:
+            old.func_code = new.func_code
+            old.func_defaults = new.func_defaults
+            old.func_doc = new.func_doc
+
+def swap_module(old_dict, new_dict, ignore=()):
+    """Update the functions and classes in the namespace of a module in place
+
+    If the only differences between the old and new namespaces are in the code
+    of functions (including methods and the default values of arguments), then the
+    code of the functions in old_dict is replaced with the code from new_dict.
+    Objects in worksheets that reference the old functions and classes will then
+    use the new code.
+
+    @param old_dict: the namespace of the loaded module
+    @param new_dict: the namespace from executing the new source code of the module
+    @param ignore: names to ignore when comparing the namespaces
+    @returns: the set of names of functions, methods and classes that changed, or None
+       if the old namespace can't be patched to match the new namespace. In
+       that case, nothing is changed.
+
+    """
+
+    old_names = set(k for k in old_dict if not k in ignore)
+    new_names = set(k for k in new_dict if not k in ignore)
+    if old_names != new_names:
+        return None
+
+    patcher = _Patcher()
+    for name in old_names:
+        if not patcher.check_value(name, old_dict[name], new_dict[name]):
+            return None
+
+    patcher.apply()
+
+    return patcher.changed
+
+def find_users(namespace, names):
+    """Find the functions and classes in a namespace that reference any of the given names
+
+    Calling such a function may call a function that changed, so its result may
+    also change. This follows references within the namespace, so if f calls g and
+    g calls h, then f and g are returned when h is in names.
+
+    @returns: the set of names found, including the names passed in
+
+    """
+
+    users = {}
+    for name, value in namespace.iteritems():
+        if isinstance(value, types.FunctionType):
+            users[name] = get_code_names(value.func_code)
+        elif isinstance(value, (type, types.ClassType)):
+            referenced = set()
+            for attr in value.__dict__.itervalues():
+                if isinstance(attr, types.FunctionType):
+                    referenced.update(get_code_names(attr.func_code))
+            users[name] = referenced
+
+    result = set(names)
+    while True:
+        found = set(name for name, referenced in users.iteritems()
+                    if not name in result and referenced & result)
+        if len(found) == 0:
+            return result
+        result.update(found)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from test_utils import assert_equals
+
+    def load(source):
+        namespace = {}
+        exec source in namespace
+        return namespace
+
+    old = load("""
+import re
+X = 1
+Y = [1, (2, 3), {'a': 4}]
+def f(a=1):
+    return a + X
+def g():
+    return f()
+class A(object):
+    def m(self):
+        return 1
+    @staticmethod
+    def s():
+        return 2
+    @classmethod
+    def c(cls):
+        return 3
+""")
+    f = old['f']
+    instance = old['A']()
+
+    # Moving code around doesn't count as a change
+    new = load("""
+
+import re
+X = 1
+Y = [1, (2, 3), {'a': 4}]
+def f(a=1):
+    return a + X
+def g():
+    return f()
+class A(object):
+    def m(self):
+        return 1
+    @staticmethod
+    def s():
+        return 2
+    @classmethod
+    def c(cls):
+        return 3
+""")
+    assert_equals(swap_module(old, new, ignore=['__builtins__']), set())
+
+    new = load("""
+import re
+X = 1
+Y = [1, (2, 3), {'a': 4}]
+def f(a=1):
+    return a + X + 1
+def g():
+    return f()
+class A(object):
+    def m(self):
+        return 10
+    @staticmethod
+    def s():
+        return 2
+    @classmethod
+    def c(cls):
+        return 30
+""")
+    assert_equals(swap_module(old, new, ignore=['__builtins__']), set(['f', 'A', 'm', 'c']))
+    assert f is old['f']
+    assert_equals(f(), 3)
+    assert_equals(instance.m(), 10)
+    assert_equals(instance.c(), 30)
+    assert_equals(find_users(old, ['f']), set(['f', 'g']))
+
+    # New module-level state can't be patched
+    new = load("""
+import re
+X = [2]
+Y = [1, (2, 3), {'a': 4}]
+def f(a=1):
+    return a + X + 1
+def g():
+    return f()
+class A(object):
+    def m(self):
+        return 10
+""")
+    assert_equals(swap_module(old, new, ignore=['__builtins__']), None)
+
+    # A new function can't be patched
+    new = load("""
+import re
+X = 1
+Y = [1, (2, 3), {'a': 4}]
+def f(a=1):
+    return a + X + 1
+def g():
+    return f()
+def h():
+    pass
+class A(object):
+    def m(self):
+        return 10
+    @staticmethod
+    def s():
+        return 2
+""")
+    assert_equals(swap_module(old, new, ignore=['__builtins__']), None)
+    assert_equals(f(), 3)
+
+    # Decorated functions
+    old = load("""
+def decorate(func):
+    def wrapper(*args):
+        return func(*args)
+    return wrapper
+@decorate
+def f():
+    return 1
+""")
+    f = old['f']
+    new = load("""
+def decorate(func):
+    def wrapper(*args):
+        return func(*args)
+    return wrapper
+@decorate
+def f():
+    return 2
+""")
+    assert_equals(swap_module(old, new, ignore=['__builtins__']), set(['f']))
+    assert_equals(f(), 2)
+
+    assert_equals(get_code_names(compile("def f(): return a.b", "<test>", "exec")), set(['f', 'a', 'b']))
@@ -0,0 +1,216 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import bisect
+import inspect
+
+# Maximum number of per-object indexes we keep around; when we hit this
+# we just start over, which is crude but keeps memory use bounded
+_MAX_OBJECT_INDEXES = 64
+
+# Names are grouped by rank: normal names first, then _private names, then
+# __special__ names. Within each group, names are sorted.
+_N_RANKS = 3
+
+def _rank(name):
+    if name.startswith("__"):
+        return 2
+    elif name.startswith("_"):
+        return 1
+    else:
+        return 0
+
+class CompletionIndex(object):
+
+    """
+    A CompletionIndex holds a set of names to complete against, sorted in
+    the order we want to present completions: names starting with _ and __
+    are sorted after other names. Looking up a prefix is a binary search
+    within each group of names; when the prefix is an extension of the previous
+    prefix looked up, the search is narrowed to the previous matches, so
+    lookups as the user types are cheap.
+
+    The index only holds names; the objects that the names are bound to
+    are looked up by the caller when the completions are returned, so an
+    index is still valid if a name is rebound to a different object.
+    """
+
+    def __init__(self, names):
+        groups = [[] for i in xrange(_N_RANKS)]
+        for name in set(names):
+            groups[_rank(name)].append(name)
+        for group in groups:
+            group.sort()
+
+        self.__groups = groups
+        self.__last = None
+
+    def __len__(self):
+        return sum(len(group) for group in self.__groups)
+
+    def find(self, prefix=''):
+        """Return a list of all names starting with prefix, in completion order"""
+
+        # Read the cached state in one step so that concurrent lookups
+        # from different threads just see a possibly less useful cache
+        last = self.__last
+        if last is not None and prefix.startswith(last[0]):
+            bounds = last[1]
+        else:
+            bounds = [(0, len(group)) for group in self.__groups]
+
+        new_bounds = []
+        result = []
+        for group, (lo, hi) in zip(self.__groups, bounds):
+            start = bisect.bisect_left(group, prefix, lo, hi)
+            end = start
+            while end < hi and group[end].startswith(prefix):
+                end += 1
+            new_bounds.append((start, end))
+            result.extend(group[start:end])
+
+        self.__last = (prefix, new_bounds)
+
+        return result
+
+class ScopeIndex(CompletionIndex):
+
+    """
+    A ScopeIndex is a CompletionIndex for the names bound in a scope
+    dictionary, along with the builtins for that scope.
+
+    Scopes that we complete against are the result scopes of statements,
+    which are only modified while that statement is executing, so it's
+    sufficient to check the names bound in the scope (rather than their
+    values) to tell whether the index needs to be rebuilt. See is_valid_for().
+    """
+
+    def __init__(self, scope):
+        self.__scope_names = scope.keys()
+
+        builtins = scope.get('__builtins__')
+        if builtins is not None and not isinstance(builtins, dict):
+            builtins = builtins.__dict__
+        self.__builtins = builtins
+
+        if builtins is not None:
+            names = scope.keys() + builtins.keys()
+        else:
+            names = scope.keys()
+
+        CompletionIndex.__init__(self, names)
+
+    def is_valid_for(self, scope):
+        """Check if the index still reflects the names bound in scope"""
+
+        # Checking the number of names first makes the common case cheap; if
+        # it matches, the names are the same if every old name is still bound
+        return len(scope) == len(self.__scope_names) and all(name in scope for name in self.__scope_names)
+
+    def lookup(self, scope, name):
+        """Return the object that name is bound to within scope or its builtins"""
+
+        try:
+            return scope[name]
+        except KeyError:
+            if self.__builtins is not None:
+                return self.__builtins.get(name)
+            return None
+
+######################################################################
+
+_object_indexes = {}
+
+def _index_key(obj):
+    # Return the key to cache the index for obj under and a "size" we use
+    # to check if a cached index is still valid, or (None, None) if we can't
+    # cache the index for the object.
+    if inspect.ismodule(obj) or inspect.isclass(obj):
+        return obj, len(getattr(obj, '__dict__', ()))
+
+    # For instances, dir() normally just lists the attributes of the type;
+    # but if the object has its own __dict__ or the type customizes dir(),
+    # then the names will vary from object to object.
+    klass = type(obj)
+    if hasattr(obj, '__dict__') or hasattr(klass, '__dir__') or hasattr(klass, '__members__'):
+        return None, None
+
+    return klass, len(getattr(klass, '__dict__', ()))
+
+def get_object_index(obj):
+    """Get a CompletionIndex for the attributes of an object
+
+    Indexes for modules, classes, and instances of simple types are cached,
+    so repeated completion on (for example) a large module or on a numpy
+    array doesn't rebuild the index each time.
+
+    """
+
+    key, size = _index_key(obj)
+    if key is None:
+        return CompletionIndex(dir(obj))
+
+    try:
+        cached_size, index = _object_indexes[key]
+        if cached_size == size:
+            return index
+    except KeyError:
+        pass
+
+    if len(_object_indexes) >= _MAX_OBJECT_INDEXES:
+        _object_indexes.clear()
+
+    index = CompletionIndex(dir(obj))
+    _object_indexes[key] = (size, index)
+
+    return index
+
+######################################################################
+
+if __name__ == '__main__':
+    from test_utils import assert_equals
+
+    index = CompletionIndex(['b', '__b', '_b', 'a', 'ab', '_a', '__a__', 'abc', 'b'])
+    assert_equals(len(index), 8)
+    assert_equals(index.find(), ['a', 'ab', 'abc', 'b', '_a', '_b', '__a__', '__b'])
+    assert_equals(index.find('a'), ['a', 'ab', 'abc'])
+    assert_equals(index.find('ab'), ['ab', 'abc'])
+    assert_equals(index.find('abcd'), [])
+    # Shrinking the prefix again after narrowing
+    assert_equals(index.find('a'), ['a', 'ab', 'abc'])
+    assert_equals(index.find('_'), ['_a', '_b', '__a__', '__b'])
+    assert_equals(index.find('__'), ['__a__', '__b'])
+    assert_equals(index.find('c'), [])
+
+    scope = { '__builtins__': { 'len': len }, 'a': 1, 'len': 2 }
+    index = ScopeIndex(scope)
+    assert_equals(index.find(), ['a', 'len', '__builtins__'])
+    assert_equals(index.lookup(scope, 'len'), 2)
+    assert index.is_valid_for(scope)
+    scope['b'] = 3
+    assert not index.is_valid_for(scope)
+    # Replacing a name with a different one changes the names without changing their number
+    del scope['b']
+    del scope['a']
+    scope['c'] = 4
+    assert not index.is_valid_for(scope)
+
+    import __builtin__
+    index = ScopeIndex({ '__builtins__': __builtin__ })
+    assert_equals(index.lookup({}, 'len'), len)
+
+    import re
+    index = get_object_index(re)
+    assert get_object_index(re) is index
+    assert_equals(index.find('compil'), ['compile'])
+    assert get_object_index(1) is get_object_index(2)
+
+    class A(object):
+        pass
+    a = A()
+    assert get_object_index(a) is not get_object_index(a)
@@ -11,6 +11,7 @@ import inspect
 
 from popup import Popup
 from doc_popup import DocPopup
+from lookup_thread import LookupThread
 from data_format import is_data_object
 from shell_buffer import ADJUST_NONE
 
@@ -69,24 +70,18 @@ class CompletionPopup(Popup):
 
         self.__doc_popup= DocPopup(fixed_width=True, fixed_height=True, max_height=HEIGHT, can_focus=False)
 
-        self._in_change = False
+        self.__lookup_thread = LookupThread()
+        self.__cache_key = None
+        self.__cache_prefix = None
+        self.__cache = None
+
+        self.__in_change = False
         self.spontaneous = False
         self.showing = False
 
-    def __update_completions(self, spontaneous=False):
-        buf = self.__view.get_buffer()
-
+    def __set_completions(self, completions):
         self.__in_change = True
         self.__tree_model.clear()
-        line, offset = buf.iter_to_pos(buf.get_iter_at_mark(buf.get_insert()), adjust=ADJUST_NONE)
-        if line is None:
-            completions = []
-        else:
-            if spontaneous:
-                min_length = SPONTANEOUS_MIN_LENGTH
-            else:
-                min_length = 0
-            completions = buf.worksheet.find_completions(line, offset, min_length)
         for display, completion, obj in completions:
             self.__tree_model.append([display, completion, obj])
 
@@ -95,6 +90,95 @@ class CompletionPopup(Popup):
         self.__in_change = False
         self.__update_doc_popup()
 
+    def __cached_completions(self, key, prefix):
+        # If we have the results of a previous lookup against the same object
+        # for a shorter prefix, we can filter those to get the completions for
+        # the new prefix without calling into user code.
+        if self.__cache_key != key or not prefix.startswith(self.__cache_prefix):
+            return None
+
+        return [(display, display[len(prefix):], obj)
+                for display, _, obj in self.__cache
+                if display.startswith(prefix)]
+
+    def __update_completions(self, on_complete, spontaneous=False):
+        # Finding the completions calls into user code, which might be slow,
+        # so we do it in a separate thread. on_complete is called once we have
+        # the completions (or have given up waiting and used cached completions.)
+
+        buf = self.__view.get_buffer()
+
+        insert = buf.get_iter_at_mark(buf.get_insert())
+        line, offset = buf.iter_to_pos(insert, adjust=ADJUST_NONE)
+        if line is None:
+            names = None
+        else:
+            if spontaneous:
+                min_length = SPONTANEOUS_MIN_LENGTH
+            else:
+                min_length = 0
+
+            # Module names come from an index that is never slow to consult, so
+            # there's no need to use the lookup thread
+            completions = buf.worksheet.find_module_completions(line, offset, min_length)
+            if completions is not None:
+                self.__lookup_thread.cancel()
+                self.__set_completions(completions)
+                on_complete()
+                return
+
+            scope, names = buf.worksheet.get_completion_names(line, offset, min_length)
+
+        if names is None:
+            self.__lookup_thread.cancel()
+            self.__set_completions([])
+            on_complete()
+            return
+
+        worksheet = buf.worksheet
+        key = (id(scope), tuple(names[0:-1]))
+        prefix = names[-1]
+
+        # Until the lookup finishes, the popup must not offer completions for the
+        # previous prefix, since inserting one would insert the wrong suffix, so
+        # filter the cached completions for the new prefix, or show nothing.
+        cached = self.__cached_completions(key, prefix)
+        if cached is not None:
+            self.__set_completions(cached)
+        else:
+            self.__set_completions([])
+
+        # Set if we've already used cached completions because the lookup timed out
+        used_cache = [False]
+
+        def lookup():
+            return worksheet.complete_names(scope, names)
+
+        def on_result(completions):
+            self.__cache_key = key
+            self.__cache_prefix = prefix
+            self.__cache = completions
+
+            # The user may have moved the cursor without editing while we were waiting
+            insert = buf.get_iter_at_mark(buf.get_insert())
+            if buf.iter_to_pos(insert, adjust=ADJUST_NONE) != (line, offset):
+                return
+
+            self.__set_completions(completions)
+            if not used_cache[0]:
+                on_complete()
+            elif self.showing and len(completions) == 0:
+                self.popdown()
+
+        def on_timeout():
+            completions = self.__cached_completions(key, prefix)
+            if completions is not None:
+                used_cache[0] = True
+                self.__set_completions(completions)
+                on_complete()
+
+        self.__lookup_thread.lookup(lookup, on_result, timeout_callback=on_timeout)
+
     def __update_position(self):
         buf = self.__view.get_buffer()
         
@@ -149,7 +233,8 @@ class CompletionPopup(Popup):
 
     def __insert_selected(self):
         model, iter = self.__tree.get_selection().get_selected()
-        self.__insert_completion(iter)
+        if iter is not None:
+            self.__insert_completion(iter)
             
     def __on_selection_changed(self, selection):
         if not self.__in_change:
@@ -171,29 +256,31 @@ class CompletionPopup(Popup):
            of editing, rather than because of an explicit key shortcut.
 
         """
-        
-        self.__update_completions(spontaneous=spontaneous)
-        num_completions = len(self.__tree_model)
-        if num_completions == 0:
-            return
-        elif num_completions == 1 and not spontaneous:
-            self.__insert_selected()
-            return
-        
-        self.__update_position()
 
-        self.spontaneous = spontaneous
+        def on_complete():
+            num_completions = len(self.__tree_model)
+            if num_completions == 0:
+                return
+            elif num_completions == 1 and not spontaneous:
+                self.__insert_selected()
+                return
 
-        if self.showing:
-            return
+            self.__update_position()
 
-        self.show()
-        self.showing = True
+            self.spontaneous = spontaneous
 
-        self.__doc_popup.position_next_to_window(self)
-        self.__update_doc_popup()
+            if self.showing:
+                return
 
-        self.focus()
+            self.show()
+            self.showing = True
+
+            self.__doc_popup.position_next_to_window(self)
+            self.__update_doc_popup()
+
+            self.focus()
+
+        self.__update_completions(on_complete, spontaneous=spontaneous)
 
     def update(self):
         """Update the completion popup after the cursor is moved, or text is inserted.
@@ -205,17 +292,24 @@ class CompletionPopup(Popup):
         
         if not self.showing:
             return
-        
-        self.__update_completions(spontaneous=self.spontaneous)
-        if len(self.__tree_model) == 0:
-            self.popdown()
-            return
-        
-        self.__update_position()
+
+        def on_complete():
+            if not self.showing:
+                return
+
+            if len(self.__tree_model) == 0:
+                self.popdown()
+                return
+
+            self.__update_position()
+
+        self.__update_completions(on_complete, spontaneous=self.spontaneous)
         
     def popdown(self):
         """Hide the completion if it is currently showing"""
 
+        self.__lookup_thread.cancel()
+
         if not self.showing:
             return
 
@@ -6,15 +6,44 @@
 #
 ########################################################################
 
-import gtk
-
 class CustomResult(object):
     def create_widget(self):
         raise NotImplementedError()
 
+    def render_png(self):
+        """Render the result without a window, for reinteract-serve and similar.
+
+        @returns: the PNG image data as a string, or None if this kind of result
+           can only be displayed as a widget
+
+        """
+        return None
+
+class ImageResult(CustomResult):
+    """A result that is displayed as a PNG image"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def create_widget(self):
+        # Imported here so that the worksheet code can be used without GTK+
+        import gtk
+
+        loader = gtk.gdk.PixbufLoader('png')
+        loader.write(self.data)
+        loader.close()
+
+        return gtk.image_new_from_pixbuf(loader.get_pixbuf())
+
+    def render_png(self):
+        return self.data
+
 def show_menu(widget, event, save_callback=None):
     """Convenience function to create a right-click menu with a Save As option"""
 
+    # Imported here so that the worksheet code can be used without GTK+
+    import gtk
+
     toplevel = widget.get_toplevel()
         
     menu = gtk.Menu()
@@ -6,8 +6,10 @@
 #
 ########################################################################
 
+import inspect
 import re
 import pydoc
+import sys
 import gtk
 
 from data_format import insert_with_tag, is_data_object
@@ -15,37 +17,160 @@ from data_format import insert_with_tag, is_data_object
 BOLD_RE = re.compile("(?:(.)\b(.))+")
 STRIP_BOLD_RE = re.compile("(.)\b(.)")
 
-def insert_docs(buf, iter, obj, bold_tag):
-    """Insert documentation about obj into a gtk.TextBuffer
+# Number of rendered documents we keep around. Documentation for a large
+# module can take hundreds of milliseconds to generate, so we don't want to
+# regenerate it each time the user hovers over the same name.
+_MAX_CACHED_DOCS = 32
 
-    @param buf: the buffer to insert the documentation into
-    @param iter: the location to insert the documentation
-    @param obj: the object to get documentation about
-    @param bold_tag: the tag to use for bold text, such as headings
+# List of (obj, version, runs), most recently used last
+_doc_cache = []
 
-    """
-    
-    # If the routine is an instance, we get help on the type instead
-    if is_data_object(obj):
-        obj = type(obj)
-        
+def _get_function_version(value):
+    # Notebook hot-swaps modules by patching the code, defaults and docs of their
+    # functions in place (see code_swap), so these are part of the version
+    if isinstance(value, (staticmethod, classmethod)):
+        value = value.__get__(None, object)
+    if inspect.ismethod(value):
+        value = value.im_func
+    if inspect.isfunction(value):
+        return value.func_code, id(value.func_defaults), value.func_doc
+    else:
+        return None
+
+def _get_dict_version(d):
+    return tuple((k, _get_function_version(d[k])) for k in sorted(d))
+
+def _get_version(obj):
+    # Return a value that changes when the documentation for obj might have
+    # changed without obj being replaced by a new object. Modules and classes
+    # can have attributes added; the version of a module changes when the
+    # module is upgraded underneath us.
+    if inspect.ismodule(obj):
+        return getattr(obj, '__version__', None), _get_dict_version(obj.__dict__)
+
+    module = sys.modules.get(getattr(obj, '__module__', None))
+    module_version = getattr(module, '__version__', None)
+
+    if inspect.isclass(obj):
+        return module_version, _get_dict_version(getattr(obj, '__dict__', {}))
+    else:
+        return module_version, _get_function_version(obj)
+
+def _render_docs(obj):
     name = getattr(obj, '__name__', None)
     document = pydoc.text.document(obj, name)
 
+    # Strip the trailing newline; this isn't very justifiable in general terms,
+    # but matches what we need in Reinteract
+    if document.endswith("\n"):
+        document = document[:-1]
+
     # pydoc.text.document represents boldface with overstrikes, we need to
     # reverse engineer this and find the spans of bold text
+    runs = []
     pos = 0
     while True:
         m = BOLD_RE.search(document, pos)
         if m is None:
-            # Strip the trailing newline; this isn't very justifiable in general terms,
-            # but matches what we need in Reinteract
-            if document.endswith("\n"):
-                buf.insert(iter, document[pos:-1])
-            else:
-                buf.insert(iter, document[pos:])
+            if pos < len(document):
+                runs.append((document[pos:], False))
             break
 
-        buf.insert(iter, document[pos:m.start()])
-        insert_with_tag(buf, iter, STRIP_BOLD_RE.sub(lambda m: m.group(1), m.group()), bold_tag)
+        if m.start() > pos:
+            runs.append((document[pos:m.start()], False))
+        runs.append((STRIP_BOLD_RE.sub(lambda m: m.group(1), m.group()), True))
         pos = m.end()
+
+    return runs
+
+def get_doc_runs(obj):
+    """Get the documentation for an object as a list of runs of text
+
+    The documentation is cached, so getting the documentation for the same object
+    again is cheap.
+
+    @param obj: the object to get documentation about
+    @returns: a list of (text, is_bold)
+
+    """
+
+    # If the routine is an instance, we get help on the type instead
+    if is_data_object(obj):
+        obj = type(obj)
+
+    version = _get_version(obj)
+    for i, (cached_obj, cached_version, runs) in enumerate(_doc_cache):
+        if cached_obj is obj:
+            del _doc_cache[i]
+            if cached_version == version:
+                _doc_cache.append((obj, version, runs))
+                return runs
+            break
+
+    runs = _render_docs(obj)
+
+    if len(_doc_cache) >= _MAX_CACHED_DOCS:
+        del _doc_cache[0]
+    _doc_cache.append((obj, version, runs))
+
+    return runs
+
+def insert_docs(buf, iter, obj, bold_tag):
+    """Insert documentation about obj into a gtk.TextBuffer
+
+    @param buf: the buffer to insert the documentation into
+    @param iter: the location to insert the documentation
+    @param obj: the object to get documentation about
+    @param bold_tag: the tag to use for bold text, such as headings
+
+    """
+
+    for text, is_bold in get_doc_runs(obj):
+        if is_bold:
+            insert_with_tag(buf, iter, text, bold_tag)
+        else:
+            buf.insert(iter, text)
+
+######################################################################
+
+if __name__ == '__main__':
+    from test_utils import assert_equals
+
+    def f():
+        """Does something"""
+        pass
+
+    runs = get_doc_runs(f)
+    assert_equals(runs, [('f', True), ('()\n    Does something', False)])
+    assert get_doc_runs(f) is runs
+
+    # Instances get the documentation of their type
+    assert get_doc_runs(1) is get_doc_runs(2)
+
+    # Adding an attribute to a class changes its documentation
+    class A(object):
+        pass
+    runs = get_doc_runs(A)
+    A.method = f
+    assert get_doc_runs(A) is not runs
+    assert 'method' in "".join(text for text, _ in get_doc_runs(A))
+
+    # Hot-swapping the code of a function changes its documentation
+    def g(a=1):
+        """Does something else"""
+        pass
+    f.func_code = g.func_code
+    f.func_defaults = g.func_defaults
+    f.func_doc = g.func_doc
+    assert_equals(get_doc_runs(f), [('f', True), ('(a=1)\n    Does something else', False)])
+
+    # Including when it's a method of a class
+    runs = get_doc_runs(A)
+    A.method.im_func.func_doc = "Does nothing"
+    assert get_doc_runs(A) is not runs
+
+    # Old entries are evicted
+    for i in xrange(_MAX_CACHED_DOCS):
+        get_doc_runs(type("C%d" % i, (object,), {}))
+    assert_equals(len(_doc_cache), _MAX_CACHED_DOCS)
+    assert not f in [obj for obj, _, _ in _doc_cache]
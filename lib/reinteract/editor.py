@@ -19,6 +19,7 @@ from shell_buffer import ShellBuffer
 from shell_view import ShellView
 from save_file import SaveFileBuilder
 from print_operation import PrintOperation
+import saved_results
 
 class Editor(gobject.GObject):
     def __init__(self, notebook):
@@ -182,6 +183,7 @@ class Editor(gobject.GObject):
             self._save(fullname)
             self._clear_unsaved()
             os.remove(old_filename)
+            saved_results.remove_results(old_filename)
             self.notebook.refresh()
 
         self.__prompt_for_name(title=title, save_button_text="_Rename", action=action, check_name=check_name)
@@ -194,9 +196,10 @@ class Editor(gobject.GObject):
     def needs_calculate(self):
         return (self.state != NotebookFile.EXECUTE_SUCCESS and
                 self.state != NotebookFile.NONE and
-                self.state != NotebookFile.EXECUTING)
+                self.state != NotebookFile.EXECUTING and
+                self.state != NotebookFile.QUEUED)
 
-    def calculate(self):
+    def calculate(self, up_to_cursor=False):
         pass
 
     def undo(self):
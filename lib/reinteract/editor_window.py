@@ -28,6 +28,7 @@ class EditorWindow(BaseWindow):
          <menuitem action="open"/>
          <menuitem action="save"/>
          <menuitem action="save-as"/>
+         <menuitem action="export-timings"/>
          <separator/>
          <menuitem action="quit"/>
       </menu>
@@ -39,6 +40,7 @@ class EditorWindow(BaseWindow):
          <menuitem action="delete"/>
          <separator/>
          <menuitem action="calculate"/>
+         <menuitem action="calculate-to-cursor"/>
          <menuitem action="break"/>
          <separator/>
          <menuitem action="preferences"/>
@@ -138,6 +140,7 @@ class EditorWindow(BaseWindow):
             self.current_editor.destroy()
 
         self.current_editor = editor
+        self._update_focused_worksheet()
 
         self.current_editor.connect('notify::modified', lambda *args: self.update_sensitivity())
         self.current_editor.connect('notify::title', self.__update_title)
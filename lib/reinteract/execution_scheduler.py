@@ -0,0 +1,285 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Each worksheet executes its statements in its own worker thread (see
+# ThreadExecutor). Without coordination, recalculating many worksheets at once -
+# say, after changing a library used by all the worksheets of a notebook - starts
+# that many threads fighting with each other and with the user interface for the
+# interpreter. The scheduler limits the number of worksheets calculating at once,
+# and starts the rest as earlier calculations complete: first calculations of
+# the worksheet the user is working in, then calculations the user asked for,
+# and last calculations started in the background by automatic calculation.
+#
+
+import logging
+
+from signals import Property, SignalObject
+
+_debug = logging.getLogger("ExecutionScheduler").debug
+
+# The default number of calculations running at once. Each one is a thread of this
+# process, so calculations share the interpreter lock with each other and with the
+# user interface; running more than one at a time would only make each slower. (A
+# backend running calculations in separate processes could run as many as there are
+# processors.)
+DEFAULT_MAX_RUNNING = 1
+
+class ScheduledRun(SignalObject):
+
+    """
+    A calculation of a worksheet submitted to the L{ExecutionScheduler}
+
+    The state of the run is one of QUEUED, RUNNING, or DONE; 'notify::state'
+    is emitted when it changes.
+
+    """
+
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+
+    state = Property(type=int, default=QUEUED)
+
+    def __init__(self, scheduler, executor, worksheet, background):
+        SignalObject.__init__(self)
+
+        self.scheduler = scheduler
+        self.executor = executor
+        self.worksheet = worksheet
+        self.background = background
+        # Order of submission, for runs with the same priority
+        self.serial = 0
+
+    @property
+    def priority(self):
+        """The priority of the run, one of the ExecutionScheduler.PRIORITY_* constants"""
+
+        if self.worksheet is self.scheduler.focused_worksheet:
+            return ExecutionScheduler.PRIORITY_FOCUSED
+        elif self.background:
+            return ExecutionScheduler.PRIORITY_BACKGROUND
+        else:
+            return ExecutionScheduler.PRIORITY_NORMAL
+
+    def interrupt(self):
+        """Interrupt the run's executor
+
+        If the run is still queued, it is started immediately, whatever the number of
+        runs already running, so that the executor completes without executing anything.
+
+        """
+
+        self.executor.interrupt()
+        if self.state == ScheduledRun.QUEUED:
+            self.scheduler._start(self)
+
+class ExecutionScheduler(SignalObject):
+
+    """
+    Scheduler for the calculations of all open worksheets
+
+    Worksheets submit their executors with L{submit} rather than executing
+    them directly. At most max_running executors run at once; the rest are
+    queued, and started in order of priority (see L{ScheduledRun.priority}),
+    then of submission. The scheduler must only be used from the main loop
+    thread.
+
+    Signals
+    =======
+     - B{changed}(scheduler): emitted when a run is queued, starts or completes,
+       or the order of the queued runs changes
+
+    """
+
+    PRIORITY_FOCUSED = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BACKGROUND = 2
+
+    __signals__ = {
+        'changed' : (),
+    }
+
+    def __init__(self, max_running=None):
+        """
+        @param max_running: the maximum number of runs executing at once. The
+           default is DEFAULT_MAX_RUNNING.
+
+        """
+
+        SignalObject.__init__(self)
+
+        if max_running is None:
+            max_running = DEFAULT_MAX_RUNNING
+
+        self.__max_running = max_running
+        self.__focused_worksheet = None
+        self.__queued = []
+        self.__running = []
+        self.__serial = 0
+
+    def submit(self, executor, worksheet, background=False):
+        """Submit an executor to be executed
+
+        The executor must have been compiled successfully, and not executed.
+
+        @param executor: the L{ThreadExecutor} to execute
+        @param worksheet: the worksheet that the executor is calculating
+        @param background: True if the calculation was started automatically
+           rather than by the user
+        @returns: a L{ScheduledRun} for following the state of the run
+
+        """
+
+        run = ScheduledRun(self, executor, worksheet, background)
+        self.__serial += 1
+        run.serial = self.__serial
+        executor.connect('complete', self.__on_executor_complete, run)
+
+        self.__queued.append(run)
+        self.__dispatch()
+        if run.state == ScheduledRun.QUEUED:
+            _debug("Queued calculation of %s", worksheet.filename)
+            self.emit('changed')
+
+        return run
+
+    def get_runs(self):
+        """Get the runs that are running or queued
+
+        @returns: a list of L{ScheduledRun}, the running runs first, then the
+           queued runs in the order they will be started
+
+        """
+
+        return self.__running + sorted(self.__queued, key=self.__sort_key)
+
+    def __sort_key(self, run):
+        return (run.priority, run.serial)
+
+    def _start(self, run):
+        self.__queued.remove(run)
+        self.__running.append(run)
+        _debug("Starting calculation of %s", run.worksheet.filename)
+        run.state = ScheduledRun.RUNNING
+        run.executor.execute()
+        self.emit('changed')
+
+    def __dispatch(self):
+        while len(self.__queued) > 0 and len(self.__running) < self.__max_running:
+            self._start(min(self.__queued, key=self.__sort_key))
+
+    def __on_executor_complete(self, executor, run):
+        if run in self.__running:
+            self.__running.remove(run)
+        elif run in self.__queued:
+            # Shouldn't happen, since a queued executor hasn't started
+            self.__queued.remove(run)
+
+        run.state = ScheduledRun.DONE
+        self.__dispatch()
+        self.emit('changed')
+
+    def __get_max_running(self):
+        return self.__max_running
+
+    def __set_max_running(self, max_running):
+        self.__max_running = max(1, max_running)
+        self.__dispatch()
+
+    max_running = Property(getter=__get_max_running, setter=__set_max_running, type=int)
+
+    def __get_focused_worksheet(self):
+        return self.__focused_worksheet
+
+    def __set_focused_worksheet(self, worksheet):
+        # This only affects queued runs; running runs aren't affected
+        if worksheet is self.__focused_worksheet:
+            return
+
+        self.__focused_worksheet = worksheet
+        if len(self.__queued) > 0:
+            self.emit('changed')
+
+    focused_worksheet = Property(getter=__get_focused_worksheet, setter=__set_focused_worksheet, type=object)
+
+######################################################################
+
+execution_scheduler = ExecutionScheduler()
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from test_utils import assert_equals
+
+    class TestExecutor(SignalObject):
+        __signals__ = {
+            'complete' : (),
+        }
+
+        def __init__(self, name):
+            SignalObject.__init__(self)
+            self.name = name
+            self.executed = False
+            self.interrupted = False
+
+        def execute(self):
+            self.executed = True
+
+        def interrupt(self):
+            self.interrupted = True
+
+    class TestWorksheet(object):
+        def __init__(self, name):
+            self.filename = name
+
+    a, b, c = TestWorksheet("a"), TestWorksheet("b"), TestWorksheet("c")
+
+    scheduler = ExecutionScheduler(max_running=1)
+    changes = []
+    scheduler.connect('changed', lambda *args: changes.append(None))
+
+    def names(runs):
+        return [run.executor.name for run in runs]
+
+    # Runs beyond max_running are queued; background runs are started last, and
+    # runs of the focused worksheet first
+    run1 = scheduler.submit(TestExecutor("1"), a)
+    run2 = scheduler.submit(TestExecutor("2"), b, background=True)
+    run3 = scheduler.submit(TestExecutor("3"), c)
+    run4 = scheduler.submit(TestExecutor("4"), a)
+    scheduler.focused_worksheet = b
+    assert_equals(names(scheduler.get_runs()), ["1", "2", "3", "4"])
+    assert_equals([run.state for run in (run1, run2, run3)],
+                  [ScheduledRun.RUNNING, ScheduledRun.QUEUED, ScheduledRun.QUEUED])
+    assert run1.executor.executed and not run2.executor.executed
+    assert_equals(len(changes), 5)
+
+    run1.executor.emit('complete')
+    assert_equals(run1.state, ScheduledRun.DONE)
+    assert_equals(names(scheduler.get_runs()), ["2", "3", "4"])
+    assert_equals(run2.state, ScheduledRun.RUNNING)
+
+    scheduler.focused_worksheet = None
+    run2.executor.emit('complete')
+    assert_equals(names(scheduler.get_runs()), ["3", "4"])
+
+    # Interrupting a queued run starts it immediately
+    run4.interrupt()
+    assert run4.executor.interrupted
+    assert_equals(names(scheduler.get_runs()), ["3", "4"])
+    assert_equals(run4.state, ScheduledRun.RUNNING)
+    run3.executor.emit('complete')
+    run4.executor.emit('complete')
+    assert_equals(scheduler.get_runs(), [])
+
+    # Raising max_running starts queued runs
+    runs = [scheduler.submit(TestExecutor(str(i)), a) for i in xrange(3)]
+    assert_equals([run.state for run in runs], [ScheduledRun.RUNNING, ScheduledRun.QUEUED, ScheduledRun.QUEUED])
+    scheduler.max_running = 2
+    assert_equals([run.state for run in runs], [ScheduledRun.RUNNING, ScheduledRun.RUNNING, ScheduledRun.QUEUED])
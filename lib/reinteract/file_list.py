@@ -6,6 +6,7 @@
 #
 ########################################################################
 
+import bisect
 import gobject
 import gtk
 import logging
@@ -16,6 +17,10 @@ from notebook import Notebook, NotebookFile, WorksheetFile, MiscFile, LibraryFil
 
 _HEADER_COLOR = gtk.gdk.Color(0xffff,0xdddd,0xbbbb)
 
+# Folders with more than this many items aren't added to the tree until
+# they are expanded
+LAZY_FOLDER_SIZE = 100
+
 _debug = logging.getLogger("FileList").debug
 
 ######################################################################
@@ -56,18 +61,16 @@ _file_class_order[WorksheetFile] = 0
 _file_class_order[LibraryFile] = 1
 _file_class_order[MiscFile] = 2
 
-def _compare_files(file_a, file_b):
-    c = cmp(_file_class_order[file_a.__class__], _file_class_order[file_b.__class__])
-    if c != 0:
-        return c
-
-    return _compare_paths(file_a.path, file_b.path)
-
 ######################################################################
 # Classes for the items in the list
 ######################################################################
 
 class _Item:
+    # The item containing this item
+    parent = None
+    # Iter for the row in the model, or None if the item isn't in the model
+    iter = None
+
     def get_text(self):
         return os.path.basename(self.path)
 
@@ -84,6 +87,16 @@ class _Item:
         # ordering is arbitrary
         return cmp(self.__class__.__name__, other.__class__.__name__)
 
+class _ParentItem(_Item):
+    def __init__(self):
+        # Sorted list of child items
+        self.children = []
+        # Whether the children have been added to the model
+        self.populated = False
+        # Iter for the placeholder row we add as a child of a row that isn't populated
+        # (so it has an expander)
+        self.placeholder = None
+
 class _FileItem(_Item):
     def __init__(self, file):
         self.file = file
@@ -97,8 +110,9 @@ class _FileItem(_Item):
         else:
             return name
 
-class _FolderItem(_Item):
+class _FolderItem(_ParentItem):
     def __init__(self, path, klass):
+        _ParentItem.__init__(self)
         self.path = path
         self.klass = klass
 
@@ -116,6 +130,10 @@ class _HeaderItem(_Item):
         else:
             return "Other Files"
 
+class _PlaceholderItem(_Item):
+    def get_text(self):
+        return "..."
+
 ######################################################################
 # Tree view utility
 ######################################################################
@@ -135,23 +153,6 @@ def _next_row_depthfirst(model, iter):
 
     return None
 
-def _remove_row_depthfirst(model, iter):
-    # Remove a row and returns an iterator to the next row in depth-first order.
-    # (This implementation depends on the TreeStore being "iters_persist")
-
-    parent = model.iter_parent(iter)
-    if model.remove(iter):
-        return iter
-
-    while parent is not None:
-        next = model.iter_next(parent)
-        if next is not None:
-            return next
-
-        parent = model.iter_parent(parent)
-
-    return None
-
 # Enhance gtk.CellRendererPixbuf to support a background color (use for header rows)
 class _BgPixbufRenderer(gtk.CellRendererPixbuf):
     # To simplify, use background_gdk = None, rather than background-set = False
@@ -175,6 +176,7 @@ class FileList(gtk.TreeView):
         'rename-file':  (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         'delete-file':  (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         'row-activated':  'override',
+        'test-expand-row':  'override',
         'destroy': 'override'
     }
 
@@ -182,7 +184,15 @@ class FileList(gtk.TreeView):
         self.__model = gtk.TreeStore(gobject.TYPE_PYOBJECT)
         gtk.TreeView.__init__(self, self.__model)
         self.notebook = notebook
-        self.__files_changed_handler = self.notebook.connect('files-changed', self.on_files_changed)
+        self.__file_added_handler = self.notebook.connect('file-added', self.on_file_added)
+        self.__file_removed_handler = self.notebook.connect('file-removed', self.on_file_removed)
+
+        # Indexes from files, folders, and classes of file to the corresponding items
+        self.__root = _ParentItem()
+        self.__file_items = {}      # path => _FileItem
+        self.__folder_items = {}    # (klass, path) => _FolderItem
+        self.__header_items = {}    # klass => _HeaderItem
+        self.__file_counts = {}     # klass => number of files of that class
 
         column = gtk.TreeViewColumn()
         self.append_column(column)
@@ -205,7 +215,12 @@ class FileList(gtk.TreeView):
         self.set_headers_visible(False)
         self.get_selection().set_select_function(self.__select_function)
 
-        self.__rescan()
+        # Build up the items first, and then add them to the model all at once
+        # so we can decide which folders to populate lazily
+        for file in notebook.files.itervalues():
+            self.__add_file(file)
+        self.__populate(self.__root)
+        self.set_show_expanders(len(self.__folder_items) > 0)
 
     def do_button_press_event(self, event):
         # We hard-code support for the Mac-style control-click here because the
@@ -230,13 +245,19 @@ class FileList(gtk.TreeView):
             return gtk.TreeView.do_button_press_event(self, event)
 
     def do_destroy(self):
-        iter = self.__model.get_iter_first()
-        while iter:
-            item = self.__model.get_value(iter, 0)
-            self.__disconnect_item(item)
-            iter = _next_row_depthfirst(self.__model, iter)
+        for item in self.__file_items.itervalues():
+            if item.iter is not None:
+                self.__disconnect_item(item)
 
-        self.notebook.disconnect(self.__files_changed_handler)
+        self.notebook.disconnect(self.__file_added_handler)
+        self.notebook.disconnect(self.__file_removed_handler)
+
+    def do_test_expand_row(self, iter, path):
+        item = self.__model.get_value(iter, 0)
+        if isinstance(item, _ParentItem) and not item.populated:
+            self.__populate(item)
+
+        return False
 
     def do_row_activated(self, path, column):
         iter = self.__model.get_iter(path)
@@ -281,30 +302,10 @@ class FileList(gtk.TreeView):
 
     ############################################################
 
-    def __iter_for_item(self, item):
-        iter = self.__model.get_iter_first()
-        while iter:
-            row_item = self.__model.get_value(iter, 0)
-            if row_item == item:
-                return iter
-            iter = _next_row_depthfirst(self.__model, iter)
-
-        return None
-
-    def __iter_for_file(self, file):
-        iter = self.__model.get_iter_first()
-        while iter:
-            row_item = self.__model.get_value(iter, 0)
-            if isinstance(row_item, _FileItem) and row_item.file == file:
-                return iter
-            iter = _next_row_depthfirst(self.__model, iter)
-
-        return None
-
     def __refresh_item(self, item):
-        iter = self.__iter_for_item(item)
-        path = self.__model.get_path(iter)
-        self.__model.row_changed(path, iter)
+        if item.iter is not None:
+            path = self.__model.get_path(item.iter)
+            self.__model.row_changed(path, item.iter)
 
     def __connect_item(self, item):
         if isinstance(item, _FileItem):
@@ -391,94 +392,116 @@ class FileList(gtk.TreeView):
 
     ############################################################
 
-    def __iter_items(self):
-        # Generator yielding all the items to display in the list in order
-        klass = None
-        path = []
-        for file in sorted(self.notebook.files.values(), _compare_files):
-            if file.__class__ != klass:
-                klass = file.__class__
-                path = []
-                yield (_HeaderItem(file.__class__), len(path))
-
-            new_path = _split_path(file.path)[0:-1]
-            while len(path) > len(new_path) or (len(path) > 0 and path[len(path) - 1] != new_path[len(path) - 1]):
-                path.pop()
-
-            while len(new_path) > len(path):
-                folder_name = new_path[len(path)]
-                path.append(folder_name)
-                yield (_FolderItem(os.path.join(*new_path[0:len(path)]), klass), len(path) - 1)
-
-            yield (_FileItem(file), len(path))
-
-    def __rescan(self):
-        #
-        # Compare the items that should be in the list (from __iter_items) with the items that are
-        # currently in the list, insert missing items, and remove items that no longer in the list.
-        # We go through quite a bit of trouble here to make the minimal set of inserts and removals
-        # rather than just starting over from scratch to avoid problems with scroll position,
-        # selection, and expanded state that will occur if we delete everything and add them again.
-        # Efficiency is not the main concern.
-        #
-        depth = 0
-        parent = None
-        next_old = self.__model.get_iter_first()
-        seen_folders = False
-        for (item, new_depth) in self.__iter_items():
-            # Delete old items that are logically before the next item
-            found_item = False
-            while next_old is not None:
-                old_item = self.__model.get_value(next_old, 0)
-                c = cmp(item, old_item)
-                if c < 0:
-                    break
-                elif c == 0:
-                    found_item = True
-                    iter = next_old
-                    next_old = _next_row_depthfirst(self.__model, next_old)
-                    break
-                else:
-                    next_parent = self.__model.iter_parent(next_old)
-                    _debug("Removing %s", old_item.get_text())
-                    next_old = _remove_row_depthfirst(self.__model, next_old)
-                    self.__disconnect_item(next_old)
-
-            while new_depth < depth:
-                parent = self.__model.iter_parent(parent)
-                depth -= 1
-
-            if not found_item:
-                if next_old:
-                    _debug("Inserting %s before %s", item.get_text(), self.__model.get_value(next_old, 0).get_text())
-                else:
-                    _debug("Appending %s", item.get_text())
-
-                next = None
-                if next_old:
-                    if parent:
-                        parent_path = self.__model.get_path(parent)
-                    else:
-                        parent_path = ()
-                    if self.__model.get_path(next_old)[0:-1] == parent_path:
-                        next = next_old
-                iter = self.__model.insert_before(parent, next)
-                self.__model.set_value(iter, 0, item)
-                self.__connect_item(item)
-                next_old = _next_row_depthfirst(self.__model, iter)
-
-            if isinstance(item, _FolderItem):
-                seen_folders = True
-                parent = iter
-                depth += 1
-
-        while next_old is not None:
-            next_old = _remove_row_depthfirst(self.__model, next_old)
-
-        self.set_show_expanders(seen_folders)
-
-    def on_files_changed(self, notebook):
-        self.__rescan()
+    # The tree of items always reflects all the files in the notebook, but
+    # only the children of items that are "populated" are in the model. Folders
+    # with many files aren't populated until they are expanded.
+
+    def __show_item(self, parent, position, item):
+        # Add a row for item to the model, as a child of parent, which must be populated
+        item.iter = self.__model.insert(parent.iter, position, (item,))
+        self.__connect_item(item)
+
+        if isinstance(item, _ParentItem):
+            if isinstance(item, _FolderItem) and len(item.children) > LAZY_FOLDER_SIZE:
+                item.populated = False
+                item.placeholder = self.__model.append(item.iter, (_PlaceholderItem(),))
+            else:
+                self.__populate(item)
+
+    def __populate(self, item):
+        # Add rows for the children of item to the model
+        if item.placeholder is not None:
+            self.__model.remove(item.placeholder)
+            item.placeholder = None
+
+        item.populated = True
+        for i, child in enumerate(item.children):
+            self.__show_item(item, i, child)
+
+    def __forget_rows(self, item):
+        # Clear out the iters for an item and its children, after the row has been
+        # removed from the model
+        if isinstance(item, _ParentItem):
+            if item.populated:
+                for child in item.children:
+                    self.__forget_rows(child)
+            item.populated = False
+            item.placeholder = None
+
+        self.__disconnect_item(item)
+        item.iter = None
+
+    def __insert_item(self, parent, item):
+        position = bisect.bisect(parent.children, item)
+        parent.children.insert(position, item)
+        item.parent = parent
+
+        if parent.populated:
+            _debug("Inserting %s", item.get_text())
+            self.__show_item(parent, position, item)
+
+    def __remove_item(self, item):
+        parent = item.parent
+        position = bisect.bisect_left(parent.children, item)
+        assert parent.children[position] is item
+        del parent.children[position]
+        item.parent = None
+
+        if item.iter is not None:
+            _debug("Removing %s", item.get_text())
+            self.__model.remove(item.iter)
+            self.__forget_rows(item)
+
+        # Remove folders that no longer have anything in them
+        if parent is not self.__root and len(parent.children) == 0:
+            del self.__folder_items[(parent.klass, parent.path)]
+            self.__remove_item(parent)
+
+    def __add_file(self, file):
+        klass = file.__class__
+
+        # Each class of file has a header row, at the same level as the toplevel
+        # files and folders of that class
+        count = self.__file_counts.get(klass, 0)
+        if count == 0:
+            header = _HeaderItem(klass)
+            self.__header_items[klass] = header
+            self.__insert_item(self.__root, header)
+        self.__file_counts[klass] = count + 1
+
+        parent = self.__root
+        components = _split_path(file.path)[0:-1]
+        for i in xrange(0, len(components)):
+            folder_path = os.path.join(*components[0:i + 1])
+            folder = self.__folder_items.get((klass, folder_path))
+            if folder is None:
+                folder = _FolderItem(folder_path, klass)
+                self.__folder_items[(klass, folder_path)] = folder
+                self.__insert_item(parent, folder)
+            parent = folder
+
+        item = _FileItem(file)
+        self.__file_items[file.path] = item
+        self.__insert_item(parent, item)
+
+    def on_file_added(self, notebook, file):
+        self.__add_file(file)
+        self.set_show_expanders(len(self.__folder_items) > 0)
+
+    def on_file_removed(self, notebook, file):
+        item = self.__file_items.pop(file.path, None)
+        if item is None:
+            return
+
+        self.__remove_item(item)
+
+        klass = file.__class__
+        self.__file_counts[klass] -= 1
+        if self.__file_counts[klass] == 0:
+            del self.__file_counts[klass]
+            self.__remove_item(self.__header_items.pop(klass))
+
+        self.set_show_expanders(len(self.__folder_items) > 0)
 
     ############################################################
 
@@ -490,11 +513,22 @@ class FileList(gtk.TreeView):
 
         """
 
-        iter = self.__iter_for_file(file)
-        if iter is None:
+        item = self.__file_items.get(file.path)
+        if item is None or item.file is not file:
             return
 
-        self.set_cursor(self.__model.get_path(iter), self.get_column(0))
+        # Make sure that the row is in the model, even if it is inside a
+        # folder that hasn't been populated yet
+        ancestors = []
+        parent = item.parent
+        while parent is not self.__root:
+            ancestors.insert(0, parent)
+            parent = parent.parent
+        for ancestor in ancestors:
+            if not ancestor.populated:
+                self.__populate(ancestor)
+
+        self.set_cursor(self.__model.get_path(item.iter), self.get_column(0))
 
 ######################################################################
 
@@ -709,6 +743,35 @@ if __name__ == '__main__': #pragma: no cover
                "subdir",
                ">aaa.txt")
 
+        # Large folders are only populated when expanded
+        file_list.destroy()
+        LAZY_FOLDER_SIZE = 2
+        make_file("subdir/bbb.txt")
+        make_file("subdir/ccc.txt")
+        notebook.refresh()
+        file_list = FileList(notebook)
+
+        expect("Worksheets",
+               "worksheet_a.rws",
+               "worksheet_b.rws",
+               "Other Files",
+               "subdir",
+               ">...")
+
+        make_file("subdir/ddd.txt")
+        notebook.refresh()
+        file_list.expand_row((4,), False)
+
+        expect("Worksheets",
+               "worksheet_a.rws",
+               "worksheet_b.rws",
+               "Other Files",
+               "subdir",
+               ">aaa.txt",
+               ">bbb.txt",
+               ">ccc.txt",
+               ">ddd.txt")
+
     finally:
         remove()
 
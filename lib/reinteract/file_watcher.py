@@ -0,0 +1,432 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import errno
+import logging
+import os
+import stat
+import struct
+import sys
+
+import main_loop
+from signals import SignalObject
+
+_debug = logging.getLogger("FileWatcher").debug
+
+# How often (in milliseconds) we check for changes when we can't use inotify
+POLL_INTERVAL = 2000
+
+######################################################################
+# Minimal ctypes binding for Linux inotify
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_ONLYDIR     = 0x01000000
+
+IN_NONBLOCK = 0x800 # O_NONBLOCK
+IN_CLOEXEC = 0x80000 # O_CLOEXEC
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_STRUCT = struct.Struct("iIII")
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        _libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        _libc.inotify_init1
+    # use_errno was added in Python 2.6; on 2.5 CDLL() raises TypeError
+    except (ImportError, OSError, AttributeError, TypeError):
+        _libc = None
+
+class _Inotify(object):
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path):
+        wd = _libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails if the directory has already been deleted, which is fine
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        # Return a list of (wd, mask, name) for all pending events
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = _EVENT_STRUCT.unpack_from(data, pos)
+                pos += _EVENT_STRUCT.size
+                name = data[pos:pos + length].rstrip('\0')
+                pos += length
+                events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+######################################################################
+
+class FileWatcher(SignalObject):
+
+    """
+    Class that watches the files in a folder (recursively) for changes.
+
+    On Linux, the folder is watched with inotify; otherwise we fall back to
+    checking the modification time of each directory and file every
+    POLL_INTERVAL milliseconds. In both cases, only the directories
+    that actually changed are listed again.
+
+    Files and directories whose names start with '.' are ignored. Directories
+    aren't reported themselves, but adding or removing a directory reports
+    all the files in it as added or removed.
+
+    Changes are reported in batches by the ::changed signal, which has a
+    list of (kind, relative_path) as an argument, where kind is one of
+    FileWatcher.ADDED, FileWatcher.REMOVED, FileWatcher.CHANGED. Changes within
+    a batch are merged, so a file that is created and then deleted again
+    (like a temporary file during a save) isn't reported at all.
+
+    """
+
+    ADDED = 1
+    REMOVED = 2
+    CHANGED = 3
+
+    __signals__ = {
+        'changed': (list,)
+    }
+
+    def __init__(self, folder, use_inotify=True):
+        SignalObject.__init__(self)
+
+        self.folder = folder
+
+        # relative path of directory => { name => (is_dir, mtime, size) }
+        self.__dirs = {}
+        # relative path of directory => mtime when we last listed it
+        self.__listed_mtimes = {}
+
+        self.__inotify = None
+        self.__wd_dirs = {}     # inotify watch descriptor => relative path of directory
+        self.__dir_wds = {}     # relative path of directory => inotify watch descriptor
+
+        self.__changes = []         # list of [kind, relative_path]
+        self.__change_indices = {}  # relative_path => index in self.__changes
+
+        if use_inotify and _libc is not None:
+            try:
+                self.__inotify = _Inotify()
+            except OSError, e:
+                _debug("Can't use inotify: %s", e)
+
+        self.__add_dir('')
+
+        # The initial contents aren't reported as changes
+        self.__changes = []
+        self.__change_indices = {}
+
+        if self.__inotify is not None:
+            self.__source_id = main_loop.io_add_watch(self.__inotify.fd, main_loop.IO_IN, self.__on_inotify_readable)
+        else:
+            self.__source_id = main_loop.timeout_add(POLL_INTERVAL, self.__on_poll_timeout)
+
+    ############################################################
+
+    def __stat(self, relative):
+        try:
+            st = os.stat(os.path.join(self.folder, relative))
+        except OSError:
+            return None
+
+        return stat.S_ISDIR(st.st_mode), st.st_mtime, st.st_size
+
+    def __add_change(self, kind, relative):
+        i = self.__change_indices.get(relative)
+        if i is None:
+            self.__change_indices[relative] = len(self.__changes)
+            self.__changes.append([kind, relative])
+            return
+
+        old_kind = self.__changes[i][0]
+        if old_kind is None:
+            new_kind = kind
+        elif old_kind == self.ADDED and kind == self.REMOVED:
+            new_kind = None
+        elif old_kind == self.REMOVED and kind == self.ADDED:
+            new_kind = self.CHANGED
+        elif old_kind == self.ADDED:
+            new_kind = self.ADDED
+        else:
+            new_kind = kind
+
+        self.__changes[i][0] = new_kind
+
+    def __add_dir(self, relative):
+        if self.__inotify is not None:
+            # Add the watch before listing the directory, so we don't miss changes
+            # that happen in between
+            try:
+                wd = self.__inotify.add_watch(os.path.join(self.folder, relative))
+                self.__wd_dirs[wd] = relative
+                self.__dir_wds[relative] = wd
+            except OSError, e:
+                _debug("Can't watch %s: %s", relative, e)
+
+        self.__dirs[relative] = {}
+        self.__check_dir(relative, recurse=False)
+
+    def __remove_dir(self, relative):
+        for name, (is_dir, _, _) in self.__dirs[relative].iteritems():
+            if is_dir:
+                self.__remove_dir(os.path.join(relative, name))
+            else:
+                self.__add_change(self.REMOVED, os.path.join(relative, name))
+
+        del self.__dirs[relative]
+        self.__listed_mtimes.pop(relative, None)
+
+        wd = self.__dir_wds.pop(relative, None)
+        if wd is not None:
+            del self.__wd_dirs[wd]
+            self.__inotify.rm_watch(wd)
+
+    def __check_dir(self, relative, recurse):
+        # Bring our idea of the contents of the directory in sync with what is
+        # on disk. We only list the directory if its modification time changed;
+        # if recurse is True, we also check the existing subdirectories.
+        entries = self.__dirs[relative]
+        names = entries.keys()
+
+        st = self.__stat(relative)
+        if st is not None and st[1] != self.__listed_mtimes.get(relative):
+            self.__listed_mtimes[relative] = st[1]
+            try:
+                listed = set(name for name in os.listdir(os.path.join(self.folder, relative))
+                             if not name.startswith('.'))
+                listed.update(names)
+                names = listed
+            except OSError, e:
+                _debug("Can't list %s: %s", relative, e)
+
+        for name in names:
+            self.__update_entry(relative, name, recurse)
+
+    def __update_entry(self, dirname, name, recurse):
+        # Bring our idea of a single file or directory in sync with what's on disk
+        entries = self.__dirs.get(dirname)
+        if entries is None:
+            return
+
+        relative = os.path.join(dirname, name)
+        old = entries.get(name)
+        new = self.__stat(relative)
+
+        if old is not None and (new is None or new[0] != old[0]):
+            if old[0]:
+                self.__remove_dir(relative)
+            else:
+                self.__add_change(self.REMOVED, relative)
+            del entries[name]
+            old = None
+
+        if new is None:
+            return
+
+        entries[name] = new
+        if new[0]:
+            if old is None:
+                self.__add_dir(relative)
+            elif recurse:
+                self.__check_dir(relative, recurse)
+        else:
+            if old is None:
+                self.__add_change(self.ADDED, relative)
+            elif old[1:] != new[1:]:
+                self.__add_change(self.CHANGED, relative)
+
+    def __process_inotify_events(self):
+        overflowed = False
+        for wd, mask, name in self.__inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+
+            dirname = self.__wd_dirs.get(wd)
+            if dirname is None or name == '' or name.startswith('.'):
+                continue
+
+            self.__update_entry(dirname, name, recurse=False)
+
+        if overflowed:
+            # We lost events; fall back to checking everything
+            _debug("inotify queue overflowed, rescanning")
+            self.__listed_mtimes = {}
+            self.__check_dir('', recurse=True)
+
+    def __flush_changes(self):
+        changes = [(kind, relative) for kind, relative in self.__changes if kind is not None]
+        self.__changes = []
+        self.__change_indices = {}
+
+        if len(changes) > 0:
+            self.emit('changed', changes)
+
+    def __on_inotify_readable(self, source, condition):
+        self.__process_inotify_events()
+        self.__flush_changes()
+
+        return True
+
+    def __on_poll_timeout(self):
+        self.__check_dir('', recurse=True)
+        self.__flush_changes()
+
+        return True
+
+    ############################################################
+
+    def get_files(self):
+        """Return a list of the relative paths of all files in the folder"""
+
+        result = []
+        for dirname, entries in self.__dirs.iteritems():
+            for name, (is_dir, _, _) in entries.iteritems():
+                if not is_dir:
+                    result.append(os.path.join(dirname, name))
+
+        return result
+
+    def check(self):
+        """Check for changes immediately, rather than waiting for them to be noticed.
+
+        Any changes are reported by emitting ::changed before this returns.
+
+        """
+
+        if self.__inotify is not None:
+            self.__process_inotify_events()
+        else:
+            self.__check_dir('', recurse=True)
+        self.__flush_changes()
+
+    def close(self):
+        """Stop watching the folder"""
+
+        if self.__source_id:
+            main_loop.source_remove(self.__source_id)
+            self.__source_id = 0
+
+        if self.__inotify is not None:
+            self.__inotify.close()
+            self.__inotify = None
+            self.__wd_dirs = {}
+            self.__dir_wds = {}
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+    import time
+
+    from test_utils import assert_equals
+
+    def test_watcher(use_inotify):
+        base = tempfile.mkdtemp("", "file_watcher")
+        try:
+            def write_file(name, contents=""):
+                absname = os.path.join(base, name)
+                dirname = os.path.dirname(absname)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                f = open(absname, "w")
+                f.write(contents)
+                f.close()
+
+            write_file("a.rws")
+            write_file("sub/b.py")
+            write_file(".hidden/c.py")
+
+            watcher = FileWatcher(base, use_inotify=use_inotify)
+            assert_equals(sorted(watcher.get_files()), ['a.rws', 'sub/b.py'])
+
+            changes = []
+            def on_changed(watcher, batch):
+                changes.append(sorted(batch))
+            watcher.connect('changed', on_changed)
+
+            def expect(expected):
+                # Polling relies on the mtime changing
+                if not use_inotify:
+                    time.sleep(0.01)
+                watcher.check()
+                if expected:
+                    assert_equals(changes, [sorted(expected)])
+                else:
+                    assert_equals(changes, [])
+                del changes[:]
+
+            expect([])
+
+            write_file("d.txt")
+            expect([(FileWatcher.ADDED, 'd.txt')])
+
+            write_file("a.rws", "changed")
+            expect([(FileWatcher.CHANGED, 'a.rws')])
+
+            # A save via a temporary file only shows up as a change
+            write_file("a.rws.tmp", "changed again")
+            os.rename(os.path.join(base, "a.rws.tmp"), os.path.join(base, "a.rws"))
+            expect([(FileWatcher.CHANGED, 'a.rws')])
+
+            write_file("sub/subsub/e.py")
+            expect([(FileWatcher.ADDED, 'sub/subsub/e.py')])
+
+            os.rename(os.path.join(base, "sub"), os.path.join(base, "renamed"))
+            expect([(FileWatcher.REMOVED, 'sub/b.py'),
+                    (FileWatcher.REMOVED, 'sub/subsub/e.py'),
+                    (FileWatcher.ADDED, 'renamed/b.py'),
+                    (FileWatcher.ADDED, 'renamed/subsub/e.py')])
+
+            os.remove(os.path.join(base, "d.txt"))
+            expect([(FileWatcher.REMOVED, 'd.txt')])
+
+            write_file(".hidden/f.py")
+            expect([])
+
+            watcher.close()
+        finally:
+            shutil.rmtree(base)
+
+    test_watcher(use_inotify=False)
+    if _libc is not None:
+        test_watcher(use_inotify=True)
@@ -50,6 +50,10 @@ class GlobalSettings(gobject.GObject):
 
     autocomplete = _bool_property('autocomplete', default=True)
 
+    auto_calculate = _bool_property('auto_calculate', default=False)
+
+    show_timings = _bool_property('show_timings', default=False)
+
     def __init__(self):
         gobject.GObject.__init__(self)
 
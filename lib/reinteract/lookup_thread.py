@@ -0,0 +1,268 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import gobject
+import logging
+import thread
+import traceback
+
+_debug = logging.getLogger("LookupThread").debug
+
+# Default time (in milliseconds) we wait for a lookup before giving up
+# and letting the caller show something else
+DEFAULT_DEADLINE = 150
+
+# Maximum number of threads left behind stuck in cancelled lookups before new
+# lookups wait for one of them to finish rather than starting another thread
+MAX_ABANDONED_THREADS = 2
+
+class _Request(object):
+    def __init__(self, func, callback, timeout_callback):
+        self.func = func
+        self.callback = callback
+        self.timeout_callback = timeout_callback
+
+        self.cancelled = False
+        self.timeout_id = 0
+
+class LookupThread(object):
+
+    """
+    Class to do lookups that may call into user code in a helper thread
+
+    Finding completions or the object under the mouse pointer means calling
+    getattr() and dir() on objects from the user's worksheet, and those
+    can be arbitrarily slow. A LookupThread runs such lookups outside of the
+    main thread, so that the user interface never blocks.
+
+    Only one lookup is active at a time: making a new request cancels the
+    previous request. If a cancelled request is stuck in user code, the
+    new request is run in a fresh thread rather than waiting behind it; the
+    old thread exits once the stuck lookup finishes. At most
+    MAX_ABANDONED_THREADS threads are left behind this way; beyond that, the
+    new request waits to be run by the first of them to finish.
+
+    Callbacks are always called from the main thread.
+
+    """
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+
+        self.__request = None   # The current request
+        self.__pending = None   # Request waiting for the worker to pick it up
+        self.__worker = None    # Token identifying the current worker
+        self.__n_abandoned = 0  # Number of workers stuck in cancelled requests
+
+    def __run_callback(self, request, result):
+        if request.timeout_id:
+            gobject.source_remove(request.timeout_id)
+            request.timeout_id = 0
+
+        if not request.cancelled:
+            if self.__request is request:
+                self.__request = None
+            request.callback(result)
+
+        return False
+
+    def __on_timeout(self, request):
+        request.timeout_id = 0
+        if not request.cancelled:
+            _debug("Lookup timed out")
+            if request.timeout_callback:
+                request.timeout_callback()
+
+        return False
+
+    def __run_thread(self, worker):
+        self.lock.acquire()
+        try:
+            while True:
+                if self.__worker is not worker:
+                    # We were abandoned while running a cancelled request. If
+                    # there is no current worker, a request may be waiting for us
+                    self.__n_abandoned -= 1
+                    if self.__worker is not None:
+                        break
+                    self.__worker = worker
+
+                if self.__pending is None:
+                    break
+
+                request = self.__pending
+                self.__pending = None
+
+                if request.cancelled:
+                    continue
+
+                self.lock.release()
+                try:
+                    try:
+                        result = request.func()
+                    except:
+                        # There's nobody to report the error to; the user will just
+                        # see no result
+                        _debug("Error in lookup:\n%s", traceback.format_exc())
+                    else:
+                        gobject.idle_add(self.__run_callback, request, result)
+                finally:
+                    self.lock.acquire()
+        finally:
+            if self.__worker is worker:
+                self.__worker = None
+            self.lock.release()
+
+    def lookup(self, func, callback, deadline=DEFAULT_DEADLINE, timeout_callback=None):
+        """Run a lookup in the helper thread
+
+        Any previous lookup is cancelled; its callbacks will not be called.
+
+        @param func: function to call in the helper thread; it is called without arguments
+        @param callback: function called in the main thread with the result of func()
+        @param deadline: time in milliseconds to wait for the lookup before calling
+           timeout_callback. The lookup continues after the deadline, and callback will
+           still be called if the lookup finishes before being cancelled.
+        @param timeout_callback: function called without arguments in the main thread
+           if the deadline passes without a result
+
+        """
+
+        self.cancel()
+
+        request = _Request(func, callback, timeout_callback)
+        if deadline is not None:
+            request.timeout_id = gobject.timeout_add(deadline, self.__on_timeout, request)
+
+        self.lock.acquire()
+        try:
+            self.__request = request
+            self.__pending = request
+            if self.__worker is None:
+                # No worker running, or the worker is stuck on a cancelled request
+                # and has been abandoned; start a new one unless there are already
+                # too many threads stuck
+                if self.__n_abandoned < MAX_ABANDONED_THREADS:
+                    self.__worker = object()
+                    thread.start_new_thread(self.__run_thread, (self.__worker,))
+                else:
+                    _debug("Too many lookups stuck, waiting for one to finish")
+        finally:
+            self.lock.release()
+
+    def cancel(self):
+        """Cancel the current lookup, if any. Callbacks for the lookup will not be called."""
+
+        request = self.__request
+        if request is None:
+            return
+
+        self.__request = None
+        request.cancelled = True
+        if request.timeout_id:
+            gobject.source_remove(request.timeout_id)
+            request.timeout_id = 0
+
+        self.lock.acquire()
+        try:
+            if self.__pending is request:
+                self.__pending = None
+            elif self.__worker is not None:
+                # The worker has already started the request, and may be stuck
+                # in it; further requests go to a new worker
+                self.__worker = None
+                self.__n_abandoned += 1
+        finally:
+            self.lock.release()
+
+    def busy(self):
+        """Return True if there is a lookup that hasn't finished yet"""
+
+        return self.__request is not None
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import time
+
+    from test_utils import assert_equals
+
+    gobject.threads_init()
+
+    lookup_thread = LookupThread()
+    loop = gobject.MainLoop()
+    results = []
+
+    def on_result(result):
+        results.append(result)
+        loop.quit()
+
+    def on_timeout():
+        results.append('timeout')
+
+    # Simple lookup
+    lookup_thread.lookup(lambda: 42, on_result)
+    loop.run()
+    assert_equals(results, [42])
+    assert not lookup_thread.busy()
+
+    # A slow lookup superseded by a fast one; the fast one shouldn't have to wait
+    del results[:]
+    def slow():
+        time.sleep(1.0)
+        return 'slow'
+    lookup_thread.lookup(slow, on_result)
+    time.sleep(0.05)
+    start = time.time()
+    lookup_thread.lookup(lambda: 'fast', on_result)
+    loop.run()
+    assert_equals(results, ['fast'])
+    assert time.time() - start < 0.5
+
+    # Deadline passing before the result arrives
+    del results[:]
+    def medium():
+        time.sleep(0.3)
+        return 'medium'
+    lookup_thread.lookup(medium, on_result, deadline=50, timeout_callback=on_timeout)
+    loop.run()
+    assert_equals(results, ['timeout', 'medium'])
+
+    # Cancelling
+    del results[:]
+    lookup_thread.lookup(medium, on_result)
+    lookup_thread.cancel()
+    gobject.timeout_add(500, loop.quit)
+    loop.run()
+    assert_equals(results, [])
+
+    # Only a limited number of threads are left stuck in cancelled lookups;
+    # beyond that, a lookup waits for one of them to finish. (First wait for
+    # the threads stuck in earlier tests to finish)
+    time.sleep(1.0)
+    del results[:]
+    running = [0, 0] # current, maximum
+    def stuck():
+        lookup_thread.lock.acquire()
+        running[0] += 1
+        running[1] = max(running)
+        lookup_thread.lock.release()
+        time.sleep(0.5)
+        lookup_thread.lock.acquire()
+        running[0] -= 1
+        lookup_thread.lock.release()
+        return 'stuck'
+    for i in xrange(MAX_ABANDONED_THREADS + 3):
+        lookup_thread.lookup(stuck, on_result)
+        time.sleep(0.05)
+    start = time.time()
+    lookup_thread.lookup(lambda: 'fast', on_result)
+    loop.run()
+    assert_equals(results, ['fast'])
+    assert_equals(running[1], MAX_ABANDONED_THREADS)
+    assert time.time() - start > 0.2
@@ -10,16 +10,20 @@
 import gobject
 import gtk
 import logging
+import main_loop
 from optparse import OptionParser
 import os
 import stdout_capture
 import sys
 
 gobject.threads_init()
+main_loop.use_gobject()
 stdout_capture.init()
 
 from global_settings import global_settings
 from application import application
+from bytecode_cache import bytecode_cache
+from module_index import module_index
 
 def main():
     if sys.version_info < (2, 5, 0):
@@ -54,6 +58,9 @@ def main():
     if os.path.exists(user_ext_path):
         sys.path[0:0] = [user_ext_path]
 
+    module_index.set_cache_file(os.path.join(global_settings.config_dir, 'module_index.cache'))
+    bytecode_cache.set_cache_dir(os.path.join(global_settings.config_dir, 'bytecode'))
+
     gtk.window_set_default_icon_name("reinteract")
     gobject.set_application_name("Reinteract")
 
@@ -0,0 +1,370 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# The worksheet and notebook model and the code that executes statements
+# need a way to get callbacks run in the main thread. They get it from this
+# module rather than from gobject, so that they can be used without gobject
+# and GTK+ (by reinteract-run, for example.)
+#
+# Callbacks are dispatched by a simple main loop in this module, unless
+# use_gobject() has been called, in which case they go to the GLib main loop.
+#
+
+import os
+import select
+import sys
+import threading
+import time
+
+# The same values as the GLib constants
+IO_IN = 1
+IO_HUP = 16
+
+class _Source(object):
+    def __init__(self, source_id, func, args, interval=None, fd=None, condition=None):
+        self.source_id = source_id
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.fd = fd
+        self.condition = condition
+        if interval is not None:
+            self.ready_time = time.time() + interval / 1000.
+        else:
+            self.ready_time = None
+
+class _MainContext(object):
+    # A minimal main loop that can be used from multiple threads
+
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__sources = []
+        self.__next_source_id = 1
+        self.__wake_pipe = None
+        self.__wake_pipe_pid = None
+        self.__blocking = False
+
+    def __wake(self):
+        # Must be called with the lock held
+        self.__cond.notifyAll()
+        if self.__blocking:
+            try:
+                os.write(self.__wake_pipe[1], "x")
+            except OSError: # Pipe full, select() will wake up anyways
+                pass
+
+    def __add(self, *args, **kwargs):
+        self.__cond.acquire()
+        try:
+            source = _Source(self.__next_source_id, *args, **kwargs)
+            self.__next_source_id += 1
+            self.__sources.append(source)
+            self.__wake()
+            return source.source_id
+        finally:
+            self.__cond.release()
+
+    def idle_add(self, func, *args):
+        return self.__add(func, args)
+
+    def timeout_add(self, interval, func, *args):
+        return self.__add(func, args, interval=interval)
+
+    def io_add_watch(self, fd, condition, func, *args):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        return self.__add(func, args, fd=fd, condition=condition)
+
+    def __ensure_wake_pipe(self):
+        # A pipe we write to to wake up select() when a source is added from another
+        # thread. If we've forked, the pipe is shared with the parent process, so we
+        # need a new one.
+        if self.__wake_pipe is not None and self.__wake_pipe_pid == os.getpid():
+            return
+
+        import fcntl
+        self.__wake_pipe = os.pipe()
+        self.__wake_pipe_pid = os.getpid()
+        for fd in self.__wake_pipe:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def source_remove(self, source_id):
+        self.__cond.acquire()
+        try:
+            for source in self.__sources:
+                if source.source_id == source_id:
+                    self.__sources.remove(source)
+                    return True
+            return False
+        finally:
+            self.__cond.release()
+
+    def wake(self):
+        self.__cond.acquire()
+        try:
+            self.__wake()
+        finally:
+            self.__cond.release()
+
+    def __find_ready(self, now):
+        # Returns (ready sources, timeout until the next source is ready)
+        ready = []
+        timeout = None
+        for source in self.__sources:
+            if source.fd is not None:
+                continue
+            if source.ready_time is None or source.ready_time <= now:
+                ready.append(source)
+            else:
+                remaining = source.ready_time - now
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+
+        return ready, timeout
+
+    def __poll_fds(self, timeout):
+        # Wait for file descriptors, and return [(source, condition)] for the ones that
+        # are ready. Must be called with the lock held; releases it while waiting
+        self.__ensure_wake_pipe()
+        watches = [source for source in self.__sources if source.fd is not None]
+        fds = [source.fd for source in watches] + [self.__wake_pipe[0]]
+
+        self.__blocking = timeout != 0
+        self.__cond.release()
+        try:
+            try:
+                readable, _, errors = select.select(fds, [], fds, timeout)
+            except select.error:
+                readable, errors = [], []
+        finally:
+            self.__cond.acquire()
+            self.__blocking = False
+
+        if self.__wake_pipe[0] in readable:
+            try:
+                os.read(self.__wake_pipe[0], 1024)
+            except OSError:
+                pass
+
+        result = []
+        for source in watches:
+            if source.fd in errors:
+                result.append((source, IO_HUP))
+            elif source.fd in readable and (source.condition & IO_IN) != 0:
+                result.append((source, IO_IN))
+
+        return result
+
+    def iteration(self, may_block=True, should_stop=None):
+        """Dispatch the sources that are ready; if none are and may_block is True,
+        wait until one is, or should_stop() returns True"""
+
+        self.__cond.acquire()
+        try:
+            while True:
+                if should_stop is not None and should_stop():
+                    return False
+
+                now = time.time()
+                ready, timeout = self.__find_ready(now)
+                if not may_block or len(ready) > 0:
+                    timeout = 0
+
+                have_watches = False
+                for source in self.__sources:
+                    if source.fd is not None:
+                        have_watches = True
+                        break
+
+                if have_watches:
+                    ready_watches = self.__poll_fds(timeout)
+                    if len(ready_watches) > 0 or len(ready) > 0 or timeout == 0:
+                        break
+                else:
+                    ready_watches = []
+                    if len(ready) > 0 or timeout == 0:
+                        break
+                    self.__cond.wait(timeout)
+        finally:
+            self.__cond.release()
+
+        for source in ready:
+            self.__dispatch(source, source.args)
+        for source, condition in ready_watches:
+            self.__dispatch(source, (source.fd, condition) + source.args)
+
+        return len(ready) + len(ready_watches) > 0
+
+    def __dispatch(self, source, args):
+        self.__cond.acquire()
+        removed = not source in self.__sources
+        self.__cond.release()
+        if removed:
+            return
+
+        if source.func(*args):
+            if source.interval is not None:
+                source.ready_time = time.time() + source.interval / 1000.
+        else:
+            self.source_remove(source.source_id)
+
+class _MainLoop(object):
+    def __init__(self, context):
+        self.__context = context
+        self.__running = False
+
+    def run(self):
+        self.__running = True
+        while self.__running:
+            self.__context.iteration(True, should_stop=lambda: not self.__running)
+
+    def quit(self):
+        self.__running = False
+        self.__context.wake()
+
+    def is_running(self):
+        return self.__running
+
+class _DefaultBackend(object):
+    def __init__(self):
+        self.context = _MainContext()
+
+    def idle_add(self, func, *args):
+        return self.context.idle_add(func, *args)
+
+    def timeout_add(self, interval, func, *args):
+        return self.context.timeout_add(interval, func, *args)
+
+    def io_add_watch(self, fd, condition, func, *args):
+        return self.context.io_add_watch(fd, condition, func, *args)
+
+    def source_remove(self, source_id):
+        return self.context.source_remove(source_id)
+
+    def new_main_loop(self):
+        return _MainLoop(self.context)
+
+class _GObjectBackend(object):
+    def __init__(self):
+        import gobject
+        self.gobject = gobject
+
+    def idle_add(self, func, *args):
+        return self.gobject.idle_add(func, *args)
+
+    def timeout_add(self, interval, func, *args):
+        return self.gobject.timeout_add(interval, func, *args)
+
+    def io_add_watch(self, fd, condition, func, *args):
+        gobject_condition = 0
+        if condition & IO_IN:
+            gobject_condition |= self.gobject.IO_IN
+        if condition & IO_HUP:
+            gobject_condition |= self.gobject.IO_HUP
+
+        def on_io(source, condition, *args):
+            if condition & self.gobject.IO_HUP:
+                condition = IO_HUP
+            else:
+                condition = IO_IN
+            return func(source, condition, *args)
+
+        return self.gobject.io_add_watch(fd, gobject_condition, on_io, *args)
+
+    def source_remove(self, source_id):
+        return self.gobject.source_remove(source_id)
+
+    def new_main_loop(self):
+        return self.gobject.MainLoop()
+
+_backend = _DefaultBackend()
+
+def use_gobject():
+    """Dispatch callbacks from the GLib main loop
+
+    This must be called by applications that run a GLib main loop (such as any
+    GTK+ application) before creating worksheets or notebooks.
+
+    """
+
+    global _backend
+    if not isinstance(_backend, _GObjectBackend):
+        _backend = _GObjectBackend()
+
+def idle_add(func, *args):
+    """Call func(*args) from the main loop as soon as possible; this can be called
+    from any thread. The function is called repeatedly until it returns False."""
+
+    return _backend.idle_add(func, *args)
+
+def timeout_add(interval, func, *args):
+    """Call func(*args) from the main loop every interval milliseconds, until it
+    returns False"""
+
+    return _backend.timeout_add(interval, func, *args)
+
+def io_add_watch(fd, condition, func, *args):
+    """Call func(fd, condition, *args) when fd is readable (IO_IN) or closed (IO_HUP),
+    until it returns False"""
+
+    return _backend.io_add_watch(fd, condition, func, *args)
+
+def source_remove(source_id):
+    """Remove a callback added with idle_add(), timeout_add(), or io_add_watch()"""
+
+    return _backend.source_remove(source_id)
+
+def MainLoop():
+    """Create a main loop object, with run() and quit() methods"""
+
+    return _backend.new_main_loop()
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import thread
+
+    from test_utils import assert_equals
+
+    # Callbacks added from another thread
+    loop = MainLoop()
+    results = []
+    def add_from_thread():
+        time.sleep(0.05)
+        idle_add(lambda: results.append('idle') or loop.quit())
+    thread.start_new_thread(add_from_thread, ())
+    loop.run()
+    assert_equals(results, ['idle'])
+
+    del results[:]
+    def on_timeout():
+        results.append('timeout')
+        if len(results) == 2:
+            loop.quit()
+        return True
+    source_id = timeout_add(10, on_timeout)
+    loop.run()
+    source_remove(source_id)
+    assert_equals(results, ['timeout', 'timeout'])
+
+    # File descriptor watches
+    if sys.platform != 'win32':
+        del results[:]
+        read_fd, write_fd = os.pipe()
+        def on_readable(fd, condition):
+            results.append((condition, os.read(fd, 100)))
+            loop.quit()
+            return False
+        io_add_watch(read_fd, IO_IN, on_readable)
+        thread.start_new_thread(lambda: (time.sleep(0.05), os.write(write_fd, "a")), ())
+        loop.run()
+        assert_equals(results, [(IO_IN, "a")])
+        os.close(read_fd)
+        os.close(write_fd)
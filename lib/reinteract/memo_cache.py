@@ -0,0 +1,601 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cPickle
+import errno
+import functools
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+import types
+
+from code_swap import get_code_names
+
+_debug = logging.getLogger("MemoCache").debug
+
+def is_internal_name(name):
+    """Check if a name in a statement scope is part of the machinery of executing
+    statements rather than a result of the statements"""
+
+    return name.startswith('__reinteract') or name == '__builtins__'
+
+def list_store_entries(directory, get_key):
+    """List the entries of a store of values kept as files in a directory
+
+    @param directory: the directory of the store
+    @param get_key: function that returns the key of the entry that a file belongs to,
+       given the name of the file
+    @returns: a dictionary mapping each key to a list [last_used, size, filenames], where
+       last_used is the latest modification time of the entry's files and size is their
+       total size; empty if the directory can't be read
+
+    """
+
+    try:
+        filenames = os.listdir(directory)
+    except OSError:
+        return {}
+
+    entries = {}
+    for filename in filenames:
+        try:
+            st = os.stat(os.path.join(directory, filename))
+        except OSError:
+            continue
+        entry = entries.setdefault(get_key(filename), [0, 0, []])
+        entry[0] = max(entry[0], st.st_mtime)
+        entry[1] += st.st_size
+        entry[2].append(filename)
+
+    return entries
+
+def remove_store_entry(directory, filenames):
+    """Remove the files of an entry returned by L{list_store_entries}"""
+
+    for filename in filenames:
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+class _Uncacheable(Exception):
+    pass
+
+# Hashing the globals that a worksheet function reads on each call would make a
+# call of a function that uses a large global array as slow to look up as to make.
+# So we remember the digests of the values of globals by identity. A value in the
+# scope of a statement that has finished executing isn't modified by later
+# statements (see Rewriter), so its digest stays valid. The digests are forgotten
+# when a calculation starts, and not used for the globals of scopes of statements
+# that are still executing.
+_digests_lock = threading.Lock()
+_digests = {}          # id(value) => (value, digest)
+_executing_scopes = {} # id(scope) => count of executions
+
+def forget_digests():
+    """Forget the remembered digests of the values of worksheet globals
+
+    This is called when a worksheet calculation starts, so that the values of the
+    scopes of the previous calculation aren't kept alive.
+
+    """
+
+    _digests_lock.acquire()
+    try:
+        _digests.clear()
+    finally:
+        _digests_lock.release()
+
+def set_scope_executing(scope, executing):
+    """Mark the scope of a statement as being executed, or not any more
+
+    The digests of the values of globals of functions defined in a scope aren't
+    remembered while the scope is being executed, since the statement can still
+    modify them.
+
+    """
+
+    _digests_lock.acquire()
+    try:
+        count = _executing_scopes.get(id(scope), 0) + (executing and 1 or -1)
+        if count > 0:
+            _executing_scopes[id(scope)] = count
+        else:
+            _executing_scopes.pop(id(scope), None)
+    finally:
+        _digests_lock.release()
+
+def _hash_code(h, code, seen):
+    # Hash the parts of a code object that determine what it does; unlike
+    # marshal.dumps(code) this leaves out the line numbers, so that editing
+    # an earlier part of a worksheet doesn't change the hash
+    h.update("code\0%d\0%d\0%s\0" % (code.co_argcount, code.co_flags, code.co_code))
+    for names in (code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars):
+        h.update("\0".join(names))
+        h.update("\1")
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(h, const, seen)
+        else:
+            _hash_value(h, const, seen)
+
+def _is_importable(cls):
+    # Check if a class can be found by name in its module, as pickle requires;
+    # classes defined in a worksheet can't
+    module = sys.modules.get(cls.__module__)
+    return module is not None and getattr(module, cls.__name__, None) is cls
+
+def _hash_value(h, value, seen):
+    # Add the contents of a value to the hash h. Raises _Uncacheable for values
+    # that we can't hash by contents. seen maps the ids of the functions and classes
+    # already hashed to the order they were hashed in, so recursive references
+    # between them are hashed as references
+    t = type(value)
+    if value is None or t in (bool, int, long, float, complex):
+        h.update("%s\0%r\0" % (t.__name__, value))
+    elif t is str:
+        h.update("str\0%d\0" % len(value))
+        h.update(value)
+    elif t is unicode:
+        encoded = value.encode("utf8")
+        h.update("unicode\0%d\0" % len(encoded))
+        h.update(encoded)
+    elif t in (tuple, list):
+        h.update("%s\0%d\0" % (t.__name__, len(value)))
+        for item in value:
+            _hash_value(h, item, seen)
+    elif t in (set, frozenset):
+        _hash_value(h, t.__name__, seen)
+        _hash_value(h, sorted(_value_key(item, seen) for item in value), seen)
+    elif t is dict:
+        h.update("dict\0%d\0" % len(value))
+        for key, item in sorted((_value_key(k, seen), v) for k, v in value.iteritems()):
+            h.update(key)
+            _hash_value(h, item, seen)
+    elif t is types.FunctionType or (t in (type, types.ClassType) and not _is_importable(value)):
+        if id(value) in seen:
+            h.update("seen\0%d\0" % seen[id(value)])
+        else:
+            seen[id(value)] = len(seen)
+            if t is types.FunctionType:
+                _hash_function(h, value, seen)
+            else:
+                _hash_class(h, value, seen)
+    elif t is types.ModuleType:
+        # Modules are hashed by name, and for modules loaded from a file, the
+        # modification time of the file, so a change to a notebook module is noticed
+        filename = getattr(value, '__file__', None)
+        if filename is not None:
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                mtime = None
+        else:
+            mtime = None
+        h.update("module\0%s\0%s\0%r\0" % (value.__name__, filename, mtime))
+    else:
+        numpy = sys.modules.get('numpy')
+        if numpy is not None and isinstance(value, numpy.ndarray) and not value.dtype.hasobject:
+            h.update("ndarray\0%s\0%r\0" % (value.dtype.str, value.shape))
+            if not value.flags.c_contiguous:
+                value = numpy.ascontiguousarray(value)
+            # Hash the array's memory directly, without copying it to a string
+            h.update(buffer(value))
+        else:
+            # Anything else is hashed by its pickle; objects are usually pickled
+            # as their class and their __dict__. (Protocol 2 would "successfully"
+            # pickle objects like files that have no state visible to pickle.)
+            try:
+                pickled = cPickle.dumps(value, 1)
+            except Exception, e:
+                raise _Uncacheable("Can't hash %s: %s" % (t.__name__, e))
+            h.update("pickle\0%d\0" % len(pickled))
+            h.update(pickled)
+
+def hash_contents(h, value):
+    """Add the contents of a value to a hash, as for the arguments of a @cached function
+
+    @param h: a hash object from the hashlib module
+    @param value: the value to hash
+    @raises ValueError: if the value can't be hashed by its contents
+
+    """
+
+    try:
+        _hash_value(h, value, {})
+    except _Uncacheable, e:
+        raise ValueError(str(e))
+    except Exception, e:
+        # Hashing can call into user code, like __reduce__() methods
+        raise ValueError("Can't hash %s: %s: %s" % (type(value).__name__, type(e).__name__, e))
+
+def _value_key(value, seen):
+    h = hashlib.sha1()
+    _hash_value(h, value, seen)
+    return h.digest()
+
+def _hash_function(h, function, seen):
+    cached_function = getattr(function, '_cached_function', None)
+    if cached_function is not None:
+        # A function wrapped by MemoCache.cached() returns what the function it wraps does
+        h.update("cached\0")
+        _hash_value(h, cached_function, seen)
+        return
+
+    h.update("function\0%s\0%s\0" % (function.__module__, function.__name__))
+    _hash_code(h, function.func_code, seen)
+    _hash_value(h, function.func_defaults, seen)
+    if function.func_closure is not None:
+        for cell in function.func_closure:
+            _hash_value(h, cell.cell_contents, seen)
+
+    # A function defined in a worksheet (which has no __name__ global) also depends
+    # on the values of the worksheet's global names that it reads; these can change
+    # without the function being defined again
+    globals_ = function.func_globals
+    if globals_.get('__name__') is None:
+        _digests_lock.acquire()
+        try:
+            use_digests = not id(globals_) in _executing_scopes
+        finally:
+            _digests_lock.release()
+
+        for name in sorted(get_code_names(function.func_code)):
+            if name in globals_ and not is_internal_name(name):
+                h.update("global\0%s\0" % name)
+                if use_digests:
+                    _hash_global(h, globals_[name], seen)
+                else:
+                    _hash_value(h, globals_[name], seen)
+
+def _hash_global(h, value, seen):
+    # Hash the value of a global read by a worksheet function, using the
+    # remembered digest of the value if there is one
+    t = type(value)
+    if value is None or t in (bool, int, long, float, complex, types.ModuleType,
+                              types.FunctionType, types.ClassType, type):
+        # Cheap, or hashed differently depending on what was hashed before
+        _hash_value(h, value, seen)
+        return
+
+    _digests_lock.acquire()
+    try:
+        entry = _digests.get(id(value))
+    finally:
+        _digests_lock.release()
+
+    if entry is not None and entry[0] is value:
+        digest = entry[1]
+    else:
+        digest = _value_key(value, {})
+        _digests_lock.acquire()
+        try:
+            _digests[id(value)] = (value, digest)
+        finally:
+            _digests_lock.release()
+
+    h.update("digest\0")
+    h.update(digest)
+
+def _hash_class(h, cls, seen):
+    # Classes that can't be pickled by name are hashed by their contents
+    h.update("class\0%s\0" % cls.__name__)
+    _hash_value(h, cls.__bases__, seen)
+    for name, value in sorted(cls.__dict__.iteritems()):
+        if name in ('__dict__', '__weakref__'):
+            continue
+        if type(value) in (staticmethod, classmethod):
+            # There's no public way to get at the function in Python 2.5, but
+            # we can fetch it through a dummy class
+            value = value.__get__(None, object)
+            if type(value) is types.MethodType:
+                value = value.im_func
+        elif type(value) is property:
+            value = (value.fget, value.fset, value.fdel)
+        h.update("%s\0" % name)
+        _hash_value(h, value, seen)
+
+class MemoCache(object):
+
+    """
+    Persistent store of the return values of functions, for the @cached decorator
+    available in worksheets.
+
+    A function decorated with @cached is only called once for each set of
+    arguments; the return value is pickled and saved in a hidden directory in
+    the notebook folder, and when the function is called again with the same
+    arguments - even after the notebook is reopened - the saved value is
+    returned instead. This is meant for expensive, pure functions: ones whose
+    return values depend only on their arguments.
+
+    Return values are keyed by a hash of the function's code (which doesn't
+    change when unrelated parts of the worksheet are edited), of the values of
+    the worksheet's global names that the function reads (and in turn, those
+    read by worksheet functions and classes among them), and of the contents
+    of its arguments. Numpy arrays are hashed by their memory directly, and
+    other values not of builtin types by their pickle. Calls with arguments
+    that can't be hashed, and return values that can't be pickled, aren't cached.
+
+    When the total size of the store exceeds max_size, the least recently used
+    values are removed.
+    """
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        """
+        @param directory: directory to store values in
+        @param max_size: maximum total size of the store, in bytes
+
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(function, args, kwargs):
+        """Compute the key for a call of a function
+
+        @raises ValueError: if the function or arguments can't be hashed
+
+        """
+
+        h = hashlib.sha1()
+        hash_contents(h, function)
+        hash_contents(h, args)
+        hash_contents(h, kwargs)
+
+        return h.hexdigest()
+
+    def __get_filename(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def lookup(self, key):
+        """Look up a stored value
+
+        @returns: a tuple of (True, value) if a value is stored for key, otherwise
+           (False, None)
+
+        """
+
+        filename = self.__get_filename(key)
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return False, None
+
+        try:
+            try:
+                value = cPickle.load(f)
+            except Exception, e:
+                _debug("Can't load value %s: %s", key, e)
+                return False, None
+        finally:
+            f.close()
+
+        now = time.time()
+        try:
+            os.utime(filename, (now, now))
+        except OSError:
+            pass
+
+        return True, value
+
+    def store(self, key, value):
+        """Store a value
+
+        @returns: True if the value was stored
+
+        """
+
+        try:
+            pickled = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            _debug("Can't pickle value %s: %s", key, e)
+            return False
+
+        filename = self.__get_filename(key)
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            f = open(tmpname, "wb")
+            try:
+                f.write(pickled)
+            finally:
+                f.close()
+            if os.path.exists(filename):
+                os.unlink(filename)
+            os.rename(tmpname, filename)
+        except (OSError, IOError), e:
+            _debug("Can't save value %s: %s", key, e)
+            return False
+
+        self.__evict(keep=key)
+
+        return True
+
+    def cached(self, function):
+        """Decorator that makes calls to function return stored values (see L{MemoCache})"""
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                key = self.make_key(function, args, kwargs)
+            except ValueError, e:
+                _debug("Not caching call to %s: %s", function.__name__, e)
+                return function(*args, **kwargs)
+
+            found, value = self.lookup(key)
+            if found:
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            value = function(*args, **kwargs)
+            self.store(key, value)
+
+            return value
+
+        wrapper._cached_function = function
+
+        return wrapper
+
+    def __evict(self, keep=None):
+        # Remove the least recently used values until the store is smaller than max_size;
+        # the time a value was last used is the modification time of its file
+        entries = list_store_entries(self.directory, lambda filename: filename.split('.')[0])
+        total = sum(size for _, size, _ in entries.itervalues())
+
+        for key in sorted(entries.iterkeys(), key=lambda k: entries[k][0]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            _debug("Removing cached value %s", key)
+            remove_store_entry(self.directory, entries[key][2])
+            total -= entries[key][1]
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "memo_cache")
+    try:
+        cache = MemoCache(os.path.join(base, ".cache"))
+
+        calls = []
+        def f(x, y=1):
+            calls.append(x)
+            return [x, y]
+
+        cached_f = cache.cached(f)
+        assert_equals(cached_f.__name__, "f")
+        assert_equals(cached_f(1), [1, 1])
+        assert_equals(cached_f(1), [1, 1])
+        assert_equals(cached_f(1, y=2), [1, 2])
+        assert_equals(cached_f((1, u"a", {'b': None})), [(1, u"a", {'b': None}), 1])
+        assert_equals(cached_f((1, u"a", {'b': None})), [(1, u"a", {'b': None}), 1])
+        assert_equals(calls, [1, 1, (1, u"a", {'b': None})])
+        assert_equals((cache.hits, cache.misses), (2, 3))
+
+        # Values are shared between different MemoCache objects for the same
+        # directory, and a function with the same code defined again
+        def f(x, y=1):
+            calls.append(x)
+            return [x, y]
+        cache = MemoCache(os.path.join(base, ".cache"))
+        assert_equals(cache.cached(f)(1), [1, 1])
+        assert_equals(len(calls), 3)
+
+        # But not if the code or defaults are different
+        def f(x, y=1):
+            calls.append(x)
+            return [y, x]
+        assert_equals(cache.cached(f)(1), [1, 1])
+        def g(x, y=1):
+            calls.append(x)
+            return [x, y]
+        assert_equals(cache.cached(g)(1), [1, 1])
+        assert_equals(len(calls), 5)
+
+        # The line number of the function doesn't matter
+        code1 = compile("def h(x):\n    return x + 1\n", "<statement>", "exec")
+        code2 = compile("\n\n\ndef h(x):\n    return x + 1\n", "<statement>", "exec")
+        scope1 = {}
+        scope2 = {}
+        exec code1 in scope1
+        exec code2 in scope2
+        assert_equals(MemoCache.make_key(scope1['h'], (1,), {}), MemoCache.make_key(scope2['h'], (1,), {}))
+        assert MemoCache.make_key(scope1['h'], (1,), {}) != MemoCache.make_key(scope1['h'], (2,), {})
+
+        # But the values of the worksheet globals that the function reads do,
+        # including through other functions; recursion is fine
+        code = compile("def h(x):\n    return g(x) + h(x - 1) if x else 0\ndef g(x):\n    return x + k\n",
+                       "<statement>", "exec")
+        def h_key(k):
+            scope = { 'k': k }
+            exec code in scope
+            return MemoCache.make_key(scope['h'], (1,), {})
+        assert_equals(h_key(1), h_key(1))
+        assert h_key(1) != h_key(2)
+
+        # The digests of the values of globals are remembered until forget_digests()
+        # is called, except while the scope is being executed
+        scope = { 'k': [1] }
+        exec compile("def g(x):\n    return x + k[0]\n", "<statement>", "exec") in scope
+        key = MemoCache.make_key(scope['g'], (1,), {})
+        scope['k'][0] = 2
+        assert_equals(MemoCache.make_key(scope['g'], (1,), {}), key)
+        forget_digests()
+        assert MemoCache.make_key(scope['g'], (1,), {}) != key
+        set_scope_executing(scope, True)
+        key = MemoCache.make_key(scope['g'], (1,), {})
+        scope['k'][0] = 3
+        assert MemoCache.make_key(scope['g'], (1,), {}) != key
+        set_scope_executing(scope, False)
+        forget_digests()
+
+        # Calls with arguments that can't be hashed call the function each time
+        cached_f = cache.cached(f)
+        cached_f(open(__file__))
+        cached_f(open(__file__))
+        assert_equals(len(calls), 7)
+        class BadReduce(object):
+            def __reduce__(self):
+                raise RuntimeError("can't reduce")
+        cached_f(BadReduce())
+        assert_equals(len(calls), 8)
+
+        # Static and class methods of classes that can't be pickled by name are
+        # hashed by their functions
+        code = compile("class A(object):\n    @staticmethod\n    def s():\n        return 1\n"
+                       "    @classmethod\n    def c(cls):\n        return 2\n", "<statement>", "exec")
+        scope = {}
+        exec code in scope
+        assert MemoCache.make_key(f, (scope['A'],), {}) is not None
+
+        # Numpy arrays are hashed by contents
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            a = numpy.arange(12.).reshape(3, 4)
+            assert_equals(MemoCache.make_key(f, (a,), {}), MemoCache.make_key(f, (a.copy(),), {}))
+            assert MemoCache.make_key(f, (a,), {}) != MemoCache.make_key(f, (a.T,), {})
+            assert MemoCache.make_key(f, (a,), {}) != MemoCache.make_key(f, (a + 1,), {})
+            assert_equals(MemoCache.make_key(f, (a[:, 1],), {}), MemoCache.make_key(f, (a[:, 1].copy(),), {}))
+
+        # Least recently used values are removed beyond max_size
+        shutil.rmtree(os.path.join(base, ".cache"))
+        cache = MemoCache(os.path.join(base, ".cache"), max_size=2500)
+        cached_f = cache.cached(f)
+        for i in xrange(3):
+            cached_f("x" * 1000 + str(i))
+            # Make sure that the modification times are distinct
+            for filename in os.listdir(cache.directory):
+                path = os.path.join(cache.directory, filename)
+                os.utime(path, (os.stat(path).st_mtime - 10, os.stat(path).st_mtime - 10))
+        assert_equals(len(os.listdir(cache.directory)), 2)
+        del calls[:]
+        cached_f("x" * 1000 + "2")
+        cached_f("x" * 1000 + "0")
+        assert_equals(len(calls), 1)
+    finally:
+        shutil.rmtree(base)
@@ -32,6 +32,7 @@ class MiniWindow(BaseNotebookWindow):
          <menuitem action="save"/>
          <menuitem action="rename"/>
          <menuitem action="print"/>
+         <menuitem action="export-timings"/>
          <menuitem action="close"/>
       </menu>
       <menu action="edit">
@@ -42,6 +43,7 @@ class MiniWindow(BaseNotebookWindow):
          <menuitem action="delete"/>
          <separator/>
          <menuitem action="calculate"/>
+         <menuitem action="calculate-to-cursor"/>
          <menuitem action="break"/>
          <separator/>
          <menuitem action="calculate-all"/>
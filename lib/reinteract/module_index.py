@@ -0,0 +1,381 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cPickle
+import logging
+import os
+import pkgutil
+import thread
+import time
+import zipimport
+
+from completion_index import CompletionIndex
+
+_debug = logging.getLogger("ModuleIndex").debug
+
+# Bump this when changing the format of what we store in the cache file
+_CACHE_VERSION = 1
+
+def _get_mtime(path):
+    # Get the modification time for a directory we are going to list. For
+    # a directory inside a zip file we use the modification time of the zip file
+    while path:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    return None
+
+def _list_modules(dirname):
+    # List the modules in a directory (or a directory within a zip file) as a
+    # list of (name, is_package). We create the importer directly rather than
+    # using pkgutil.iter_modules() to avoid filling sys.path_importer_cache with
+    # entries for every directory we look at.
+    if os.path.isdir(dirname):
+        importer = pkgutil.ImpImporter(dirname)
+    else:
+        try:
+            importer = zipimport.zipimporter(dirname)
+        except zipimport.ZipImportError:
+            return []
+
+    try:
+        return [(name, is_package) for name, is_package in pkgutil.iter_importer_modules(importer)]
+    except (OSError, IOError):
+        return []
+
+class ModuleIndex(object):
+
+    """
+    Index of the modules that can be imported from a path, used for completion
+    within import statements.
+
+    Building the index means listing every directory on sys.path, and every
+    package within those directories, so it is done in a background thread.
+    Until the index is built, lookups return what has been found so far. The
+    listing of each directory is saved to disk along with the directory's
+    modification time, so on the next run we only need to list directories
+    that have changed.
+
+    Nothing is imported to build the index.
+    """
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+
+        # Map from directory => (mtime, [(name, is_package), ...])
+        self.__dirs = {}
+        # Directories that are at the root of a path and have been scanned
+        self.__scanned_roots = set()
+        # Path entries waiting to be scanned
+        self.__queued_roots = []
+        self.__scanning = False
+
+        self.__cache_file = None
+        self.__dirty = False
+
+        # Cache of CompletionIndex for a list of directories
+        self.__completion_indexes = {}
+
+    def set_cache_file(self, filename):
+        """Set the file used to save the index between sessions, and load it if it exists"""
+
+        self.__cache_file = filename
+
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return
+
+        try:
+            try:
+                version, dirs = cPickle.load(f)
+            except Exception, e:
+                _debug("Can't load module index from %s: %s", filename, e)
+                return
+        finally:
+            f.close()
+
+        if version != _CACHE_VERSION:
+            return
+
+        self.lock.acquire()
+        try:
+            for dirname, entry in dirs.iteritems():
+                if not dirname in self.__dirs:
+                    self.__dirs[dirname] = entry
+            self.__completion_indexes = {}
+        finally:
+            self.lock.release()
+
+    def __save(self):
+        if self.__cache_file is None:
+            return
+
+        self.lock.acquire()
+        try:
+            dirs = dict(self.__dirs)
+            self.__dirty = False
+        finally:
+            self.lock.release()
+
+        # Write to a temporary file and rename, so that another Reinteract process
+        # never sees a partial file
+        tmpname = self.__cache_file + ".tmp"
+        try:
+            f = open(tmpname, "wb")
+            try:
+                cPickle.dump((_CACHE_VERSION, dirs), f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.path.exists(self.__cache_file):
+                os.unlink(self.__cache_file)
+            os.rename(tmpname, self.__cache_file)
+        except (OSError, IOError), e:
+            _debug("Can't save module index to %s: %s", self.__cache_file, e)
+
+    def __scan_dir(self, dirname, parents):
+        # parents is the set of the real paths of the directories we are scanning
+        # dirname within; a symlink to one of those would make us recurse forever
+        realpath = os.path.realpath(dirname)
+        if realpath in parents:
+            return
+
+        mtime = _get_mtime(dirname)
+        if mtime is None:
+            return
+
+        self.lock.acquire()
+        old = self.__dirs.get(dirname)
+        self.lock.release()
+
+        if old is not None and old[0] == mtime:
+            entries = old[1]
+        else:
+            _debug("Listing modules in %s", dirname)
+            entries = _list_modules(dirname)
+            self.lock.acquire()
+            self.__dirs[dirname] = (mtime, entries)
+            self.__completion_indexes = {}
+            self.__dirty = True
+            self.lock.release()
+
+        parents.add(realpath)
+        try:
+            for name, is_package in entries:
+                if is_package:
+                    self.__scan_dir(os.path.join(dirname, name), parents)
+        finally:
+            parents.remove(realpath)
+
+    def __run_thread(self):
+        while True:
+            self.lock.acquire()
+            if len(self.__queued_roots) == 0:
+                self.__scanning = False
+                dirty = self.__dirty
+                self.lock.release()
+                break
+            root = self.__queued_roots.pop(0)
+            self.lock.release()
+
+            try:
+                self.__scan_dir(root, set())
+            except Exception, e:
+                _debug("Error scanning %s: %s", root, e)
+
+        if dirty:
+            self.__save()
+
+    def update(self, path):
+        """Start scanning the directories in path (and packages within them) in the background
+
+        Directories that have already been scanned are skipped; use invalidate() to force
+        a directory to be scanned again.
+
+        """
+
+        self.lock.acquire()
+        try:
+            for root in path:
+                # '' means the current directory, which has no meaning for us
+                if root == '' or root in self.__scanned_roots:
+                    continue
+                self.__scanned_roots.add(root)
+                self.__queued_roots.append(root)
+
+            if len(self.__queued_roots) > 0 and not self.__scanning:
+                self.__scanning = True
+                thread.start_new_thread(self.__run_thread, ())
+        finally:
+            self.lock.release()
+
+    def invalidate(self, path):
+        """Mark the directories in path as needing to be scanned again"""
+
+        self.lock.acquire()
+        try:
+            for root in path:
+                self.__scanned_roots.discard(root)
+        finally:
+            self.lock.release()
+
+    def wait(self):
+        """Block until any background scanning is complete. (Mostly useful for testing.)"""
+
+        while True:
+            self.lock.acquire()
+            scanning = self.__scanning
+            self.lock.release()
+            if not scanning:
+                break
+            time.sleep(0.01)
+
+    def __get_completion_index(self, dirs):
+        key = tuple(dirs)
+        self.lock.acquire()
+        try:
+            try:
+                return self.__completion_indexes[key]
+            except KeyError:
+                pass
+
+            names = []
+            for dirname in dirs:
+                entry = self.__dirs.get(dirname)
+                if entry is not None:
+                    names.extend((name for name, _ in entry[1]))
+
+            index = CompletionIndex(names)
+            self.__completion_indexes[key] = index
+
+            return index
+        finally:
+            self.lock.release()
+
+    def find_modules(self, path, package_names, prefix):
+        """Find modules that can be imported
+
+        If the index hasn't been built yet for the directories in path, this
+        starts building it, and returns whatever is known so far.
+
+        @param path: list of directories to look for modules in (like sys.path)
+        @param package_names: list of the components of the name of a package to look for
+            modules within, or [] to look for toplevel modules
+        @param prefix: only return modules whose names start with prefix
+        @returns: list of module names, in the order they should be presented to the user
+
+        """
+
+        self.update(path)
+
+        dirs = [root for root in path if root != '']
+        for name in package_names:
+            # Like Python, we use the first package in the path with the name
+            package_dir = None
+            self.lock.acquire()
+            try:
+                for dirname in dirs:
+                    entry = self.__dirs.get(dirname)
+                    if entry is not None and (name, True) in entry[1]:
+                        package_dir = os.path.join(dirname, name)
+                        break
+            finally:
+                self.lock.release()
+
+            if package_dir is None:
+                return []
+
+            dirs = [package_dir]
+
+        return self.__get_completion_index(dirs).find(prefix)
+
+# The global singleton
+module_index = ModuleIndex()
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+    import zipfile
+
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "module_index")
+    try:
+        def write_file(name, contents=""):
+            absname = os.path.join(base, name)
+            dirname = os.path.dirname(absname)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            f = open(absname, "w")
+            f.write(contents)
+            f.close()
+
+        write_file("path1/mod1.py")
+        write_file("path1/package1/__init__.py")
+        write_file("path1/package1/mod2.py")
+        write_file("path1/package1/subpackage/__init__.py")
+        write_file("path1/package1/subpackage/mod3.py")
+        write_file("path1/_private.py")
+        write_file("path2/mod4.py")
+        write_file("path2/package1/__init__.py")
+        write_file("path2/package1/shadowed.py")
+
+        zip = zipfile.ZipFile(os.path.join(base, "zipped.zip"), "w")
+        zip.writestr("zipmod.py", "")
+        zip.writestr("zippackage/__init__.py", "")
+        zip.writestr("zippackage/mod5.py", "")
+        zip.close()
+
+        path = [os.path.join(base, "path1"), os.path.join(base, "path2"), os.path.join(base, "zipped.zip"), '']
+        cache_file = os.path.join(base, "module_index.cache")
+
+        index = ModuleIndex()
+        index.set_cache_file(cache_file)
+        index.update(path)
+        index.wait()
+
+        assert_equals(index.find_modules(path, [], ''), ['mod1', 'mod4', 'package1', 'zipmod', 'zippackage', '_private'])
+        assert_equals(index.find_modules(path, [], 'mod'), ['mod1', 'mod4'])
+        assert_equals(index.find_modules(path, ['package1'], ''), ['mod2', 'subpackage'])
+        assert_equals(index.find_modules(path, ['package1', 'subpackage'], 'm'), ['mod3'])
+        assert_equals(index.find_modules(path, ['zippackage'], ''), ['mod5'])
+        assert_equals(index.find_modules(path, ['mod1'], ''), [])
+        assert_equals(index.find_modules(path, ['nonexistent'], ''), [])
+
+        # The cache is written out and is usable before scanning
+        assert os.path.exists(cache_file)
+        index = ModuleIndex()
+        index.set_cache_file(cache_file)
+        assert_equals(index.find_modules([], [], ''), [])
+        assert_equals(index.find_modules(path, ['package1'], ''), ['mod2', 'subpackage'])
+        index.wait()
+
+        # Changes are picked up after invalidating
+        time.sleep(1.01) # Make sure the mtime changes
+        write_file("path1/package1/mod6.py")
+        index.invalidate(path)
+        index.update(path)
+        index.wait()
+        assert_equals(index.find_modules(path, ['package1'], ''), ['mod2', 'mod6', 'subpackage'])
+
+        # A symlink to a containing package doesn't make scanning recurse forever
+        if hasattr(os, 'symlink'):
+            os.symlink(os.path.join(base, "path1/package1"), os.path.join(base, "path1/package1/subpackage/loop"))
+            index.invalidate(path)
+            index.update(path)
+            index.wait()
+            assert_equals(index.find_modules(path, ['package1', 'subpackage'], ''), ['loop', 'mod3'])
+    finally:
+        shutil.rmtree(base)
@@ -8,13 +8,24 @@
 ########################################################################
 
 import copy
-import gobject
 import imp
+import logging
 import os
 import pkgutil
 import sys
-
+import time
+
+import code_swap
+from bytecode_cache import bytecode_cache
+from checkpoint_store import CheckpointStore
+from file_watcher import FileWatcher
+from memo_cache import MemoCache
+from module_index import module_index
 from notebook_info import NotebookInfo
+from signals import Property, SignalObject
+from statement_cache import StatementCache
+
+_debug = logging.getLogger("Notebook").debug
 
 # Used to give each notebook a unique namespace
 _counter = 1
@@ -32,6 +43,10 @@ def reinteract_import(name, globals=None, locals=None, fromlist=None, level=-1):
 
 __builtin__.__import__ = reinteract_import
 
+def _no_cache(function):
+    # @cached in worksheets that aren't part of a notebook folder
+    return function
+
 class HelpResult:
     def __init__(self, arg):
         self.arg = arg
@@ -50,17 +65,19 @@ class _Helper:
 
 ######################################################################
 
-class NotebookFile(gobject.GObject):
+class NotebookFile(SignalObject):
     NONE = 0
     NEEDS_EXECUTE = 1
     EXECUTING = 2
     EXECUTE_SUCCESS = 3
     ERROR = 4
+    # Waiting for other worksheets to finish calculating; see ExecutionScheduler
+    QUEUED = 5
 
-    active = gobject.property(type=bool, default=False)
-    modified = gobject.property(type=bool, default=False)
-    state = gobject.property(type=int, default=NONE)
-    worksheet = gobject.property(type=gobject.TYPE_PYOBJECT)
+    active = Property(type=bool, default=False)
+    modified = Property(type=bool, default=False)
+    state = Property(type=int, default=NONE)
+    worksheet = Property(type=object)
 
     # Having this here in the core code is completely random, however it doesn't actually
     # require importing GTK+, it's just returning a string.
@@ -78,9 +95,11 @@ class NotebookFile(gobject.GObject):
             return 'gtk-apply'
         elif state == NotebookFile.ERROR:
             return 'gtk-dialog-error'
+        elif state == NotebookFile.QUEUED:
+            return 'gtk-media-pause'
 
     def __init__(self, path):
-        gobject.GObject.__init__(self)
+        SignalObject.__init__(self)
         self.path = path
 
 class WorksheetFile(NotebookFile):
@@ -94,13 +113,17 @@ class MiscFile(NotebookFile):
 
 ######################################################################
 
-class Notebook(gobject.GObject):
-    __gsignals__ = {
-        'files-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+class Notebook(SignalObject):
+    __signals__ = {
+        # Emitted after a batch of the fine-grained signals below
+        'files-changed': (),
+        'file-added': (NotebookFile,),
+        'file-removed': (NotebookFile,),
+        'file-changed': (NotebookFile,)
     }
 
     def __init__(self, folder=None):
-        gobject.GObject.__init__(self)
+        SignalObject.__init__(self)
 
         global _counter
 
@@ -117,6 +140,23 @@ class Notebook(gobject.GObject):
 
         self.__path = path
         self.__modules = {}
+        # Map from the name of a local module to the set of names of local
+        # modules that import it
+        self.__importers = {}
+        # Cache of path entry => PEP 302 importer for that entry
+        self.__path_importers = {}
+        # Names that we've failed to find a module for, as (parent_name, fullname);
+        # parent_name is None for toplevel modules
+        self.__not_found = set()
+        # Names of toplevel modules that aren't in the notebook's path
+        self.__not_local = set()
+        self.__import_stats = {
+            'find_calls': 0,
+            'find_time': 0.,
+            'importer_hits': 0,
+            'importer_misses': 0,
+            'negative_hits': 0,
+        }
 
         self.__root_module = imp.new_module(self.__prefix)
         self.__root_module.path = path
@@ -125,99 +165,271 @@ class Notebook(gobject.GObject):
         self.files = {}
         self.worksheets = set()
 
+        self.__checkpoint_store = None
+        self.__memo_cache = None
+        self.__statement_cache = None
+
         if folder:
             self.info = NotebookInfo(folder)
+            self.__watcher = FileWatcher(folder)
+            self.__watcher.connect('changed', self.__on_watcher_changed)
+            for relative in self.__watcher.get_files():
+                file = self.__create_file(relative)
+                if file is not None:
+                    self.files[relative] = file
         else:
             self.info = None
-
-        self.refresh()
+            self.__watcher = None
 
     ############################################################
     # Loading and Saving
     ############################################################
 
-    def __load_files(self, folder, old_files, new_files):
-        if folder:
-            full_folder = os.path.join(self.folder, folder)
+    def __create_file(self, relative):
+        # Create the right type of NotebookFile for a path, or return None
+        # if the path shouldn't be shown as part of the notebook. Files starting
+        # with '.' are already skipped by the FileWatcher: we handle them as
+        # hidden on all platforms, valuing notebook portability over exact
+        # correspondance with local convention.
+        if relative == "index.rnb" or relative.endswith('~'):
+            return None
+
+        lower = relative.lower()
+        if lower.endswith('.rws'):
+            file = WorksheetFile(relative)
+            absolute = os.path.join(self.folder, relative)
+            for worksheet in self.worksheets:
+                if worksheet.filename and os.path.abspath(worksheet.filename) == absolute:
+                    file.worksheet = worksheet
+                    break
+        elif lower.endswith('.py'):
+            file = LibraryFile(relative)
+        elif lower.endswith('.pyc') or lower.endswith('.pyo'):
+            return None
         else:
-            full_folder = self.folder
+            file = MiscFile(relative)
+
+        return file
+
+    def __on_watcher_changed(self, watcher, changes):
+        # Any change to the folder could make a failed import succeed, or
+        # change the contents of a zip file we have an importer for
+        self.__clear_import_caches()
+
+        files_changed = False
+        for kind, relative in changes:
+            if kind == FileWatcher.ADDED:
+                file = self.__create_file(relative)
+                if file is not None:
+                    self.files[relative] = file
+                    self.emit('file-added', file)
+                    files_changed = True
+            elif kind == FileWatcher.REMOVED:
+                file = self.files.pop(relative, None)
+                if file is not None:
+                    self.emit('file-removed', file)
+                    files_changed = True
+            else:
+                file = self.files.get(relative)
+                if file is not None:
+                    self.emit('file-changed', file)
 
-        files_added = False
+        if files_changed:
+            self.emit('files-changed')
 
-        for f in os.listdir(full_folder):
-            if folder is None and f == "index.rnb":
-                continue
+    ############################################################
+    # Import handling
+    ############################################################
 
-            # We handle filenames starting with . as hidden on all platforms,
-            # valuing notebook portability over exact correspondance with
-            # local convention.
-            if f.startswith('.'):
-                continue
+    def __clear_import_caches(self):
+        self.__path_importers.clear()
+        self.__not_found.clear()
+        self.__not_local.clear()
 
-            if folder:
-                relative = os.path.join(folder, f)
-            else:
-                relative = f
+    def __reset_modules(self, names):
+        for name in names:
+            if name in self.__modules:
+                del sys.modules[self.__prefix + "." + name]
+                del self.__modules[name]
 
-            full_path = os.path.join(full_folder, f)
+        # Imports made by the reset modules are recorded again when they are
+        # reloaded, and anything that imported them was also reset
+        for name in names:
+            self.__importers.pop(name, None)
+        for importers in self.__importers.itervalues():
+            importers.difference_update(names)
 
-            if os.path.isdir(full_path):
-                files_added = self.__load_files(relative, old_files, new_files) or files_added
-            elif relative in old_files:
-                new_files[relative] = old_files[relative]
-                del old_files[relative]
-            elif f.endswith('~'):
-                pass
-            else:
-                lower = f.lower()
-                if lower.endswith('.rws'):
-                    file = WorksheetFile(relative)
-                    absolute = os.path.join(full_folder, f)
-                    for worksheet in self.worksheets:
-                        if worksheet.filename and os.path.abspath(worksheet.filename) == absolute:
-                            file.worksheet = worksheet
-                            break
-                elif lower.endswith('.py'):
-                    file = LibraryFile(relative)
-                elif lower.endswith('.pyc') or lower.endswith('.pyo'):
-                    continue
-                else:
-                    file = MiscFile(relative)
-                new_files[relative] = file
-                files_added = True
+        for worksheet in self.worksheets:
+            worksheet.modules_changed(names)
 
-        return files_added
+    def __reset_all_modules(self):
+        self.__reset_modules(set(self.__modules))
+
+    def __find_dependents(self, name):
+        # Find the set of modules that need to be reset when the given module
+        # changes: the module itself, the modules that import it directly or
+        # indirectly, and submodules of any of those packages (since we'll create
+        # a new package module that doesn't have them as attributes)
+        result = set()
+        to_visit = [name]
+        while len(to_visit) > 0:
+            name = to_visit.pop()
+            if name in result:
+                continue
+            result.add(name)
 
-    ############################################################
-    # Import handling
-    ############################################################
+            to_visit.extend(self.__importers.get(name, ()))
 
-    def __reset_all_modules(self):
-        for (name, module) in self.__modules.iteritems():
-            del sys.modules[self.__prefix + "." + name]
+            prefix = name + "."
+            to_visit.extend((n for n in self.__modules if n.startswith(prefix)))
+
+        return result
+
+    def __hot_swap_module(self, name, module, source_file):
+        # Try to update the functions and classes of module in place from the
+        # new contents of source_file; returns True on success
+        try:
+            code = bytecode_cache.compile_file(source_file)
+        except (IOError, SyntaxError), e:
+            _debug("Can't compile %s for hot-swap: %s", source_file, e)
+            return False
+
+        # Execute the new code in a scratch module, so we can compare it to the old one
+        new = imp.new_module(module.__name__)
+        self.setup_globals(new.__dict__)
+        for attr in ('__file__', '__path__'):
+            if hasattr(module, attr):
+                setattr(new, attr, getattr(module, attr))
+        try:
+            exec code in new.__dict__
+        except Exception, e:
+            _debug("Error executing %s for hot-swap: %s", source_file, e)
+            return False
+
+        ignore = set(('__builtins__', '__doc__', '__file__', '__name__', '__path__'))
+        scratch = {}
+        self.setup_globals(scratch)
+        ignore.update(scratch.iterkeys())
+
+        changed = code_swap.swap_module(module.__dict__, new.__dict__, ignore)
+        if changed is None:
+            _debug("%s changed in a way that can't be hot-swapped", name)
+            return False
+
+        # Functions that call the changed functions also give different results,
+        # including functions in modules that import this one. (An importer that
+        # failed to load after importing this module is recorded, but not loaded.)
+        for dependent in self.__find_dependents(name):
+            if dependent in self.__modules:
+                changed = code_swap.find_users(self.__modules[dependent].__dict__, changed)
+
+        _debug("Hot-swapped %s, changed: %s", name, sorted(changed))
+        if len(changed) > 0:
             for worksheet in self.worksheets:
-                worksheet.module_changed(name)
+                worksheet.names_changed(changed)
 
-        self.__modules = {}
+        return True
 
     def reset_module_by_filename(self, filename):
+        """Reset a local module after its source file has changed
+
+        The module is reloaded next time it is imported. Other local modules
+        that import it (directly or indirectly) are also reset, and worksheets
+        are told about all the modules that were reset.
+
+        If hot-swapping is enabled for the notebook (see L{NotebookInfo.hot_swap}),
+        and the only changes are to the code of functions and methods, the module
+        is instead updated in place, and only statements that use the changed
+        functions are re-executed. Changes that can't be handled this way, such as
+        new or changed module-level variables, fall back to resetting the module.
+
+        @param filename: the absolute path to the source file
+        @returns: the old module object, or None if no module was loaded from the file
+
+        """
+
         filename = filename.lower()
         for (name, module) in self.__modules.iteritems():
             # If the .py changed, we need to reload the module even if it was
             # loaded from a .pyc file.
-            module_file = module.__file__.lower()
-            if module_file.endswith(".pyc") or module_file.endswith(".pyo"):
-                module_file = module_file[:-3] + "py"
+            source_file = module.__file__
+            if source_file.lower().endswith(".pyc") or source_file.lower().endswith(".pyo"):
+                source_file = source_file[:-3] + "py"
 
-            if module_file == filename:
-                del sys.modules[self.__prefix + "." + name]
-                del self.__modules[name]
-
-                for worksheet in self.worksheets:
-                    worksheet.module_changed(name)
+            if source_file.lower() == filename:
+                if self.info is not None and self.info.hot_swap and \
+                        self.__hot_swap_module(name, module, source_file):
+                    return module
 
+                self.__reset_modules(self.__find_dependents(name))
                 return module
 
+    def get_importers(self, name):
+        """Return the names of the local modules that directly import a local module"""
+
+        return set(self.__importers.get(name, ()))
+
+    def get_local_module_name(self, module_name):
+        """Get the name of a local module without the prefix it has in sys.modules
+
+        @param module_name: the name of a module, as in its __name__ attribute
+        @returns: the name of the module within the notebook, or None if it isn't
+           a local module of this notebook
+
+        """
+
+        if module_name is None or not module_name.startswith(self.__prefix + "."):
+            return None
+
+        return module_name[len(self.__prefix) + 1:]
+
+    def __get_local_name(self, globals_):
+        # Return the name of the local module whose globals are globals_, or None
+        if globals_ is None:
+            return None
+
+        return self.get_local_module_name(globals_.get('__name__'))
+
+    def __record_import(self, importer, name):
+        if name in self.__modules and name != importer:
+            self.__importers.setdefault(name, set()).add(importer)
+
+    def __record_imports(self, globals_, names, fromlist):
+        # Record the local modules imported by a local module, so we know what
+        # to reset when a module changes. Imports from worksheets are tracked
+        # by the worksheets themselves.
+        importer = self.__get_local_name(globals_)
+        if importer is None:
+            return
+
+        # Importing a.b.c imports a and a.b as well
+        for i in xrange(1, len(names) + 1):
+            self.__record_import(importer, ".".join(names[0:i]))
+
+        if fromlist is not None:
+            # 'from a import b' where b is a submodule
+            fullname = ".".join(names)
+            for fromname in fromlist:
+                if isinstance(fromname, basestring):
+                    self.__record_import(importer, fullname + "." + fromname)
+
+    def __get_source_file(self, loader):
+        # If loader is a loader for a Python source file or a package
+        # with an __init__.py, return (source_file, package_dir), otherwise
+        # return (None, None)
+        if not isinstance(loader, pkgutil.ImpLoader):
+            return None, None
+
+        kind = loader.etc[2]
+        if kind == imp.PY_SOURCE:
+            return loader.filename, None
+        elif kind == imp.PKG_DIRECTORY:
+            init_file = os.path.join(loader.filename, "__init__.py")
+            if os.path.exists(init_file):
+                return init_file, loader.filename
+
+        return None, None
+
     def __load_local_module(self, fullname, loader):
         prefixed = self.__prefix + "." + fullname
         
@@ -232,7 +444,20 @@ class Notebook(gobject.GObject):
         assert not prefixed in sys.modules
         sys.modules[prefixed] = new
         try:
-            result = loader.load_module(prefixed)
+            # For source files, we compile the code ourselves rather than using
+            # imp.load_module(), so that the compiled code goes in our cache rather
+            # than in a .pyc file in the notebook folder
+            source_file, package_dir = self.__get_source_file(loader)
+            if source_file is not None:
+                if loader.file is not None:
+                    loader.file.close()
+                new.__file__ = source_file
+                if package_dir is not None:
+                    new.__path__ = [package_dir]
+                exec bytecode_cache.compile_file(source_file) in new.__dict__
+                result = new
+            else:
+                result = loader.load_module(prefixed)
         except:
             del sys.modules[prefixed]
             raise
@@ -240,38 +465,81 @@ class Notebook(gobject.GObject):
         
         return result
 
+    def __get_importer(self, item):
+        try:
+            importer = self.__path_importers[item]
+            self.__import_stats['importer_hits'] += 1
+        except KeyError:
+            importer = pkgutil.get_importer(item)
+            self.__path_importers[item] = importer
+            self.__import_stats['importer_misses'] += 1
+
+        return importer
+
     # Unlike imp.find_module(), pkgutil.find_loader() doesn't take a path
     # argument, so when we want to look in a specific path we need to "roll
     # our own" out of lower level functionality.
     def __find_loader_in_path(self, fullname, path):
         for item in path:
-            importer = pkgutil.get_importer(item)
+            importer = self.__get_importer(item)
+            if importer is None:
+                continue
             loader = importer.find_module(fullname)
             if loader is not None:
                 return loader
 
         raise ImportError("no module named " + fullname)
 
+    def __find_loader(self, fullname, parent):
+        # Returns (loader, local). Searching the filesystem for a module that
+        # doesn't exist is slow, and code like 'try: import x; except ImportError:'
+        # will do it each time a statement is executed, so we remember failures
+        # until something changes. See __clear_import_caches()
+        if parent is None:
+            key = (None, fullname)
+        else:
+            key = (parent.__name__, fullname)
+
+        if key in self.__not_found:
+            self.__import_stats['negative_hits'] += 1
+            raise ImportError("no module named " + fullname)
+
+        self.__import_stats['find_calls'] += 1
+        start = time.time()
+        try:
+            try:
+                if parent is None:
+                    if not fullname in self.__not_local:
+                        try:
+                            return self.__find_loader_in_path(fullname, self.__path), True
+                        except ImportError:
+                            self.__not_local.add(fullname)
+
+                    loader = pkgutil.find_loader(fullname)
+                    if loader is None:
+                        raise ImportError("no module named " + fullname)
+                    return loader, False
+                else:
+                    if hasattr(parent, '__path__'):
+                        return self.__find_loader_in_path(fullname, parent.__path__), None
+                    else:
+                        raise ImportError("no module named " + fullname)
+            except ImportError:
+                self.__not_found.add(key)
+                raise
+        finally:
+            self.__import_stats['find_time'] += time.time() - start
+
     def __find_and_load(self, fullname, name, parent=None, local=None):
         # The 'imp' module doesn't support PEP 302 extensions like
         # sys.path_hooks (used for zipped eggs), so we use (undocumented)
         # functionality from pkgutil instead.
         if parent is None:
             assert local is None
-            try:
-                loader = self.__find_loader_in_path(fullname, self.__path)
-                local = True
-            except ImportError:
-                loader = pkgutil.find_loader(fullname)
-                if loader is None:
-                    raise ImportError("no module named " + fullname)
-                local = False
+            loader, local = self.__find_loader(fullname, None)
         else:
             assert local is not None
-            if hasattr(parent, '__path__'):
-                loader = self.__find_loader_in_path(fullname, parent.__path__)
-            else:
-                raise ImportError("no module named " + fullname)
+            loader, _ = self.__find_loader(fullname, parent)
 
         if local:
             module = self.__load_local_module(fullname, loader)
@@ -352,13 +620,18 @@ class Notebook(gobject.GObject):
                     else:
                         self.__ensure_from_list_item(name, fromname, module, local)
 
-                return module
+                result = module
             else:
                 self.__add_wrapper(globals_, module)
                 if local:
-                    return self.__modules[names[0]]
+                    result = self.__modules[names[0]]
                 else:
-                    return sys.modules[names[0]]
+                    result = sys.modules[names[0]]
+
+            if local:
+                self.__record_imports(globals_, names, fromlist)
+
+            return result
         finally:
             imp.release_lock()
 
@@ -379,27 +652,138 @@ class Notebook(gobject.GObject):
     ############################################################
 
     def refresh(self):
-        if not self.folder:
+        """Update self.files immediately after making changes to the notebook folder
+
+        Changes are noticed by themselves, but possibly not before the main loop
+        is next run.
+
+        """
+
+        if self.__watcher is None:
             return
 
-        old_files = self.files
-        self.files = {}
-        files_added = self.__load_files(None, old_files, self.files)
-        if files_added or len(old_files) > 0:
-            self.emit('files-changed')
+        self.__watcher.check()
+
+        # Modules might also have been installed outside the notebook
+        self.__clear_import_caches()
+        module_index.invalidate(self.__path)
+
+    def close(self):
+        """Stop watching the notebook folder for changes"""
+
+        if self.__watcher is not None:
+            self.__watcher.close()
+            self.__watcher = None
 
     def set_path(self, path):
         if path != self.__path:
             self.__path = path
             self.__root_module.path = path
+            self.__clear_import_caches()
             self.__reset_all_modules()
 
+    def get_import_stats(self):
+        """Return counters for the work done finding modules to import
+
+        This is meant for measuring the overhead of imports from worksheets; the
+        counters cover lookups of modules that weren't already loaded.
+
+        @returns: a dictionary with the keys:
+           find_calls: number of times we searched the path for a module
+           find_time: total time spent searching, in seconds
+           importer_hits, importer_misses: lookups of the importer for a path entry
+              that were or weren't satisfied from the cache
+           negative_hits: number of imports that failed immediately because the
+              module was already known not to exist
+
+        """
+
+        return dict(self.__import_stats)
+
+    def get_checkpoint_store(self):
+        """Get the store of checkpoints of slow statements for the notebook
+
+        @returns: a L{CheckpointStore}, or None if checkpoints aren't enabled for the
+           notebook (see L{NotebookInfo.checkpoints})
+
+        """
+
+        if self.info is None or not self.info.checkpoints:
+            return None
+
+        if self.__checkpoint_store is None:
+            self.__checkpoint_store = CheckpointStore(os.path.join(self.folder, ".checkpoints"))
+
+        self.__checkpoint_store.threshold = self.info.checkpoint_threshold
+        self.__checkpoint_store.max_size = self.info.checkpoint_max_size * 1024 * 1024
+
+        return self.__checkpoint_store
+
+    def get_memo_cache(self):
+        """Get the store of return values of functions decorated with @cached
+        in worksheets in the notebook
+
+        @returns: a L{MemoCache}, or None if the notebook doesn't have a folder
+
+        """
+
+        if self.info is None:
+            return None
+
+        if self.__memo_cache is None:
+            self.__memo_cache = MemoCache(os.path.join(self.folder, ".cache"))
+
+        self.__memo_cache.max_size = self.info.cache_max_size * 1024 * 1024
+
+        return self.__memo_cache
+
+    def get_statement_cache(self):
+        """Get the cache of the effects of statements marked with #@cache in
+        worksheets in the notebook
+
+        @returns: a L{StatementCache}. If enabled for the notebook (see
+           L{NotebookInfo.statement_cache_spill}), entries that don't fit in memory
+           are saved with the return values of @cached functions.
+
+        """
+
+        if self.__statement_cache is None:
+            self.__statement_cache = StatementCache()
+
+        if self.info is not None and self.info.statement_cache_spill:
+            self.__statement_cache.spill = self.get_memo_cache()
+        else:
+            self.__statement_cache.spill = None
+
+        return self.__statement_cache
+
+    def find_modules(self, package_names, prefix):
+        """Find modules that can be imported from worksheets in the notebook
+
+        The modules are found without importing anything, from an index that is built
+        in the background. See L{ModuleIndex.find_modules}.
+
+        @param package_names: list of the components of the name of a package to look
+            for modules within, or [] to look for toplevel modules
+        @param prefix: only return modules whose names start with prefix
+        @returns: list of module names
+
+        """
+
+        return module_index.find_modules(self.__path + sys.path, package_names, prefix)
+
     def setup_globals(self, globals):
         globals['__reinteract_notebook'] = self
         globals['__reinteract_copy'] = copy.copy
         globals['__reinteract_wrappers'] = []
         globals['help'] = _Helper()
 
+        memo_cache = self.get_memo_cache()
+        if memo_cache is not None:
+            globals['cached'] = memo_cache.cached
+        else:
+            globals['cached'] = _no_cache
+
     def file_for_absolute_path(self, absolute_path):
         assert absolute_path
         assert os.path.isabs(absolute_path)
@@ -541,6 +925,100 @@ if __name__ == '__main__':
         nb.reset_module_by_filename(os.path.join(base, "mod4.py"))
         do_test("import mod4", "mod4.a", 1, nb=nb)
 
+        # Changing a module resets the modules that import it, directly or indirectly
+        class MockWorksheet(object):
+            def __init__(self):
+                self.changed = []
+            def modules_changed(self, names):
+                self.changed.append(sorted(names))
+
+        nb = Notebook(base)
+        worksheet = MockWorksheet()
+        nb.worksheets.add(worksheet)
+        write_file("mod5.py", "a = 1")
+        write_file("mod6.py", "import mod5\nb = mod5.a + 1")
+        write_file("mod7.py", "from mod6 import b\nc = b + 1")
+        write_file("mod8.py", "import mod1")
+        do_test("import mod7, mod8", "mod7.c", 3, nb=nb)
+        assert_equals(nb.get_importers("mod5"), set(["mod6"]))
+        assert_equals(nb.get_importers("mod6"), set(["mod7"]))
+        write_file("mod5.py", "a = 2")
+        nb.reset_module_by_filename(os.path.join(base, "mod5.py"))
+        assert_equals(worksheet.changed, [["mod5", "mod6", "mod7"]])
+        assert_equals(nb.get_importers("mod5"), set())
+        do_test("import mod7", "mod7.c", 4, nb=nb)
+        assert_equals(nb.get_importers("mod5"), set(["mod6"]))
+
+        # Hot-swapping changed functions
+        class MockWorksheet(object):
+            def __init__(self):
+                self.changed = []
+            def modules_changed(self, names):
+                self.changed.append(('modules', sorted(names)))
+            def names_changed(self, names):
+                self.changed.append(('names', sorted(names)))
+
+        nb = Notebook(base)
+        nb.info.hot_swap = True
+        worksheet = MockWorksheet()
+        nb.worksheets.add(worksheet)
+        write_file("mod9.py", "def f():\n    return 1\ndef g():\n    return f()\ndef h():\n    return 0")
+        write_file("mod10.py", "from mod9 import g\ndef k():\n    return g()")
+        do_test("import mod10", "mod10.k()", 1, nb=nb)
+        write_file("mod9.py", "def f():\n    return 2\ndef g():\n    return f()\ndef h():\n    return 0")
+        nb.reset_module_by_filename(os.path.join(base, "mod9.py"))
+        assert_equals(worksheet.changed, [('names', ['f', 'g', 'k'])])
+        do_test("import mod10", "mod10.k()", 2, nb=nb)
+        del worksheet.changed[:]
+        # New module-level state falls back to resetting
+        write_file("mod9.py", "X = 3\ndef f():\n    return X\ndef g():\n    return f()\ndef h():\n    return 0")
+        nb.reset_module_by_filename(os.path.join(base, "mod9.py"))
+        assert_equals(worksheet.changed, [('modules', ['mod10', 'mod9'])])
+        do_test("import mod10", "mod10.k()", 3, nb=nb)
+        del worksheet.changed[:]
+        # A module that imported the changed module and then failed to load
+        write_file("mod13.py", "import mod9\nraise ValueError()")
+        try:
+            do_test("import mod13", "1", 1, nb=nb)
+            raise AssertionError("import mod13 should have failed")
+        except ValueError:
+            pass
+        write_file("mod9.py", "X = 3\ndef f():\n    return X + 1\ndef g():\n    return f()\ndef h():\n    return 0")
+        nb.reset_module_by_filename(os.path.join(base, "mod9.py"))
+        assert_equals(worksheet.changed, [('names', ['f', 'g', 'k'])])
+        do_test("import mod10", "mod10.k()", 4, nb=nb)
+        nb.info.hot_swap = False
+
+        # Compiled code for notebook modules doesn't end up in the notebook folder
+        nb = Notebook(base)
+        write_file("mod12.py", "a = 1")
+        scope = {}
+        nb.setup_globals(scope)
+        exec "import mod12, package1.mod2" in scope
+        assert_equals(scope['package1'].mod2.b, 2)
+        assert not os.path.exists(os.path.join(base, "mod12.pyc"))
+        assert not os.path.exists(os.path.join(base, "package1", "__init__.pyc"))
+        nb.close()
+
+        # Failed lookups are remembered until the notebook folder changes
+        nb = Notebook(base)
+        for i in xrange(0, 2):
+            try:
+                do_test("import mod11", "mod11.a", 1, nb=nb)
+                raise AssertionError("import mod11 should have failed")
+            except ImportError:
+                pass
+        stats = nb.get_import_stats()
+        assert_equals(stats['find_calls'], 1)
+        assert_equals(stats['negative_hits'], 1)
+        write_file("mod11.py", "a = 1")
+        nb.refresh()
+        do_test("import mod11", "mod11.a", 1, nb=nb)
+        assert_equals(nb.get_import_stats()['find_calls'], 2)
+        do_test("import mod1", "mod1.a", 1, nb=nb)
+        assert nb.get_import_stats()['importer_hits'] > 0
+        nb.close()
+
         nb = Notebook(base)
         assert_equals(nb.file_for_absolute_path(os.path.dirname(base)), None)
         assert_equals(nb.file_for_absolute_path(base), None)
@@ -549,5 +1027,33 @@ if __name__ == '__main__':
         assert_equals(nb.file_for_absolute_path(os.path.join(base, "package1/")), None)
         assert_equals(nb.file_for_absolute_path(os.path.join(base, "package1/mod2.py")).path, "package1/mod2.py")
 
+        # Changes to the files in the notebook folder are reported incrementally
+        events = []
+        nb.connect('file-added', lambda nb, file: events.append(('added', file.path)))
+        nb.connect('file-removed', lambda nb, file: events.append(('removed', file.path)))
+        nb.connect('files-changed', lambda nb: events.append('files-changed'))
+        write_file("worksheet.rws", "")
+        write_file("data.txt~", "")
+        nb.refresh()
+        assert_equals(events, [('added', 'worksheet.rws'), 'files-changed'])
+        assert isinstance(nb.files['worksheet.rws'], WorksheetFile)
+        assert not 'data.txt~' in nb.files
+        del events[:]
+        os.remove(os.path.join(base, "worksheet.rws"))
+        nb.refresh()
+        assert_equals(events, [('removed', 'worksheet.rws'), 'files-changed'])
+        assert not 'worksheet.rws' in nb.files
+        nb.close()
+
+        # @cached stores return values in the notebook folder
+        nb = Notebook(base)
+        scope = {}
+        nb.setup_globals(scope)
+        exec "@cached\ndef f(x):\n    return x * 2\ny = f(1)\ny = f(1)\n" in scope
+        assert_equals(scope['y'], 2)
+        assert_equals((nb.get_memo_cache().hits, nb.get_memo_cache().misses), (1, 1))
+        assert os.path.isdir(os.path.join(base, ".cache"))
+        nb.close()
+
     finally:
         cleanup()
@@ -112,3 +112,63 @@ class NotebookInfo(object):
         self.__save()
 
     description = property(__get_description, __set_description)
+
+    def __get_hot_swap(self):
+        if self.__parser.has_option('Notebook', 'hot_swap'):
+            return self.__parser.getboolean('Notebook', 'hot_swap')
+        else:
+            return False
+
+    def __set_hot_swap(self, hot_swap):
+        self.__parser.set('Notebook', 'hot_swap', str(hot_swap).lower())
+        self.__save()
+
+    #: Whether to update the functions of a library module in place when it changes
+    #: rather than reloading it. See Notebook.reset_module_by_filename()
+    hot_swap = property(__get_hot_swap, __set_hot_swap)
+
+    def __get_checkpoints(self):
+        if self.__parser.has_option('Notebook', 'checkpoints'):
+            return self.__parser.getboolean('Notebook', 'checkpoints')
+        else:
+            return False
+
+    def __set_checkpoints(self, checkpoints):
+        self.__parser.set('Notebook', 'checkpoints', str(checkpoints).lower())
+        self.__save()
+
+    #: Whether to save the results of slow statements so that they don't have
+    #: to be executed again when the notebook is reopened. See CheckpointStore
+    checkpoints = property(__get_checkpoints, __set_checkpoints)
+
+    @property
+    def checkpoint_threshold(self):
+        """Minimum time in seconds a statement takes to execute for it to be checkpointed"""
+        if self.__parser.has_option('Notebook', 'checkpoint_threshold'):
+            return self.__parser.getfloat('Notebook', 'checkpoint_threshold')
+        else:
+            return 10.
+
+    @property
+    def checkpoint_max_size(self):
+        """Maximum total size of the saved checkpoints, in megabytes"""
+        if self.__parser.has_option('Notebook', 'checkpoint_max_size'):
+            return self.__parser.getint('Notebook', 'checkpoint_max_size')
+        else:
+            return 1024
+
+    @property
+    def cache_max_size(self):
+        """Maximum total size of the values saved for functions decorated with @cached, in megabytes"""
+        if self.__parser.has_option('Notebook', 'cache_max_size'):
+            return self.__parser.getint('Notebook', 'cache_max_size')
+        else:
+            return 256
+
+    @property
+    def statement_cache_spill(self):
+        """Whether to save the effects of #@cache statements that don't fit in memory to disk"""
+        if self.__parser.has_option('Notebook', 'statement_cache_spill'):
+            return self.__parser.getboolean('Notebook', 'statement_cache_spill')
+        else:
+            return False
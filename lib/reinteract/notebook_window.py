@@ -14,6 +14,7 @@ from file_list import FileList
 from format_escaped import format_escaped
 from notebook import NotebookFile, WorksheetFile, LibraryFile
 from save_file import SaveFileBuilder
+import saved_results
 
 gtk.rc_parse_string(
     """
@@ -40,6 +41,7 @@ class NotebookWindow(BaseNotebookWindow):
          <menuitem action="save"/>
          <menuitem action="rename"/>
          <menuitem action="print"/>
+         <menuitem action="export-timings"/>
          <menuitem action="close"/>
          <separator/>
          <menuitem action="quit"/>
@@ -52,6 +54,7 @@ class NotebookWindow(BaseNotebookWindow):
          <menuitem action="delete"/>
          <separator/>
          <menuitem action="calculate"/>
+         <menuitem action="calculate-to-cursor"/>
          <menuitem action="break"/>
          <separator/>
          <menuitem action="calculate-all"/>
@@ -210,6 +213,7 @@ class NotebookWindow(BaseNotebookWindow):
 
         abspath = os.path.join(self.notebook.folder, file.path)
         os.remove(abspath)
+        saved_results.remove_results(abspath)
         self.notebook.refresh()
 
     def on_hpaned_notify_position(self, pane, gparamspec):
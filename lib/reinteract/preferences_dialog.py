@@ -45,6 +45,16 @@ class PreferencesBuilder(WindowBuilder):
 
         self.autocomplete_check_button.connect('toggled', self.__on_autocomplete_check_button_toggled)
 
+        global_settings.connect('notify::auto-calculate', self.__on_notify_auto_calculate)
+        self.__on_notify_auto_calculate()
+
+        self.auto_calculate_check_button.connect('toggled', self.__on_auto_calculate_check_button_toggled)
+
+        global_settings.connect('notify::show-timings', self.__on_notify_show_timings)
+        self.__on_notify_show_timings()
+
+        self.show_timings_check_button.connect('toggled', self.__on_show_timings_check_button_toggled)
+
     def __on_notify_editor_font_is_custom(self, *args):
         self.editor_font_custom_check_button.set_active(global_settings.editor_font_is_custom)
 
@@ -87,6 +97,22 @@ class PreferencesBuilder(WindowBuilder):
         if autocomplete != global_settings.autocomplete:
             global_settings.autocomplete = autocomplete
 
+    def __on_notify_auto_calculate(self, *args):
+        self.auto_calculate_check_button.set_active(global_settings.auto_calculate)
+
+    def __on_auto_calculate_check_button_toggled(self, *args):
+        auto_calculate = self.auto_calculate_check_button.get_active()
+        if auto_calculate != global_settings.auto_calculate:
+            global_settings.auto_calculate = auto_calculate
+
+    def __on_notify_show_timings(self, *args):
+        self.show_timings_check_button.set_active(global_settings.show_timings)
+
+    def __on_show_timings_check_button_toggled(self, *args):
+        show_timings = self.show_timings_check_button.get_active()
+        if show_timings != global_settings.show_timings:
+            global_settings.show_timings = show_timings
+
     def __on_response(self, dialog, response_id):
         self.dialog.hide()
 
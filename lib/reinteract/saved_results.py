@@ -0,0 +1,225 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Saving the results of the statements of a worksheet alongside the worksheet,
+# so that they can be shown immediately when the worksheet is opened again,
+# before the worksheet is recalculated.
+#
+# The results are stored in a hidden file next to the worksheet file, as JSON
+# (so loading the results never executes code.) Each statement's results are
+# keyed by a hash of the statement's text; if the same statement occurs more than
+# once in the worksheet, the results for each occurrence are stored in order.
+# Custom results, such as plots, are stored as PNG images if they can be
+# rendered without a window (see CustomResult.render_png); help results are
+# not stored.
+#
+
+import base64
+import hashlib
+import logging
+import os
+
+from batch_run import json
+from custom_result import CustomResult, ImageResult
+
+_debug = logging.getLogger("SavedResults").debug
+
+_VERSION = 1
+
+def get_results_filename(filename):
+    """Get the name of the file that the results of a worksheet are saved in"""
+
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, "." + basename + ".results")
+
+def get_statement_key(text):
+    """Get the key for the results of a statement, from its text"""
+
+    if isinstance(text, unicode):
+        text = text.encode("utf8")
+
+    return hashlib.sha1(text).hexdigest()
+
+def _encode_result(result):
+    # Imported here to avoid circular imports
+    from statement import WarningResult
+
+    if isinstance(result, basestring):
+        return { 'text': result }
+    elif isinstance(result, WarningResult):
+        return { 'warning': result.message }
+    elif isinstance(result, CustomResult):
+        try:
+            data = result.render_png()
+        except Exception, e:
+            _debug("Can't render %s: %s", type(result).__name__, e)
+            return None
+        if data is not None:
+            return { 'image': base64.b64encode(data) }
+
+    return None
+
+def _decode_result(encoded):
+    from statement import WarningResult
+
+    if 'text' in encoded:
+        return encoded['text']
+    elif 'warning' in encoded:
+        return WarningResult(encoded['warning'])
+    elif 'image' in encoded:
+        return ImageResult(base64.b64decode(encoded['image']))
+    else:
+        raise ValueError("Unknown result")
+
+def save_results(filename, chunks):
+    """Save the results of the statements of a worksheet
+
+    @param filename: the filename of the worksheet
+    @param chunks: the StatementChunks of the worksheet, in order
+    @returns: True if the results were saved
+
+    """
+
+    if json is None:
+        return False
+
+    saved = {}
+    for chunk in chunks:
+        if chunk.error_message is not None:
+            entry = { 'results': [], 'error': chunk.error_message, 'error_line': chunk.error_line }
+        elif chunk.results:
+            encoded = (_encode_result(result) for result in chunk.results)
+            entry = { 'results': [e for e in encoded if e is not None], 'error': None, 'error_line': None }
+        else:
+            entry = None
+
+        saved.setdefault(get_statement_key(chunk.tokenized.get_text()), []).append(entry)
+
+    # Don't leave behind a results file with nothing in it
+    results_filename = get_results_filename(filename)
+    if not any(entry is not None for entries in saved.itervalues() for entry in entries):
+        remove_results(filename)
+        return True
+
+    tmpname = results_filename + ".tmp"
+    try:
+        f = open(tmpname, "wb")
+        try:
+            json.dump({ 'version': _VERSION, 'statements': saved }, f)
+        finally:
+            f.close()
+        if os.path.exists(results_filename):
+            os.unlink(results_filename)
+        os.rename(tmpname, results_filename)
+    except (OSError, IOError), e:
+        _debug("Can't save results to %s: %s", results_filename, e)
+        return False
+
+    return True
+
+def load_results(filename):
+    """Load the saved results for a worksheet
+
+    @param filename: the filename of the worksheet
+    @returns: a dictionary mapping the key of a statement (see L{get_statement_key}) to
+       a list with an entry for each occurrence of the statement in the worksheet.
+       Each entry is None, if there were no results, or a tuple of
+       (results, error_message, error_line).
+
+    """
+
+    if json is None:
+        return {}
+
+    results_filename = get_results_filename(filename)
+    try:
+        f = open(results_filename, "rb")
+    except IOError:
+        return {}
+
+    try:
+        try:
+            saved = json.load(f)
+            if saved.get('version') != _VERSION:
+                return {}
+
+            result = {}
+            for key, entries in saved['statements'].iteritems():
+                decoded = []
+                for entry in entries:
+                    if entry is not None:
+                        entry = ([_decode_result(r) for r in entry['results']],
+                                 entry['error'], entry['error_line'])
+                    decoded.append(entry)
+                result[str(key)] = decoded
+
+            return result
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            _debug("Can't load results from %s: %s", results_filename, e)
+            return {}
+    finally:
+        f.close()
+
+def remove_results(filename):
+    """Remove the saved results for a worksheet, if any"""
+
+    try:
+        os.remove(get_results_filename(filename))
+    except OSError:
+        pass
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from chunks import StatementChunk
+    from statement import WarningResult
+    from test_utils import assert_equals
+
+    class TestCustomResult(CustomResult):
+        def render_png(self):
+            return "\x89PNG..."
+
+    base = tempfile.mkdtemp("", "saved_results")
+    try:
+        filename = os.path.join(base, "test.rws")
+
+        def make_chunk(text, results, error_message=None):
+            chunk = StatementChunk(0, 1)
+            chunk.set_lines([text])
+            chunk.results = results
+            chunk.error_message = error_message
+            return chunk
+
+        chunks = [make_chunk("a", [u"1", WarningResult("careful"), TestCustomResult()]),
+                  make_chunk("b = 1", []),
+                  make_chunk("a", [u"2"]),
+                  make_chunk("1/0", None, "ZeroDivisionError")]
+        assert save_results(filename, chunks)
+        assert os.path.exists(os.path.join(base, ".test.rws.results"))
+
+        saved = load_results(filename)
+        assert_equals(sorted(saved.keys()), sorted([get_statement_key("a"), get_statement_key("b = 1"),
+                                                   get_statement_key("1/0")]))
+        first, second = saved[get_statement_key("a")]
+        assert_equals(first[0][0], u"1")
+        assert_equals(first[0][1].message, "careful")
+        assert_equals(first[0][2].render_png(), "\x89PNG...")
+        assert_equals(second, ([u"2"], None, None))
+        assert_equals(saved[get_statement_key("b = 1")], [None])
+        assert_equals(saved[get_statement_key("1/0")], [([], "ZeroDivisionError", None)])
+
+        # Without any results, the file is removed
+        assert save_results(filename, [make_chunk("b = 1", [])])
+        assert not os.path.exists(os.path.join(base, ".test.rws.results"))
+        assert_equals(load_results(filename), {})
+    finally:
+        shutil.rmtree(base)
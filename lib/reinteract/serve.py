@@ -0,0 +1,709 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Serving the worksheets of a notebook over HTTP; this is the implementation
+# of the reinteract-serve command.
+#
+# The requests are:
+#
+#  POST /run                     Body: {"worksheet": PATH, "parameters": {NAME: VALUE, ...}}
+#  GET  /run/PATH?NAME=VALUE...  Each value is parsed as JSON if possible, otherwise
+#                                it is used as a string
+#  GET  /worksheets              List the worksheets in the notebook
+#  GET  /metrics                 Metrics in the Prometheus text format
+#
+# PATH is the filename of a worksheet relative to the notebook folder. The
+# response to a run is the record from batch_run.run_worksheet() as JSON, with
+# the filename relative to the notebook folder, plots as base64 PNG images,
+# and the additional key 'cached'. A run that takes longer than the timeout
+# gets '504 Gateway Timeout', and one whose worker process dies gets
+# '500 Internal Server Error'.
+#
+
+import BaseHTTPServer
+import hashlib
+import logging
+import os
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from optparse import OptionParser
+
+import batch_run
+from batch_run import json, multiprocessing
+
+_debug = logging.getLogger("Serve").debug
+
+DEFAULT_PORT = 8189
+
+# Upper bounds of the request latency histogram, in seconds
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+class ServerBusyError(Exception):
+    """Raised when a worksheet can't be run because the request queue is full"""
+    pass
+
+class RunTimeoutError(Exception):
+    """Raised when running a worksheet takes longer than the timeout of the server"""
+    pass
+
+class WorkerDiedError(Exception):
+    """Raised when the worker process running a worksheet exits"""
+    pass
+
+class ResultCache(object):
+
+    """
+    Cache of the results of running worksheets, keyed by a hash of the contents
+    of the worksheet and the parameters it was run with. When the cache is full,
+    the least recently used entry is discarded.
+
+    Only the worksheet itself is hashed: results aren't invalidated when a library
+    module of the notebook changes. Restart the server after changing library code.
+    """
+
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__serial = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(filename, parameters):
+        """Compute the cache key for running a worksheet
+
+        @raises IOError: if the worksheet can't be read
+
+        """
+
+        f = open(filename, "rb")
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+
+        h = hashlib.sha1(os.path.abspath(filename))
+        h.update('\0')
+        h.update(contents)
+        h.update('\0')
+        h.update(json.dumps(parameters, sort_keys=True))
+
+        return h.hexdigest()
+
+    def lookup(self, key):
+        """Return the cached record for key, or None"""
+
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__serial += 1
+            self.__entries[key] = (self.__serial, entry[1])
+            return entry[1]
+        finally:
+            self.__lock.release()
+
+    def store(self, key, record):
+        self.__lock.acquire()
+        try:
+            if self.max_entries <= 0:
+                return
+
+            self.__serial += 1
+            self.__entries[key] = (self.__serial, record)
+            if len(self.__entries) > self.max_entries:
+                oldest = min(self.__entries.iteritems(), key=lambda (k, v): v[0])[0]
+                del self.__entries[oldest]
+        finally:
+            self.__lock.release()
+
+    def __len__(self):
+        return len(self.__entries)
+
+class _Metrics(object):
+    # Request counts and latencies, shared between the request threads
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__requests = {}  # (path, status) => count
+        self.__bucket_counts = [0] * len(_LATENCY_BUCKETS)
+        self.__latency_count = 0
+        self.__latency_sum = 0.
+
+    def record_request(self, path, status, elapsed):
+        self.__lock.acquire()
+        try:
+            key = (path, status)
+            self.__requests[key] = self.__requests.get(key, 0) + 1
+            for i, bound in enumerate(_LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    self.__bucket_counts[i] += 1
+            self.__latency_count += 1
+            self.__latency_sum += elapsed
+        finally:
+            self.__lock.release()
+
+    def format(self, server):
+        lines = []
+        def add(name, type, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+            for labels, value in samples:
+                if labels:
+                    label_text = "{" + ",".join('%s="%s"' % l for l in labels) + "}"
+                else:
+                    label_text = ""
+                lines.append("%s%s %s" % (name, label_text, repr(value)))
+
+        self.__lock.acquire()
+        try:
+            add("reinteract_requests_total", "counter", "HTTP requests handled.",
+                [((("path", path), ("code", status)), count)
+                 for (path, status), count in sorted(self.__requests.iteritems())])
+
+            add("reinteract_request_duration_seconds", "histogram", "HTTP request latency.", [])
+            for bound, count in zip(_LATENCY_BUCKETS, self.__bucket_counts):
+                lines.append('reinteract_request_duration_seconds_bucket{le="%r"} %d' % (bound, count))
+            lines.append('reinteract_request_duration_seconds_bucket{le="+Inf"} %d' % self.__latency_count)
+            lines.append("reinteract_request_duration_seconds_sum %r" % self.__latency_sum)
+            lines.append("reinteract_request_duration_seconds_count %d" % self.__latency_count)
+        finally:
+            self.__lock.release()
+
+        cache = server.cache
+        lookups = cache.hits + cache.misses
+        if lookups > 0:
+            hit_ratio = float(cache.hits) / lookups
+        else:
+            hit_ratio = 0.
+
+        add("reinteract_queue_depth", "gauge", "Requests waiting for a worker process.",
+            [((), server.get_queued())])
+        add("reinteract_running", "gauge", "Worksheets currently running.",
+            [((), server.get_running())])
+        add("reinteract_workers", "gauge", "Size of the worker process pool.",
+            [((), server.n_processes)])
+        add("reinteract_rejected_total", "counter", "Requests rejected because the queue was full.",
+            [((), server.rejected)])
+        add("reinteract_failed_total", "counter", "Runs that timed out or whose worker process died.",
+            [((), server.failed)])
+        add("reinteract_cache_hits_total", "counter", "Result cache hits.", [((), cache.hits)])
+        add("reinteract_cache_misses_total", "counter", "Result cache misses.", [((), cache.misses)])
+        add("reinteract_cache_hit_ratio", "gauge", "Fraction of result cache lookups that were hits.",
+            [((), hit_ratio)])
+        add("reinteract_cache_entries", "gauge", "Number of results in the cache.", [((), len(cache))])
+
+        return "\n".join(lines) + "\n"
+
+def _run_job(args):
+    # Run a worksheet for a request, in a worker process
+    filename, folder, parameters = args
+
+    try:
+        return batch_run.run_worksheet(filename, folder, parameters, render_images=True)
+    except Exception, e:
+        _debug("Error running %s: %s", filename, e)
+        return {
+            'file': filename,
+            'error': "%s: %s" % (type(e).__name__, e),
+            'errors': 1,
+            'elapsed': 0.,
+            'statements': []
+        }
+
+def _worker_main(connection):
+    # Entry point for worker processes
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            break
+        connection.send(_run_job(job))
+
+class _Worker(object):
+    # A worker process that runs one job at a time, and is replaced by a new
+    # process if a job doesn't finish in time or the process dies
+
+    def __init__(self):
+        self.__start()
+
+    def __start(self):
+        self.__connection, child_connection = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(target=_worker_main, args=(child_connection,))
+        self.__process.daemon = True
+        self.__process.start()
+        # So that we get EOF if the worker process dies
+        child_connection.close()
+
+    def run(self, job, timeout):
+        try:
+            self.__connection.send(job)
+            if self.__connection.poll(timeout):
+                return self.__connection.recv()
+        except (EOFError, IOError), e:
+            _debug("Worker process died running %s: %s", job[0], e)
+            self.restart()
+            raise WorkerDiedError()
+
+        _debug("Running %s timed out", job[0])
+        self.restart()
+        raise RunTimeoutError()
+
+    def restart(self):
+        self.stop()
+        self.__start()
+
+    def stop(self):
+        self.__process.terminate()
+        self.__process.join()
+        self.__connection.close()
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """
+    HTTP server running the worksheets of a notebook.
+
+    Each request is handled in its own thread, and worksheets are run in a
+    fixed-size pool of worker processes. The worker processes are started
+    with the worksheet code already imported, and are reused between requests.
+    When all the workers are busy, up to max_queue further requests wait for
+    a worker; beyond that, requests are rejected with '503 Service Unavailable'
+    so that clients back off rather than piling up. A worker process that
+    takes longer than run_timeout to run a worksheet is killed, as is one that
+    dies, and replaced with a new process.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, folder, address=('127.0.0.1', DEFAULT_PORT),
+                 n_processes=None, max_queue=16, cache_size=100, run_timeout=300.):
+        """
+        @param folder: the notebook folder to serve
+        @param address: (host, port) to listen on. By default, only connections
+           from the local machine are accepted. A port of 0 picks a free port;
+           see server_address.
+        @param n_processes: number of worker processes (default: number of CPUs)
+        @param max_queue: maximum number of requests waiting for a worker
+        @param cache_size: maximum number of results to cache
+        @param run_timeout: maximum time to run a worksheet, in seconds. Without the
+           multiprocessing module, worksheets are run in the request threads, and
+           the timeout doesn't apply.
+
+        """
+
+        self.folder = os.path.abspath(folder)
+        self.max_queue = max_queue
+        self.run_timeout = run_timeout
+        self.cache = ResultCache(cache_size)
+        self.metrics = _Metrics()
+        self.rejected = 0
+        self.failed = 0
+
+        if n_processes is None:
+            if multiprocessing is not None:
+                n_processes = multiprocessing.cpu_count()
+            else:
+                n_processes = 1
+        self.n_processes = n_processes
+
+        self.__lock = threading.Lock()
+        self.__slots = threading.Semaphore(n_processes)
+        self.__queued = 0
+        self.__running = 0
+
+        # Import the worksheet code before starting the workers, so that
+        # they start out ready to run worksheets
+        import stdout_capture
+        stdout_capture.init()
+        import notebook
+        import worksheet
+
+        # Idle workers; a request takes a worker after acquiring a slot
+        if multiprocessing is not None:
+            self.__workers = [_Worker() for i in xrange(n_processes)]
+        else:
+            self.__workers = None
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, _RequestHandler)
+
+    def get_queued(self):
+        """Return the number of requests waiting for a worker process"""
+
+        return self.__queued
+
+    def get_running(self):
+        """Return the number of worksheets currently running"""
+
+        return self.__running
+
+    def resolve_worksheet(self, path):
+        """Get the filename of a worksheet from a path relative to the notebook folder
+
+        @returns: the absolute filename, or None if path isn't a worksheet in the notebook
+
+        """
+
+        path = path.replace('/', os.sep)
+        filename = os.path.normpath(os.path.join(self.folder, path))
+        if not filename.startswith(self.folder + os.sep):
+            return None
+        if not filename.lower().endswith(".rws") or not os.path.isfile(filename):
+            return None
+
+        return filename
+
+    def run(self, filename, parameters):
+        """Run a worksheet, or get the results from the cache
+
+        @param filename: the absolute filename of the worksheet
+        @param parameters: dictionary of parameter values; see L{batch_run.bind_parameters}
+        @returns: tuple of (record, cached)
+        @raises ServerBusyError: if the request queue is full
+        @raises RunTimeoutError: if running the worksheet took longer than run_timeout
+        @raises WorkerDiedError: if the worker process running the worksheet died
+        @raises IOError: if the worksheet can't be read
+
+        """
+
+        key = ResultCache.make_key(filename, parameters)
+        record = self.cache.lookup(key)
+        if record is not None:
+            return record, True
+
+        self.__lock.acquire()
+        try:
+            if self.__queued + self.__running >= self.n_processes + self.max_queue:
+                self.rejected += 1
+                raise ServerBusyError()
+            self.__queued += 1
+        finally:
+            self.__lock.release()
+
+        self.__slots.acquire()
+        try:
+            self.__lock.acquire()
+            try:
+                self.__queued -= 1
+                self.__running += 1
+            finally:
+                self.__lock.release()
+
+            job = (filename, self.folder, parameters)
+            if self.__workers is not None:
+                self.__lock.acquire()
+                try:
+                    worker = self.__workers.pop()
+                finally:
+                    self.__lock.release()
+                try:
+                    record = worker.run(job, self.run_timeout)
+                except (RunTimeoutError, WorkerDiedError):
+                    self.__lock.acquire()
+                    try:
+                        self.failed += 1
+                    finally:
+                        self.__lock.release()
+                    raise
+                finally:
+                    self.__lock.acquire()
+                    try:
+                        self.__workers.append(worker)
+                    finally:
+                        self.__lock.release()
+            else:
+                record = _run_job(job)
+        finally:
+            self.__lock.acquire()
+            try:
+                self.__running -= 1
+            finally:
+                self.__lock.release()
+            self.__slots.release()
+
+        if record['error'] is None:
+            self.cache.store(key, record)
+
+        return record, False
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        if self.__workers is not None:
+            for worker in self.__workers:
+                worker.stop()
+            self.__workers = None
+
+def _parse_query_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "reinteract-serve"
+
+    def log_message(self, format, *args):
+        _debug("%s - " + format, self.address_string(), *args)
+
+    def __send(self, status, body, content_type="application/json", headers=()):
+        if content_type == "application/json":
+            body = json.dumps(body) + "\n"
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+        return status
+
+    def __send_error(self, status, message, headers=()):
+        return self.__send(status, { 'error': message }, headers=headers)
+
+    def __run(self, path, parameters):
+        if not isinstance(path, basestring):
+            return self.__send_error(400, "No worksheet specified")
+        if not isinstance(parameters, dict):
+            return self.__send_error(400, "Parameters must be an object")
+        for name in parameters:
+            if not batch_run._ASSIGNMENT_RE.match(name + "="):
+                return self.__send_error(400, "Invalid parameter name '%s'" % name)
+
+        filename = self.server.resolve_worksheet(path)
+        if filename is None:
+            return self.__send_error(404, "No worksheet '%s'" % path)
+
+        try:
+            record, cached = self.server.run(filename, parameters)
+        except ServerBusyError:
+            return self.__send_error(503, "Too many requests", headers=(("Retry-After", "1"),))
+        except RunTimeoutError:
+            return self.__send_error(504, "Running '%s' took too long" % path)
+        except WorkerDiedError:
+            return self.__send_error(500, "The worker process running '%s' exited" % path)
+        except IOError, e:
+            return self.__send_error(404, str(e))
+
+        result = dict(record)
+        result['file'] = path
+        result['cached'] = cached
+        return self.__send(200, result)
+
+    def __handle(self):
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url[2])
+
+        if self.command == 'POST':
+            if path != '/run':
+                return self.__send_error(404, "Not found")
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+            except ValueError:
+                return self.__send_error(400, "Request body is not valid JSON")
+            if not isinstance(request, dict):
+                return self.__send_error(400, "Request body must be an object")
+            return self.__run(request.get('worksheet'), request.get('parameters', {}))
+
+        if path == '/metrics':
+            return self.__send(200, self.server.metrics.format(self.server),
+                               content_type="text/plain; version=0.0.4")
+        elif path == '/worksheets':
+            worksheets = [filename[len(self.server.folder) + 1:].replace(os.sep, '/')
+                          for filename in batch_run.find_worksheets(self.server.folder)]
+            return self.__send(200, worksheets)
+        elif path.startswith('/run/'):
+            parameters = {}
+            for name, value in urlparse.parse_qsl(url[4]):
+                parameters[name] = _parse_query_value(value)
+            return self.__run(path[len('/run/'):], parameters)
+        else:
+            return self.__send_error(404, "Not found")
+
+    def __handle_and_record(self):
+        start = time.time()
+        path = urlparse.urlparse(self.path)[2]
+        if path.startswith('/run/'):
+            path = '/run'  # Don't create a separate metric for each worksheet
+        elif not path in ('/run', '/metrics', '/worksheets'):
+            path = 'other'
+
+        status = 500
+        try:
+            status = self.__handle()
+        finally:
+            self.server.metrics.record_request(path, status, time.time() - start)
+
+    do_GET = __handle_and_record
+    do_HEAD = __handle_and_record
+    do_POST = __handle_and_record
+
+def main(argv=None):
+    """Run the reinteract-serve command. Returns the exit status."""
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = OptionParser(usage="%prog [options] NOTEBOOK_FOLDER",
+                          description="Run the worksheets of a Reinteract notebook over HTTP")
+    parser.add_option("-a", "--address", default="127.0.0.1",
+                      help="address to listen on (default: 127.0.0.1, only local connections)")
+    parser.add_option("-p", "--port", type="int", default=DEFAULT_PORT,
+                      help="port to listen on (default: %d)" % DEFAULT_PORT)
+    parser.add_option("-j", "--jobs", type="int", default=None,
+                      help="number of worker processes (default: number of CPUs)")
+    parser.add_option("-q", "--queue-size", type="int", default=16,
+                      help="number of requests that can wait for a worker before requests are rejected (default: 16)")
+    parser.add_option("-c", "--cache-size", type="int", default=100,
+                      help="number of results to cache (default: 100)")
+    parser.add_option("-t", "--timeout", type="float", default=300.,
+                      help="maximum time in seconds to run a worksheet (default: 300)")
+    parser.add_option("-d", "--debug", action="store_true", default=False,
+                      help="enable internal debug messages")
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("A single notebook folder must be specified")
+    if not os.path.isdir(args[0]):
+        parser.error("%s is not a directory" % args[0])
+    if json is None:
+        parser.error("reinteract-serve requires the json or simplejson module")
+
+    if options.debug:
+        logging.basicConfig(level=logging.DEBUG, format="DEBUG: %(message)s")
+
+    server = Server(args[0], (options.address, options.port),
+                    n_processes=options.jobs, max_queue=options.queue_size,
+                    cache_size=options.cache_size, run_timeout=options.timeout)
+    print >>sys.stderr, "Serving %s on http://%s:%d/" % (server.folder, options.address, server.server_address[1])
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+
+    return 0
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+    import urllib2
+
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "serve")
+    server = None
+    try:
+        def write_file(name, contents):
+            absname = os.path.join(base, name)
+            dirname = os.path.dirname(absname)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            f = open(absname, "w")
+            f.write(contents)
+            f.close()
+
+        write_file("index.rnb", "[Notebook]\n")
+        write_file("lib.py", "def double(x):\n    return 2 * x\n")
+        write_file("double.rws", "import lib\nn = 1\nlib.double(n)\n")
+        write_file("slow.rws", "import time\ntime.sleep(delay)\n")
+        write_file("bad.rws", "1/0\n")
+        write_file("exit.rws", "import os\nos._exit(3)\n")
+
+        # Only the local machine is used, and the port is picked by the system
+        server = Server(base, ('127.0.0.1', 0), n_processes=1, max_queue=0, run_timeout=2)
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.setDaemon(True)
+        server_thread.start()
+
+        def request(path, body=None):
+            try:
+                response = urllib2.urlopen(url + path, body)
+                status = response.code
+            except urllib2.HTTPError, e:
+                response = e
+                status = e.code
+            data = response.read()
+            if response.info().gettype() == "application/json":
+                data = json.loads(data)
+            return status, data
+
+        assert_equals(request("/worksheets"), (200, ["bad.rws", "double.rws", "exit.rws", "slow.rws"]))
+
+        status, record = request("/run/double.rws")
+        assert_equals((status, record['file'], record['cached']), (200, "double.rws", False))
+        assert_equals([s['results'] for s in record['statements']], [[], [], ['2']])
+
+        status, record = request("/run", json.dumps({ 'worksheet': "double.rws", 'parameters': { 'n': 21 } }))
+        assert_equals((record['statements'][2]['results'], record['cached']), (['42'], False))
+        status, record = request("/run/double.rws?n=21")
+        assert_equals((record['statements'][2]['results'], record['cached']), (['42'], True))
+        status, record = request("/run/double.rws?n=%22a%22")
+        assert_equals(record['statements'][2]['results'], ["u'aa'"])
+
+        status, record = request("/run/bad.rws")
+        assert_equals((status, record['errors']), (200, 1))
+
+        assert_equals(request("/run/missing.rws")[0], 404)
+        assert_equals(request("/run/../serve.rws")[0], 404)
+        assert_equals(request("/run", "{")[0], 400)
+        assert_equals(request("/run/double.rws?1=2")[0], 400)
+
+        # With one worker and no queue, a second request while the worker is busy is rejected
+        slow_thread = threading.Thread(target=request, args=("/run/slow.rws?delay=1",))
+        slow_thread.start()
+        while server.get_running() == 0:
+            time.sleep(0.01)
+        status, record = request("/run/slow.rws?delay=0")
+        assert_equals((status, record['error']), (503, "Too many requests"))
+        slow_thread.join()
+
+        # A worker process that dies or takes too long is replaced, and the next request works
+        status, record = request("/run/exit.rws")
+        assert_equals((status, record['error']), (500, "The worker process running 'exit.rws' exited"))
+        status, record = request("/run/slow.rws?delay=10")
+        assert_equals((status, record['error']), (504, "Running 'slow.rws' took too long"))
+        assert_equals(server.get_running(), 0)
+        status, record = request("/run/double.rws?n=2")
+        assert_equals((status, record['statements'][2]['results']), (200, ['4']))
+
+        status, metrics = request("/metrics")
+        assert_equals(status, 200)
+        metrics = dict(line.rsplit(" ", 1) for line in metrics.split("\n") if line and not line.startswith("#"))
+        assert_equals(metrics['reinteract_cache_hits_total'], '1')
+        assert_equals(metrics['reinteract_cache_misses_total'], '9')
+        assert_equals(metrics['reinteract_rejected_total'], '1')
+        assert_equals(metrics['reinteract_failed_total'], '2')
+        assert_equals(metrics['reinteract_queue_depth'], '0')
+        assert_equals(metrics['reinteract_requests_total{path="/run",code="503"}'], '1')
+        assert_equals(metrics['reinteract_request_duration_seconds_count'], '15')
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(base)
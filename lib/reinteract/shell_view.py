@@ -14,11 +14,21 @@ from chunks import StatementChunk, CommentChunk, BlankChunk
 from completion_popup import CompletionPopup
 from doc_popup import DocPopup
 from global_settings import global_settings
+from lookup_thread import LookupThread
 from notebook import NotebookFile
 import sanitize_textview_ipc
+from statement_timing import format_duration, format_history
+from tokenized_statement import resolve_names
 
 LEFT_MARGIN_WIDTH = 10
 
+# Space on either side of the execution times shown in the right margin
+TIMING_PADDING = 4
+# A statement is highlighted as slower if its last execution took this much longer
+# than the execution before, and at least TIMING_MIN_SLOWER seconds longer
+TIMING_SLOWER_RATIO = 1.5
+TIMING_MIN_SLOWER = 0.01
+
 ALL_WHITESPACE_RE = re.compile("^\s*$")
 
 class ShellView(gtk.TextView):
@@ -34,17 +44,22 @@ class ShellView(gtk.TextView):
         'motion-notify-event': 'override',
         'realize': 'override',
         'unrealize': 'override',
-        'size-allocate': 'override'
+        'size-allocate': 'override',
+        'style-set': 'override'
    }
         
     def __init__(self, buf):
         self.edit_only = buf.worksheet.edit_only
 
+        self.__show_timings = False
+        self.__timing_margin_width = 0
+
         if not self.edit_only:
             buf.worksheet.connect('chunk-inserted', self.on_chunk_inserted)
             buf.worksheet.connect('chunk-changed', self.on_chunk_changed)
             buf.worksheet.connect('chunk-status-changed', self.on_chunk_status_changed)
             buf.worksheet.connect('notify::state', self.on_notify_state)
+            buf.worksheet.connect('notify::auto-calculate', self.on_notify_state)
 
             # Track changes to update completion
             buf.connect_after('insert-text', self.on_after_insert_text)
@@ -72,13 +87,25 @@ class ShellView(gtk.TextView):
         self.__doc_popup = DocPopup()
         self.__mouse_over_object = None
         self.__mouse_over_timeout = None
+        self.__mouse_over_names = None
 
         self.__mouse_over_start = buf.create_mark(None, buf.get_start_iter(), True)
+        self.__doc_popup_start = buf.create_mark(None, buf.get_start_iter(), True)
+
+        # Resolving the names under the mouse or the cursor to objects calls into
+        # user code, so we do it in helper threads
+        self.__mouse_over_lookup = LookupThread()
+        self.__doc_popup_lookup = LookupThread()
 
         self.__arg_highlight_start = None
         self.__arg_highlight_end = None
         buf.connect('mark-set', self.on_mark_set)
 
+        # The history of the timings of a statement is shown as a tooltip on the margins
+        if not self.edit_only and hasattr(self, 'set_has_tooltip'): # GTK+ >= 2.12
+            self.set_has_tooltip(True)
+            self.connect('query-tooltip', self.on_query_tooltip)
+
     def __get_worksheet_line_yrange(self, line):
         buffer_line = self.get_buffer().pos_to_iter(line)
         return self.get_line_yrange(buffer_line)
@@ -130,7 +157,7 @@ class ShellView(gtk.TextView):
         self.__watch_window.set_cursor(gtk.gdk.Cursor(gtk.gdk.WATCH))
         self.__watch_window.set_user_data(self)
 
-        if self.get_buffer().worksheet.state == NotebookFile.EXECUTING:
+        if self.__show_watch_window(self.get_buffer().worksheet):
             self.__watch_window.show()
             self.__watch_window.raise_()
 
@@ -169,6 +196,58 @@ class ShellView(gtk.TextView):
                 else:
                     self.paint_chunk(cr, event.area, chunk, (0, 0, 1), (0, 0, 0.5))
 
+    def __expose_window_right(self, event):
+        (_, start_y) = self.window_to_buffer_coords(gtk.TEXT_WINDOW_RIGHT, 0, event.area.y)
+        start_line = self.__get_worksheet_line_at_y(start_y, adjust=ADJUST_AFTER)
+
+        (_, end_y) = self.window_to_buffer_coords(gtk.TEXT_WINDOW_RIGHT, 0, event.area.y + event.area.height - 1)
+        end_line = self.__get_worksheet_line_at_y(end_y, adjust=ADJUST_BEFORE)
+
+        buf = self.get_buffer()
+
+        cr = event.window.cairo_create()
+
+        for chunk in buf.worksheet.iterate_chunks(start_line, end_line + 1):
+            if not isinstance(chunk, StatementChunk) or len(chunk.timings) == 0:
+                continue
+
+            timing = chunk.timings[-1]
+            if chunk.needs_compile or chunk.needs_execute:
+                # Out of date
+                color = (0.7, 0.7, 0.7)
+            elif (len(chunk.timings) > 1 and
+                  timing.wall_time > TIMING_SLOWER_RATIO * chunk.timings[-2].wall_time and
+                  timing.wall_time > chunk.timings[-2].wall_time + TIMING_MIN_SLOWER):
+                color = (0.8, 0, 0)
+            else:
+                color = (0.3, 0.3, 0.3)
+
+            layout = self.create_pango_layout(format_duration(timing.wall_time))
+            width, _ = layout.get_pixel_size()
+
+            (y, _) = self.__get_worksheet_line_yrange(chunk.start)
+            (_, window_y) = self.buffer_to_window_coords(gtk.TEXT_WINDOW_RIGHT, 0, y)
+
+            cr.move_to(self.__timing_margin_width - TIMING_PADDING - width, window_y)
+            cr.set_source_rgb(*color)
+            cr.show_layout(layout)
+
+    def __update_timing_margin(self):
+        if self.__show_timings:
+            # Wide enough for the longest times format_duration() normally returns
+            layout = self.create_pango_layout(u"00m00s")
+            width, _ = layout.get_pixel_size()
+            self.__timing_margin_width = width + 2 * TIMING_PADDING
+        else:
+            self.__timing_margin_width = 0
+
+        self.set_border_window_size(gtk.TEXT_WINDOW_RIGHT, self.__timing_margin_width)
+
+    def do_style_set(self, previous_style):
+        gtk.TextView.do_style_set(self, previous_style)
+        if self.__show_timings:
+            self.__update_timing_margin()
+
     def __draw_rect_outline(self, event, rect):
         if (rect.y + rect.height <= event.area.y or rect.y >= event.area.y + event.area.height):
             return
@@ -215,6 +294,10 @@ class ShellView(gtk.TextView):
         if not self.edit_only and event.window == self.get_window(gtk.TEXT_WINDOW_LEFT):
             self.__expose_window_left(event)
             return False
+
+        if self.__show_timings and event.window == self.get_window(gtk.TEXT_WINDOW_RIGHT):
+            self.__expose_window_right(event)
+            return False
         
         gtk.TextView.do_expose_event(self, event)
 
@@ -544,7 +627,19 @@ class ShellView(gtk.TextView):
             self.__mouse_over_timeout = None
             
         self.__mouse_over_object = None
-        
+
+    def __set_mouse_over_object(self, obj):
+        if not obj is self.__mouse_over_object:
+            self.__stop_mouse_over()
+            self.__doc_popup.popdown()
+            if obj is not None:
+                self.__mouse_over_object = obj
+                try:
+                    timeout = self.get_settings().get_property('gtk-tooltip-timeout')
+                except TypeError: # GTK+ < 2.12
+                    timeout = 500
+                self.__mouse_over_timeout = gobject.timeout_add(timeout, self.__show_mouse_over)
+
     def do_motion_notify_event(self, event):
         # Successful mousing-over depends on knowing the types of symbols so doing the
         # checks are pointless in edit-only mode
@@ -555,27 +650,33 @@ class ShellView(gtk.TextView):
             iter, _ = self.get_iter_at_position(x, y)
             line, offset = buf.iter_to_pos(iter, adjust=ADJUST_NONE)
             if line is not None:
-                obj, start_line, start_offset, _,_ = buf.worksheet.get_object_at_location(line, offset)
+                names, scope, start_line, start_offset, _, _ = buf.worksheet.get_names_at_location(line, offset)
             else:
-                obj = None
+                names = None
+
+            if names is None:
+                self.__mouse_over_names = None
+                self.__mouse_over_lookup.cancel()
+                self.__set_mouse_over_object(None)
+            else:
+                # Motion events are frequent; only start a new lookup when the
+                # mouse moves onto a different name
+                key = (id(scope), names, start_line, start_offset)
+                if key != self.__mouse_over_names:
+                    self.__mouse_over_names = key
+                    self.__set_mouse_over_object(None)
 
-            if not obj is self.__mouse_over_object:
-                self.__stop_mouse_over()
-                self.__doc_popup.popdown()
-                if obj is not None:
                     start = buf.pos_to_iter(start_line, start_offset)
                     buf.move_mark(self.__mouse_over_start, start)
 
-                    self.__mouse_over_object = obj
-                    try:
-                        timeout = self.get_settings().get_property('gtk-tooltip-timeout')
-                    except TypeError: # GTK+ < 2.12
-                        timeout = 500
-                    self.__mouse_over_timeout = gobject.timeout_add(timeout, self.__show_mouse_over)
+                    self.__mouse_over_lookup.lookup(lambda: resolve_names(names, scope),
+                                                    self.__set_mouse_over_object)
                 
         return gtk.TextView.do_motion_notify_event(self, event)
 
     def do_leave_notify_event(self, event):
+        self.__mouse_over_names = None
+        self.__mouse_over_lookup.cancel()
         self.__stop_mouse_over()
         if not self.__doc_popup.focused:
             self.__doc_popup.popdown()
@@ -610,6 +711,10 @@ class ShellView(gtk.TextView):
             left_margin_window.invalidate_rect((0, window_y, LEFT_MARGIN_WIDTH, end_y + end_height - start_y),
                                                False)
 
+            if self.__show_timings:
+                right_margin_window = self.get_window(gtk.TEXT_WINDOW_RIGHT)
+                right_margin_window.invalidate_rect((0, window_y, self.__timing_margin_width, start_height), False)
+
     def on_chunk_inserted(self, worksheet, chunk):
         self.__invalidate_status(chunk)
 
@@ -619,9 +724,36 @@ class ShellView(gtk.TextView):
     def on_chunk_status_changed(self, worksheet, chunk):
         self.__invalidate_status(chunk)
 
+    def __show_watch_window(self, worksheet):
+        # When calculating automatically, the user keeps editing during calculation
+        return ((worksheet.state == NotebookFile.EXECUTING or worksheet.state == NotebookFile.QUEUED) and
+                not worksheet.auto_calculate)
+
+    def on_query_tooltip(self, view, x, y, keyboard_mode, tooltip):
+        if keyboard_mode:
+            return False
+
+        # Only over the margins; the text area has the documentation popup
+        if not (x < LEFT_MARGIN_WIDTH or
+                (self.__show_timings and x >= self.allocation.width - self.__timing_margin_width)):
+            return False
+
+        buf = self.get_buffer()
+        (_, buffer_y) = self.window_to_buffer_coords(gtk.TEXT_WINDOW_WIDGET, x, y)
+        line = self.__get_worksheet_line_at_y(buffer_y, adjust=ADJUST_BEFORE)
+        if line is None:
+            return False
+
+        chunk = buf.worksheet.get_chunk(line)
+        if not isinstance(chunk, StatementChunk) or len(chunk.timings) == 0:
+            return False
+
+        tooltip.set_text(format_history(chunk.timings))
+        return True
+
     def on_notify_state(self, worksheet, param_spec):
         if (self.flags() & gtk.REALIZED) != 0:
-            if worksheet.state == NotebookFile.EXECUTING:
+            if self.__show_watch_window(worksheet):
                 self.__watch_window.show()
                 self.__watch_window.raise_()
             else:
@@ -675,10 +807,23 @@ class ShellView(gtk.TextView):
         if new_position:
             self.__invalidate_char_position(new_position)
 
-    def calculate(self):
+    def set_show_timings(self, show_timings):
+        """Set whether to show how long each statement took to execute in the right margin"""
+
+        if self.edit_only or show_timings == self.__show_timings:
+            return
+
+        self.__show_timings = show_timings
+        self.__update_timing_margin()
+
+    def calculate(self, up_to_cursor=False):
         buf = self.get_buffer()
 
-        buf.worksheet.calculate()
+        if up_to_cursor:
+            line, _ = buf.iter_to_pos(buf.get_iter_at_mark(buf.get_insert()))
+            buf.worksheet.calculate(up_to_line=line)
+        else:
+            buf.worksheet.calculate()
 
         # This is a hack to work around the fact that scroll_mark_onscreen()
         # doesn't wait for a size-allocate cycle, so doesn't properly handle
@@ -716,12 +861,23 @@ class ShellView(gtk.TextView):
         insert = buf.get_iter_at_mark(buf.get_insert())
         line, offset = buf.iter_to_pos(insert, adjust=ADJUST_NONE)
         if line is not None:
-            obj, start_line, start_offset, _, _ = buf.worksheet.get_object_at_location(line, offset, include_adjacent=True)
+            names, scope, start_line, start_offset, _, _ = buf.worksheet.get_names_at_location(line, offset, include_adjacent=True)
         else:
-            obj = None
+            names = None
+
+        if names is None:
+            self.__doc_popup_lookup.cancel()
+            return
+
+        # The buffer may be edited before we get the result, so we
+        # remember the position with a mark
+        buf.move_mark(self.__doc_popup_start, buf.pos_to_iter(start_line, start_offset))
 
-        if obj is not None:
-            start = buf.pos_to_iter(start_line, start_offset)
+        def on_result(obj):
+            if obj is None:
+                return
+
+            start = buf.get_iter_at_mark(self.__doc_popup_start)
             self.__stop_mouse_over()
             self.__doc_popup.set_target(obj)
             self.__doc_popup.position_at_location(self, start)
@@ -730,6 +886,8 @@ class ShellView(gtk.TextView):
             else:
                 self.__doc_popup.popup()
 
+        self.__doc_popup_lookup.lookup(lambda: resolve_names(names, scope), on_result)
+
     def highlight_arg_region(self, start, end):
         """Highlight the region between start and end for argument insertion.
         A box will be drawn around the region as long as the cursor is inside
@@ -0,0 +1,229 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# The worksheet and notebook model need signals and properties with change
+# notification. They get them from this module rather than from gobject, so
+# that they can be used without gobject and GTK+ (by reinteract-run, for
+# example.) Main loop callbacks come from main_loop.py for the same reason.
+#
+# SignalObject and Property follow the GObject API (connect(), emit(),
+# 'notify::<property>' and so forth), so user interface code can connect
+# to model objects exactly as if they were GObjects. Only the parts of that
+# API that the model needs are implemented.
+#
+
+class Property(object):
+    """
+    A property of a SignalObject. Setting the property emits 'notify::<name>'
+    on the object, where <name> is the attribute name with _ replaced by -.
+    Can be used as a decorator for a read-only property. Modelled after
+    gobject.property.
+    """
+
+    def __init__(self, getter=None, setter=None, type=None, default=None):
+        self.getter = getter
+        self.setter = setter
+        self.type = type
+        self.default = default
+        self.name = None # set by _SignalObjectMeta
+
+    def __get__(self, obj, klass=None):
+        if obj is None:
+            return self
+        if self.getter is not None:
+            return self.getter(obj)
+
+        return obj._property_values.get(self.name, self.default)
+
+    def __set__(self, obj, value):
+        if self.setter is not None:
+            self.setter(obj, value)
+        elif self.getter is not None:
+            raise AttributeError("property '%s' is read-only" % self.name)
+        else:
+            obj._property_values[self.name] = value
+
+        obj.notify(self.name)
+
+class _SignalObjectMeta(type):
+    def __init__(cls, name, bases, dict):
+        super(_SignalObjectMeta, cls).__init__(name, bases, dict)
+
+        signals = set()
+        for base in bases:
+            signals.update(getattr(base, '_all_signals', ()))
+        signals.update(dict.get('__signals__', ()))
+        cls._all_signals = frozenset(signals)
+
+        for attr, value in dict.iteritems():
+            if isinstance(value, Property):
+                value.name = attr.replace('_', '-')
+
+class _Handler(object):
+    def __init__(self, handler_id, callback, extra_args):
+        self.handler_id = handler_id
+        self.callback = callback
+        self.extra_args = extra_args
+
+class SignalObject(object):
+    """
+    Base class for objects with signals and properties.
+
+    Subclasses list the signals they emit in a __signals__ dictionary mapping
+    the signal name to a tuple with the types of the signal arguments (the
+    types are documentation only). Handlers are called as
+    handler(object, *signal_args, *extra_args) where extra_args are the
+    additional arguments passed to connect().
+
+    Every object also has a 'notify::<property>' signal for each L{Property}.
+    """
+
+    __metaclass__ = _SignalObjectMeta
+
+    def __init__(self):
+        self._property_values = {}
+        self.__handlers = {}    # signal name => list of _Handler
+        self.__next_handler_id = 1
+        self.__notify_freeze_count = 0
+        self.__pending_notifies = []
+
+    def __check_signal(self, signal):
+        if signal.startswith('notify::'):
+            name = signal[8:].replace('_', '-')
+            prop = getattr(type(self), name.replace('-', '_'), None)
+            if not isinstance(prop, Property):
+                raise TypeError("%s: unknown property name '%s'" % (type(self).__name__, name))
+            return 'notify::' + name
+        elif signal in self._all_signals:
+            return signal
+        else:
+            raise TypeError("%s: unknown signal name: %s" % (type(self).__name__, signal))
+
+    def connect(self, signal, callback, *extra_args):
+        """Connect a handler to a signal; returns an ID for the connection"""
+
+        signal = self.__check_signal(signal)
+
+        handler = _Handler(self.__next_handler_id, callback, extra_args)
+        self.__next_handler_id += 1
+        # Copy on write, so that emission isn't affected by connecting and disconnecting
+        self.__handlers[signal] = self.__handlers.get(signal, []) + [handler]
+
+        return handler.handler_id
+
+    def __find_handler(self, handler_id):
+        for signal, handlers in self.__handlers.iteritems():
+            for handler in handlers:
+                if handler.handler_id == handler_id:
+                    return signal, handler
+
+        raise ValueError("No handler with ID %d" % handler_id)
+
+    def disconnect(self, handler_id):
+        """Disconnect the handler with the ID returned from connect()"""
+
+        signal, handler = self.__find_handler(handler_id)
+        self.__handlers[signal] = [h for h in self.__handlers[signal] if h is not handler]
+
+    def emit(self, signal, *args):
+        """Call the handlers connected to a signal"""
+
+        signal = self.__check_signal(signal)
+        for handler in self.__handlers.get(signal, ()):
+            handler.callback(self, *(args + handler.extra_args))
+
+    def notify(self, property_name):
+        """Emit the notify signal for a property"""
+
+        property_name = property_name.replace('_', '-')
+        if self.__notify_freeze_count > 0:
+            if not property_name in self.__pending_notifies:
+                self.__pending_notifies.append(property_name)
+        else:
+            self.emit('notify::' + property_name, getattr(type(self), property_name.replace('-', '_')))
+
+    def freeze_notify(self):
+        """Queue property notifications until the matching thaw_notify()"""
+
+        self.__notify_freeze_count += 1
+
+    def thaw_notify(self):
+        self.__notify_freeze_count -= 1
+        if self.__notify_freeze_count == 0:
+            pending = self.__pending_notifies
+            self.__pending_notifies = []
+            for property_name in pending:
+                self.notify(property_name)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from test_utils import assert_equals
+
+    class A(SignalObject):
+        __signals__ = {
+            'changed': (int,)
+        }
+
+        def __init__(self):
+            SignalObject.__init__(self)
+            self.__name = None
+
+        def __get_name(self):
+            return self.__name
+
+        def __set_name(self, name):
+            self.__name = name
+
+        name = Property(getter=__get_name, setter=__set_name, type=str)
+        some_value = Property(type=int, default=1)
+
+        @Property
+        def upper_name(self):
+            return self.__name.upper()
+
+    class B(A):
+        __signals__ = {
+            'other': ()
+        }
+
+    events = []
+    b = B()
+    handler_id = b.connect('changed', lambda obj, value, extra: events.append((value, extra)), 'extra')
+    b.connect('notify::some-value', lambda obj, pspec: events.append(('some-value', obj.some_value)))
+    b.connect('notify::name', lambda obj, pspec: events.append(('name', obj.name)))
+    b.connect('other', lambda obj: events.append('other'))
+    b.emit('changed', 1)
+    b.emit('other')
+    assert_equals(b.some_value, 1)
+    b.some_value = 2
+    b.name = 'b'
+    assert_equals(b.upper_name, 'B')
+    assert_equals(events, [(1, 'extra'), 'other', ('some-value', 2), ('name', 'b')])
+
+    del events[:]
+    b.disconnect(handler_id)
+    b.emit('changed', 3)
+    b.freeze_notify()
+    b.name = 'c'
+    b.name = 'd'
+    assert_equals(events, [])
+    b.thaw_notify()
+    assert_equals(events, [('name', 'd')])
+
+    try:
+        b.connect('nonexistent', lambda obj: None)
+        raise AssertionError("Connecting to an unknown signal should fail")
+    except TypeError:
+        pass
+    try:
+        b.upper_name = 'x'
+        raise AssertionError("Setting a read-only property should fail")
+    except AttributeError:
+        pass
@@ -8,16 +8,38 @@
 
 import copy
 import pkgutil
+import re
+import tokenize
 import traceback
 import sys
+import time
+from cStringIO import StringIO
 
+from code_swap import get_code_names
 from custom_result import CustomResult
+import memo_cache
 import notebook
 from notebook import HelpResult
 from rewrite import Rewriter, UnsupportedSyntaxError
 import reunicode
+from statement_timing import get_usage
 from stdout_capture import StdoutCapture
 
+_CACHE_PRAGMA_RE = re.compile(r'^#\s*@cache\s*$')
+
+def _has_cache_pragma(text):
+    # Check for a '#@cache' comment in the statement
+    if isinstance(text, unicode):
+        text = text.encode("utf8")
+    try:
+        for token in tokenize.generate_tokens(StringIO(text).readline):
+            if token[0] == tokenize.COMMENT and _CACHE_PRAGMA_RE.match(token[1]):
+                return True
+    except (tokenize.TokenError, IndentationError):
+        pass
+
+    return False
+
 class WarningResult(object):
     def __init__(self, message):
         self.message = message
@@ -49,11 +71,29 @@ class Statement:
         self.imports = None
         #: names imported from __future__. Used when compiling subsequent statements
         self.future_features = None
+        #: global and attribute names referenced by the statement. Set after compilation.
+        self.referenced_names = None
 
         #: scope at the end of successful execution
         self.result_scope = None
         #: list of results from the statement. Set after successful execution
         self.results = None
+        #: time taken to compile the statement, in seconds
+        self.compile_time = None
+        #: time taken by the last execution of the statement, in seconds
+        self.execution_time = None
+        #: CPU time used by the last execution of the statement, in seconds, or None if unknown
+        self.cpu_time = None
+        #: increase of the peak memory use of the process during the last execution
+        #: of the statement, in bytes, or None if unknown. See L{StatementTiming}
+        self.peak_rss_delta = None
+        #: time at which the last execution finished, in seconds since the epoch
+        self.finish_time = None
+        #: whether the statement has a '#@cache' comment. Set after compilation. See L{StatementCache}
+        self.cache_pragma = False
+        #: True if the last execution bound the names of the statement from the L{StatementCache}
+        #: rather than executing the statement
+        self.cache_hit = False
 
         #: error_message: error message in case of compilation or execution error
         self.error_message = None
@@ -69,6 +109,9 @@ class Statement:
 
         self.__stdout_buffer = None
         self.__capture = None
+        self.__start_time = None
+        self.__start_cpu_time = None
+        self.__start_maxrss = None
 
     def set_parent(self, parent):
         """Set the parent statement for this statement.
@@ -102,11 +145,14 @@ class Statement:
         self.error_line = None
         self.error_offset = None
 
+        start_time = time.time()
         try:
             rewriter = Rewriter(self.__text, future_features=self.__parent_future_features)
             self.imports = rewriter.get_imports()
             self.__compiled, self.__mutated = rewriter.rewrite_and_compile(output_func_name='reinteract_output',
                                                                            copy_func_name="__reinteract_copy")
+            self.referenced_names = get_code_names(self.__compiled)
+            self.cache_pragma = _has_cache_pragma(self.__text)
         except SyntaxError, e:
             self.error_message = e.msg
             self.error_line = e.lineno
@@ -121,6 +167,8 @@ class Statement:
             self.error_message = e.value
             self.state = Statement.COMPILE_ERROR
             return False
+        finally:
+            self.compile_time = time.time() - start_time
 
         self.future_features = self.__parent_future_features
         if self.imports is not None:
@@ -208,6 +256,8 @@ class Statement:
         self.__worksheet.global_scope['__reinteract_statement'] = self
         self.__capture = StdoutCapture(self.__stdout_write)
         self.__capture.push()
+        self.__start_cpu_time, self.__start_maxrss = get_usage()
+        self.__start_time = time.time()
 
     def after_execute(self):
         """Do cleanup tasks after execution
@@ -216,6 +266,13 @@ class Statement:
 
         """
 
+        self.finish_time = time.time()
+        self.execution_time = self.finish_time - self.__start_time
+        cpu_time, maxrss = get_usage()
+        if cpu_time is not None:
+            self.cpu_time = cpu_time - self.__start_cpu_time
+            self.peak_rss_delta = maxrss - self.__start_maxrss
+
         if self.state == Statement.EXECUTING:
             self.state = Statement.INTERRUPTED
             self.results = None
@@ -246,16 +303,40 @@ class Statement:
 
         return (formatted + last_line).rstrip()
 
+    def __restore_from_cache(self, statement_cache, key, scope):
+        entry = statement_cache.lookup(key)
+        if entry is None:
+            return False
+
+        bound, deleted, results = entry
+        for name in deleted:
+            scope.pop(name, None)
+        scope.update(bound)
+        self.results = list(results)
+        self.cache_hit = True
+        self.state = Statement.EXECUTE_SUCCESS
+
+        return True
+
     def __do_execute(self):
         root_scope = self.__worksheet.global_scope
         if self.__parent:
-            scope = copy.copy(self.__parent.result_scope)
+            parent_scope = self.__parent.result_scope
         else:
-            scope = copy.copy(root_scope)
+            parent_scope = root_scope
+        scope = copy.copy(parent_scope)
 
         self.results = []
         self.result_scope = scope
         self.__stdout_buffer = None
+        self.cache_hit = False
+
+        cache_key = None
+        if self.cache_pragma:
+            statement_cache = self.__worksheet.notebook.get_statement_cache()
+            cache_key = statement_cache.make_key(self.__text, scope, self.referenced_names)
+            if cache_key is not None and self.__restore_from_cache(statement_cache, cache_key, scope):
+                return True
 
         for root, description, copy_code in self.__mutated:
             try:
@@ -267,10 +348,16 @@ class Statement:
                 self.results.append(WarningResult("'%s' apparently modified, but can't copy it" % description))
 
         try:
-            exec self.__compiled in scope, scope
+            memo_cache.set_scope_executing(scope, True)
+            try:
+                exec self.__compiled in scope, scope
+            finally:
+                memo_cache.set_scope_executing(scope, False)
             if self.__stdout_buffer is not None and self.__stdout_buffer != '':
                 self.results.append(self.__stdout_buffer)
             self.state = Statement.EXECUTE_SUCCESS
+            if cache_key is not None:
+                statement_cache.store(cache_key, parent_scope, scope, self.results)
         except KeyboardInterrupt, e:
             raise e
         except:
@@ -297,6 +384,23 @@ class Statement:
             if not was_in_execute:
                 self.after_execute()
 
+    def restore(self, result_scope):
+        """Set the result scope of a compiled statement without executing it
+
+        This is used when the result scope was saved from a previous execution
+        of the statement; see L{CheckpointStore}. The statement has no results.
+
+        """
+
+        assert self.state != Statement.NEW and self.state != Statement.COMPILE_ERROR
+
+        self.result_scope = result_scope
+        self.results = []
+        self.execution_time = None
+        self.cpu_time = None
+        self.peak_rss_delta = None
+        self.state = Statement.EXECUTE_SUCCESS
+
     def mark_for_execute(self):
         """Mark a statement that executed succesfully as needing execution again"""
         if self.state != Statement.NEW and self.state != Statement.COMPILE_ERROR:
@@ -351,6 +455,16 @@ if __name__=='__main__':
     s2a.execute()
     assert_equals(s2a.results[0], "0")
 
+    # Tests of timing
+    s1 = Statement("x = 0\nfor i in xrange(100000): x += i", worksheet)
+    s1.compile()
+    s1.execute()
+    assert s1.compile_time >= 0
+    assert s1.execution_time > 0
+    if s1.cpu_time is not None:
+        assert s1.cpu_time > 0
+        assert s1.peak_rss_delta >= 0
+
     # Tests of catching errors
     s1 = Statement("b = ", worksheet)
     assert_equals(s1.compile(), False)
@@ -371,3 +485,48 @@ if __name__=='__main__':
 
     s1 = Statement("import  __future__", worksheet) # just a normal import
     assert_equals(s1.future_features, None)
+
+    # Statements with a #@cache comment are restored from the statement cache
+    # when the names they reference have the same values
+    s1 = Statement("a = [1, 2]", worksheet)
+    s1.compile()
+    s1.execute()
+    s2 = Statement("b = a + [3] #@cache\nb", worksheet, parent=s1)
+    s2.compile()
+    assert s2.cache_pragma
+    s2.execute()
+    assert not s2.cache_hit
+    s1.execute()
+    s2.execute()
+    assert s2.cache_hit
+    assert_equals(s2.results, ['[1, 2, 3]'])
+    assert_equals(s2.result_scope['b'], [1, 2, 3])
+    s1 = Statement("a = [2]", worksheet)
+    s1.compile()
+    s1.execute()
+    s2.set_parent(s1)
+    s2.execute()
+    assert not s2.cache_hit
+    assert_equals(s2.results, ['[2, 3]'])
+
+    # The key includes the worksheet globals read by functions and classes the
+    # statement references, and the globals that those read in turn
+    def cached_result(k):
+        s1 = Statement("k = %d" % k, worksheet)
+        s1.compile()
+        s1.execute()
+        s2 = Statement("def f(): return k\nclass A(object):\n    def g(self): return f()", worksheet, parent=s1)
+        s2.compile()
+        s2.execute()
+        s3 = Statement("y = A().g() #@cache\ny", worksheet, parent=s2)
+        s3.compile()
+        s3.execute()
+        return s3.cache_hit, s3.results
+
+    assert_equals(cached_result(1), (False, ['1']))
+    assert_equals(cached_result(1), (True, ['1']))
+    assert_equals(cached_result(2), (False, ['2']))
+
+    s1 = Statement("b = '#@cache'", worksheet)
+    s1.compile()
+    assert not s1.cache_pragma
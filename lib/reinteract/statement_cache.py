@@ -0,0 +1,200 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import hashlib
+import logging
+import threading
+
+from memo_cache import hash_contents, is_internal_name
+
+_debug = logging.getLogger("StatementCache").debug
+
+class StatementCache(object):
+
+    """
+    Cache of the effects of executing statements marked with a #@cache comment.
+
+    When a statement with the pragma is executed, the names that it binds and
+    its results are stored, keyed by a hash of the text of the statement and
+    of the values of the global names that the statement references (see
+    L{make_key}); functions and classes defined in the worksheet are hashed
+    along with the values of the global names that they read. When the statement is executed again with the same inputs -
+    typically because a statement before it was edited without changing
+    anything the statement uses - the names are bound from the cache instead.
+
+    The most recently used entries are kept in memory. If a spill store is
+    given, entries removed from memory are pickled into it (when possible),
+    and looked up there when they aren't found in memory.
+    """
+
+    def __init__(self, max_entries=32, spill=None):
+        """
+        @param max_entries: maximum number of entries to keep in memory
+        @param spill: a L{MemoCache} to store entries removed from memory in, or None
+
+        """
+
+        self.max_entries = max_entries
+        self.spill = spill
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+        self.__entries = {} # key => [serial, entry]
+        self.__serial = 0
+
+    @staticmethod
+    def make_key(text, scope, names):
+        """Compute the key for an execution of a statement
+
+        @param text: the text of the statement
+        @param scope: the scope the statement is executed in
+        @param names: the global names referenced by the statement (see
+           L{Statement.referenced_names}); names not in scope are ignored
+        @returns: the key, or None if a value can't be hashed by its contents
+
+        """
+
+        h = hashlib.sha1()
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+        h.update(text)
+        h.update("\0")
+
+        for name in sorted(names):
+            if name in scope and not is_internal_name(name):
+                h.update(name)
+                h.update("\0")
+                try:
+                    hash_contents(h, scope[name])
+                except ValueError, e:
+                    _debug("Can't hash %s: %s", name, e)
+                    return None
+
+        return h.hexdigest()
+
+    def lookup(self, key):
+        """Look up the effects of a statement
+
+        @returns: a tuple of (bound, deleted, results) or None. bound is a
+           dictionary of the names the statement bound to their values,
+           deleted a list of names that the statement deleted, and results
+           the results of the statement.
+
+        """
+
+        self.__lock.acquire()
+        try:
+            if key in self.__entries:
+                self.hits += 1
+                self.__serial += 1
+                self.__entries[key][0] = self.__serial
+                return self.__entries[key][1]
+        finally:
+            self.__lock.release()
+
+        if self.spill is not None:
+            found, entry = self.spill.lookup(key)
+            if found:
+                self.__lock.acquire()
+                try:
+                    self.hits += 1
+                finally:
+                    self.__lock.release()
+                self.__add(key, entry)
+                return entry
+
+        self.__lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            self.__lock.release()
+
+        return None
+
+    def store(self, key, parent_scope, scope, results):
+        """Store the effects of a statement
+
+        @param key: the key of the statement (see L{make_key})
+        @param parent_scope: the scope before the statement was executed
+        @param scope: the scope after the statement was executed
+        @param results: the results of the statement
+
+        """
+
+        bound = {}
+        for name, value in scope.iteritems():
+            if is_internal_name(name):
+                continue
+            if not name in parent_scope or parent_scope[name] is not value:
+                bound[name] = value
+        deleted = [name for name in parent_scope if not name in scope and not is_internal_name(name)]
+
+        self.__add(key, (bound, deleted, list(results)))
+
+    def __add(self, key, entry):
+        evicted = []
+
+        self.__lock.acquire()
+        try:
+            self.__serial += 1
+            self.__entries[key] = [self.__serial, entry]
+            while len(self.__entries) > self.max_entries:
+                oldest = min(self.__entries.iterkeys(), key=lambda k: self.__entries[k][0])
+                evicted.append((oldest, self.__entries.pop(oldest)[1]))
+        finally:
+            self.__lock.release()
+
+        if self.spill is not None:
+            for key, entry in evicted:
+                self.spill.store(key, entry)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import os
+    import shutil
+    import tempfile
+
+    from memo_cache import MemoCache
+    from test_utils import assert_equals
+
+    parent_scope = { 'a': [1, 2], 'b': 2, 'c': 3, '__builtins__': {} }
+
+    key = StatementCache.make_key("x = a[0] + b", parent_scope, set(['a', 'b', 'x']))
+    assert_equals(key, StatementCache.make_key("x = a[0] + b", { 'a': [1, 2], 'b': 2 }, set(['a', 'b', 'x'])))
+    assert key != StatementCache.make_key("x = a[0] + b", { 'a': [1, 3], 'b': 2 }, set(['a', 'b', 'x']))
+    assert key != StatementCache.make_key("x = a[1] + b", parent_scope, set(['a', 'b', 'x']))
+    assert_equals(StatementCache.make_key("x = f", { 'f': open(__file__) }, set(['f'])), None)
+
+    cache = StatementCache(max_entries=2)
+    scope = dict(parent_scope)
+    scope['x'] = 3
+    del scope['c']
+    cache.store(key, parent_scope, scope, [u"3"])
+    assert_equals(cache.lookup(key), ({ 'x': 3 }, ['c'], [u"3"]))
+    assert_equals(cache.lookup("missing"), None)
+    assert_equals((cache.hits, cache.misses), (1, 1))
+
+    # Least recently used entries are removed, or spilled if there is a spill store
+    cache.store("key2", {}, { 'y': 1 }, [])
+    cache.lookup(key)
+    cache.store("key3", {}, { 'z': 1 }, [])
+    assert_equals(cache.lookup("key2"), None)
+    assert cache.lookup(key) is not None
+
+    base = tempfile.mkdtemp("", "statement_cache")
+    try:
+        cache = StatementCache(max_entries=1, spill=MemoCache(os.path.join(base, ".cache")))
+        cache.store("key1", {}, { 'y': 1 }, [u"1"])
+        cache.store("key2", {}, { 'y': 2 }, [u"2"])
+        assert_equals(cache.lookup("key1"), ({ 'y': 1 }, [], [u"1"]))
+        assert_equals(cache.lookup("key2"), ({ 'y': 2 }, [], [u"2"]))
+    finally:
+        shutil.rmtree(base)
@@ -0,0 +1,254 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Measurements of how long statements take to compile and execute, kept for
+# each statement chunk across calculations so that a statement that has become
+# slower stands out, and exported as CSV or JSON.
+#
+
+import csv
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from batch_run import json
+
+# Number of timings kept for each chunk
+HISTORY_LENGTH = 20
+
+# On Linux, getrusage() can report the CPU time of the calling thread alone, which
+# leaves out the user interface thread; elsewhere we get the CPU time of the process
+if sys.platform.startswith('linux'):
+    _RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+elif resource is not None:
+    _RUSAGE_THREAD = resource.RUSAGE_SELF
+
+if sys.platform == 'darwin':
+    _MAXRSS_UNIT = 1 # bytes
+else:
+    _MAXRSS_UNIT = 1024 # kilobytes
+
+def get_usage():
+    """Get the resource usage used to time statements
+
+    @returns: a tuple of (CPU time, in seconds, peak resident set size of the
+       process, in bytes). Either may be None if not available.
+
+    """
+
+    if resource is None:
+        return None, None
+
+    try:
+        cpu = resource.getrusage(_RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        cpu = resource.getrusage(resource.RUSAGE_SELF)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return cpu.ru_utime + cpu.ru_stime, maxrss * _MAXRSS_UNIT
+
+class StatementTiming(object):
+
+    """
+    Timing of one execution of a statement
+
+    The peak_rss_delta is how much executing the statement raised the highest
+    memory use of the process so far; it is 0 for a statement that used a lot of
+    memory only if an earlier statement had used more.
+
+    """
+
+    FIELDS = ('finish_time', 'compile_time', 'wall_time', 'cpu_time', 'peak_rss_delta', 'cache_hit')
+
+    def __init__(self, finish_time, compile_time, wall_time, cpu_time, peak_rss_delta, cache_hit=False):
+        #: time at which execution finished, in seconds since the epoch
+        self.finish_time = finish_time
+        #: time taken to compile the statement, in seconds, or None
+        self.compile_time = compile_time
+        #: elapsed time taken by execution, in seconds
+        self.wall_time = wall_time
+        #: CPU time used by execution, in seconds, or None
+        self.cpu_time = cpu_time
+        #: increase in the peak resident set size of the process, in bytes, or None
+        self.peak_rss_delta = peak_rss_delta
+        #: True if the statement's results were taken from the L{StatementCache}
+        self.cache_hit = cache_hit
+
+    @staticmethod
+    def for_statement(statement):
+        """Get the timing of the last execution of a statement
+
+        @returns: the timing, or None if the statement hasn't been executed
+
+        """
+
+        if statement.execution_time is None:
+            return None
+
+        return StatementTiming(statement.finish_time, statement.compile_time, statement.execution_time,
+                               statement.cpu_time, statement.peak_rss_delta, statement.cache_hit)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+def add_to_history(history, timing):
+    """Add a timing to a list of timings, removing the oldest beyond HISTORY_LENGTH"""
+
+    history.append(timing)
+    if len(history) > HISTORY_LENGTH:
+        del history[0:len(history) - HISTORY_LENGTH]
+
+def format_duration(seconds):
+    """Format a time in seconds compactly, for display next to a statement"""
+
+    if seconds < 0.001:
+        return u"<1ms"
+    elif seconds < 1:
+        return u"%dms" % (seconds * 1000)
+    elif seconds < 60:
+        return u"%.1fs" % seconds
+    else:
+        return u"%dm%02ds" % (seconds // 60, seconds % 60)
+
+def _format_size(size):
+    if size < 1024 * 1024:
+        return u"%dkB" % (size // 1024)
+    else:
+        return u"%.1fMB" % (size / (1024. * 1024.))
+
+def format_timing(timing):
+    """Format the details of a timing as a line of text"""
+
+    parts = [u"wall %s" % format_duration(timing.wall_time)]
+    if timing.cpu_time is not None:
+        parts.append(u"CPU %s" % format_duration(timing.cpu_time))
+    if timing.compile_time:
+        parts.append(u"compile %s" % format_duration(timing.compile_time))
+    if timing.peak_rss_delta:
+        parts.append(u"peak memory +%s" % _format_size(timing.peak_rss_delta))
+    if timing.cache_hit:
+        parts.append(u"cached")
+
+    return u", ".join(parts)
+
+def format_history(history):
+    """Format a list of timings as text, most recent first, for a tooltip"""
+
+    lines = []
+    for timing in reversed(history):
+        when = time.strftime("%H:%M:%S", time.localtime(timing.finish_time))
+        lines.append(u"%s: %s" % (when, format_timing(timing)))
+
+    return u"\n".join(lines)
+
+def get_rows(chunks):
+    """Get the timings of a list of statement chunks as a list of dictionaries
+
+    Each dictionary has the keys 'line' (the first line of the chunk, starting
+    from 1), 'statement' (the first line of the text of the chunk), 'run' (the index
+    of the timing in the history of the chunk, starting from 0), and the fields of
+    L{StatementTiming}.
+
+    """
+
+    rows = []
+    for chunk in chunks:
+        text = chunk.tokenized.get_text().split("\n")[0]
+        for run, timing in enumerate(chunk.timings):
+            row = timing.to_dict()
+            row['line'] = chunk.start + 1
+            row['statement'] = text
+            row['run'] = run
+            rows.append(row)
+
+    return rows
+
+_COLUMNS = ('line', 'statement', 'run') + StatementTiming.FIELDS
+
+def export_timings(chunks, filename):
+    """Save the timing histories of a list of statement chunks
+
+    The format is JSON if the filename ends with .json, otherwise CSV, with a row
+    for each timing; see L{get_rows}.
+
+    """
+
+    rows = get_rows(chunks)
+
+    if filename.lower().endswith(".json"):
+        if json is None:
+            raise IOError("Saving JSON needs the json or simplejson module")
+        f = open(filename, "w")
+        try:
+            json.dump(rows, f, indent=1)
+        finally:
+            f.close()
+    else:
+        f = open(filename, "wb")
+        try:
+            writer = csv.writer(f)
+            writer.writerow(_COLUMNS)
+            for row in rows:
+                values = [row[column] for column in _COLUMNS]
+                writer.writerow([v.encode("utf8") if isinstance(v, unicode) else v for v in values])
+        finally:
+            f.close()
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import os
+    import shutil
+    import tempfile
+
+    from chunks import StatementChunk
+    from test_utils import assert_equals
+
+    assert_equals(format_duration(0.0001), u"<1ms")
+    assert_equals(format_duration(0.25), u"250ms")
+    assert_equals(format_duration(2.54), u"2.5s")
+    assert_equals(format_duration(125), u"2m05s")
+    assert_equals(format_timing(StatementTiming(0, 0.002, 1.5, 1.25, 3 * 1024 * 1024)),
+                  u"wall 1.5s, CPU 1.2s, compile 2ms, peak memory +3.0MB")
+
+    cpu_time, maxrss = get_usage()
+    if resource is not None:
+        assert cpu_time >= 0 and maxrss > 0
+
+    history = []
+    for i in xrange(HISTORY_LENGTH + 2):
+        add_to_history(history, i)
+    assert_equals(history, range(2, HISTORY_LENGTH + 2))
+
+    chunk = StatementChunk(2, 4)
+    chunk.set_lines([u"for i in range(10):", u"    i"])
+    chunk.timings = [StatementTiming(1000., 0.001, 0.5, 0.5, 0),
+                     StatementTiming(1001., 0, 0.25, None, None, cache_hit=True)]
+    rows = get_rows([chunk])
+    assert_equals([(row['line'], row['statement'], row['run'], row['wall_time']) for row in rows],
+                  [(3, u"for i in range(10):", 0, 0.5), (3, u"for i in range(10):", 1, 0.25)])
+
+    base = tempfile.mkdtemp("", "statement_timing")
+    try:
+        filename = os.path.join(base, "timings.csv")
+        export_timings([chunk], filename)
+        lines = open(filename).read().strip().split("\r\n")
+        assert_equals(lines[0], "line,statement,run,finish_time,compile_time,wall_time,cpu_time,peak_rss_delta,cache_hit")
+        assert_equals(lines[2], "3,for i in range(10):,1,1001.0,0,0.25,,,True")
+
+        if json is not None:
+            filename = os.path.join(base, "timings.json")
+            export_timings([chunk], filename)
+            assert_equals(json.load(open(filename))[0]['cpu_time'], 0.5)
+    finally:
+        shutil.rmtree(base)
@@ -13,6 +13,8 @@ import sys
 def init():
     """Initialize the stdout_capture module. This must be called before using the StdoutCapture class"""
     global _saved_stdout
+    if isinstance(sys.stdout, _StdoutStack): # Already initialized
+        return
     _saved_stdout = sys.stdout
     sys.stdout = _StdoutStack()
 
@@ -26,6 +28,11 @@ class _StdoutStack(threading.local):
     def write(self, str):
         self.current.write(str)
 
+    def flush(self):
+        # Capture objects don't buffer, so there's nothing to flush for them
+        if hasattr(self.current, 'flush'):
+            self.current.flush()
+
     def push(self, value):
         self.stack.append(self.current)
         self.current = value
@@ -0,0 +1,383 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Running a worksheet for a series of values of a parameter (reinteract-run --sweep)
+#
+# The statements of the worksheet up to the first one that uses the parameter
+# (the "prefix") are executed once; the remaining statements (the "suffix") are
+# then executed once for each value. Where os.fork() is available, the suffix
+# runs for different values run in parallel in child processes forked after
+# the prefix has executed, so they start with the prefix results already in
+# memory. Otherwise, they run one after another in this process; since each
+# statement executes in a copy of the scope of the previous statement, the
+# prefix results are unaffected by running the suffix.
+#
+
+import cPickle
+import logging
+import os
+import select
+import time
+
+import batch_run
+
+_debug = logging.getLogger("Sweep").debug
+
+def _statement_records(statements, render_images):
+    records = []
+    errors = 0
+    for statement in statements:
+        statement.chunk.update_statement()
+        record = batch_run.statement_record_for_chunk(statement.chunk, render_images)
+        if record['error'] is not None:
+            errors += 1
+        records.append(record)
+
+    return records, errors
+
+def _execute(statements):
+    # Execute statements in order, stopping at the first failure. Returns the
+    # statements that were executed
+    from statement import Statement
+
+    executed = []
+    for statement in statements:
+        if statement.state == Statement.COMPILE_ERROR:
+            executed.append(statement)
+            break
+        statement.mark_for_execute()
+        statement.execute()
+        executed.append(statement)
+        if statement.state != Statement.EXECUTE_SUCCESS:
+            break
+
+    return executed
+
+def _find_split(statements, name):
+    # Returns (prefix, assignment, suffix). assignment is the first top-level statement
+    # assigning to name, which is replaced by the parameter value, or None
+    from statement import Statement
+
+    assignment = None
+    for statement in statements:
+        m = batch_run._ASSIGNMENT_RE.match(statement.chunk.tokenized.get_text())
+        if m and m.group(1) == name:
+            assignment = statement
+            break
+
+    prefix = []
+    for i, statement in enumerate(statements):
+        if statement is assignment:
+            continue
+        if statement.state == Statement.COMPILE_ERROR or name in statement.referenced_names:
+            break
+        prefix.append(statement)
+    else:
+        i = len(statements)
+
+    suffix = [s for s in statements[i:] if s is not assignment]
+
+    return prefix, assignment, suffix
+
+def _fork_runs(run_one, values, n_processes):
+    # Call run_one(value) for each value in a child process, running up to n_processes
+    # children at once. The results are pickled and passed back through a pipe.
+    results = [None] * len(values)
+    pending = list(enumerate(values))
+    active = {} # read fd => (index, pid, list of data read)
+
+    while len(pending) > 0 or len(active) > 0:
+        while len(pending) > 0 and len(active) < n_processes:
+            index, value = pending.pop(0)
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(read_fd)
+                    try:
+                        data = cPickle.dumps(run_one(value), cPickle.HIGHEST_PROTOCOL)
+                    except Exception, e:
+                        data = cPickle.dumps("%s: %s" % (type(e).__name__, e), cPickle.HIGHEST_PROTOCOL)
+                    while len(data) > 0:
+                        data = data[os.write(write_fd, data):]
+                finally:
+                    os._exit(0)
+
+            os.close(write_fd)
+            active[read_fd] = (index, pid, [])
+
+        readable, _, _ = select.select(active.keys(), [], [])
+        for fd in readable:
+            index, pid, data = active[fd]
+            chunk = os.read(fd, 65536)
+            if chunk != "":
+                data.append(chunk)
+                continue
+
+            os.close(fd)
+            del active[fd]
+            _, status = os.waitpid(pid, 0)
+            try:
+                results[index] = cPickle.loads("".join(data))
+            except (EOFError, cPickle.UnpicklingError), e:
+                results[index] = "Worker process exited with status %d" % status
+
+    return results
+
+def run_sweep(filename, name, values, folder=None, n_processes=1, render_images=False):
+    """Run a worksheet for each of a list of values of a parameter
+
+    The parameter is bound as for L{batch_run.bind_parameters}: the first top-level
+    assignment to the parameter in the worksheet is replaced by the value.
+    Statements before the first statement that uses the parameter are only
+    executed once, and their results are shared between the values.
+
+    @param filename: the worksheet file to run
+    @param name: the name of the parameter
+    @param values: list of values for the parameter. The values must have
+       a repr() that evaluates to an equal value.
+    @param folder: the notebook folder the worksheet belongs to; if None,
+       found with L{batch_run.find_notebook_folder}
+    @param n_processes: number of values to run in parallel. Values are only run
+       in parallel if os.fork() is available.
+    @param render_images: see L{batch_run.run_worksheet}
+    @returns: a dictionary with the keys:
+       file: the filename passed in
+       parameter: the name of the parameter
+       error: an error message if the file couldn't be loaded, otherwise None
+       errors: the number of statements that failed in the prefix and all runs
+       prefix: list of dictionaries describing the prefix statements, as for
+          L{batch_run.run_worksheet}
+       prefix_elapsed: time taken to execute the prefix, in seconds
+       runs: list of dictionaries, one for each value, with keys value, error
+          (an error message if the run failed outside the worksheet code, otherwise
+          None), errors, elapsed, and statements (describing the suffix statements).
+          If a prefix statement failed, this is empty.
+
+    """
+
+    from notebook import Notebook
+    from statement import Statement
+    from worksheet import Worksheet
+    from chunks import StatementChunk
+    import reunicode
+
+    if folder is None:
+        folder = batch_run.find_notebook_folder(filename)
+
+    sweep = {
+        'file': filename,
+        'parameter': name,
+        'error': None,
+        'errors': 0,
+        'prefix': [],
+        'prefix_elapsed': 0.,
+        'runs': []
+    }
+
+    notebook = Notebook(folder)
+    worksheet = Worksheet(notebook)
+    try:
+        try:
+            worksheet.load(filename, with_results=False)
+        except (IOError, reunicode.ConversionError), e:
+            sweep['error'] = str(e)
+            sweep['errors'] = 1
+            return sweep
+
+        statements = []
+        parent = None
+        for chunk in worksheet.iterate_chunks():
+            if isinstance(chunk, StatementChunk):
+                statement = chunk.get_statement(worksheet)
+                statement.set_parent(parent)
+                statement.compile()
+                statements.append(statement)
+                parent = statement
+
+        prefix, assignment, suffix = _find_split(statements, name)
+        _debug("%d statements in prefix, %d in suffix", len(prefix), len(suffix))
+
+        # The prefix statements are chained together without the assignment
+        parent = None
+        for statement in prefix:
+            statement.set_parent(parent)
+            parent = statement
+
+        start = time.time()
+        executed = _execute(prefix)
+        sweep['prefix'], sweep['errors'] = _statement_records(executed, render_images)
+        sweep['prefix_elapsed'] = time.time() - start
+        if len(executed) > 0 and executed[-1].state != Statement.EXECUTE_SUCCESS:
+            return sweep
+
+        def run_one(value):
+            start = time.time()
+            binding = Statement("%s = %r" % (name, value), worksheet, parent)
+            binding.compile()
+            binding.execute()
+            if binding.state != Statement.EXECUTE_SUCCESS:
+                raise ValueError("Can't bind %s: %s" % (name, binding.error_message))
+
+            statement_parent = binding
+            for statement in suffix:
+                statement.set_parent(statement_parent)
+                statement.compile()
+                statement_parent = statement
+
+            records, errors = _statement_records(_execute(suffix), render_images)
+            return {
+                'value': value,
+                'error': None,
+                'errors': errors,
+                'elapsed': time.time() - start,
+                'statements': records
+            }
+
+        if n_processes > 1 and len(values) > 1 and hasattr(os, 'fork'):
+            results = _fork_runs(run_one, values, n_processes)
+        else:
+            results = []
+            for value in values:
+                try:
+                    results.append(run_one(value))
+                except Exception, e:
+                    results.append("%s: %s" % (type(e).__name__, e))
+
+        for value, result in zip(values, results):
+            if isinstance(result, basestring):
+                result = {
+                    'value': value,
+                    'error': result,
+                    'errors': 1,
+                    'elapsed': 0.,
+                    'statements': []
+                }
+            sweep['errors'] += result['errors']
+            sweep['runs'].append(result)
+    finally:
+        worksheet.close()
+        notebook.close()
+
+    return sweep
+
+def _format_cell(statement):
+    if statement['error'] is not None:
+        return u"Error: " + statement['error'].split("\n")[-1]
+    else:
+        return u"; ".join(r.replace("\n", " ") for r in statement['results'])
+
+def format_table(sweep):
+    """Format the results of L{run_sweep} as a text table
+
+    There is a row for each value of the parameter, and a column for each
+    suffix statement that has results or errors.
+
+    """
+
+    lines = []
+    if sweep['error'] is not None:
+        lines.append("Error: " + sweep['error'])
+
+    failed_prefix = [s for s in sweep['prefix'] if s['error'] is not None]
+    for statement in failed_prefix:
+        lines.append(u"%d: %s" % (statement['line'], _format_cell(statement)))
+
+    columns = []
+    for run in sweep['runs']:
+        for statement in run['statements']:
+            if (statement['results'] or statement['error'] is not None) and not statement['line'] in columns:
+                columns.append(statement['line'])
+    columns.sort()
+
+    rows = [[sweep['parameter']] + [u"line %d" % line for line in columns]]
+    for run in sweep['runs']:
+        cells = dict((s['line'], _format_cell(s)) for s in run['statements'])
+        row = [unicode(repr(run['value']))]
+        if run['error'] is not None:
+            row.append(u"Error: " + run['error'])
+        else:
+            row.extend(cells.get(line, u"") for line in columns)
+        rows.append(row)
+
+    if len(sweep['runs']) > 0:
+        widths = [0] * max(len(row) for row in rows)
+        for row in rows:
+            for i, cell in enumerate(row):
+                widths[i] = max(widths[i], len(cell))
+        for row in rows:
+            lines.append(u"  ".join(cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip())
+
+    return u"\n".join(lines) + u"\n"
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import re
+    import shutil
+    import tempfile
+
+    import stdout_capture
+    from test_utils import assert_equals
+
+    stdout_capture.init()
+
+    base = tempfile.mkdtemp("", "sweep")
+    try:
+        def write_file(name, contents):
+            absname = os.path.join(base, name)
+            f = open(absname, "w")
+            f.write(contents)
+            f.close()
+            return absname
+
+        # The prefix appends to a file each time it is executed, so we can check
+        # that it only executes once
+        log_file = os.path.join(base, "log")
+        filename = write_file("sweep.rws", """n = 1
+open(%r, "a").write("prefix\\n")
+data = [1, 2, 3]
+[x * n for x in data]
+data.append(n)
+10 / (n - 2)
+len(data)
+""" % log_file)
+
+        def check(sweep):
+            assert_equals(open(log_file).read(), "prefix\n")
+            os.remove(log_file)
+
+            assert_equals(sweep['error'], None)
+            assert_equals(sweep['errors'], 1)
+            assert_equals([s['line'] for s in sweep['prefix']], [2, 3])
+            assert_equals([r['value'] for r in sweep['runs']], [1, 2, 3])
+            assert_equals([[(s['line'], s['results']) for s in r['statements']] for r in sweep['runs']],
+                          [[(4, ['[1, 2, 3]']), (5, []), (6, ['-10']), (7, ['4'])],
+                           [(4, ['[2, 4, 6]']), (5, []), (6, [])],
+                           [(4, ['[3, 6, 9]']), (5, []), (6, ['10']), (7, ['4'])]])
+
+            rows = [re.split(r"\s\s+", line) for line in format_table(sweep).strip().split("\n")]
+            assert_equals(rows[0], ["n", "line 4", "line 6", "line 7"])
+            assert_equals(rows[1], ["1", "[1, 2, 3]", "-10", "4"])
+            assert_equals(rows[2], ["2", "[2, 4, 6]", "Error: ZeroDivisionError: integer division or modulo by zero"])
+
+        # In this process, one value after another
+        check(run_sweep(filename, 'n', [1, 2, 3]))
+
+        # In parallel child processes
+        if hasattr(os, 'fork'):
+            check(run_sweep(filename, 'n', [1, 2, 3], n_processes=2))
+
+        # A statement failing in the prefix means no values are run
+        filename = write_file("bad.rws", "1/0\nn\n")
+        sweep = run_sweep(filename, 'n', [1, 2])
+        assert_equals((sweep['errors'], sweep['runs']), (1, []))
+        assert format_table(sweep).startswith("1: Error: ZeroDivisionError")
+    finally:
+        shutil.rmtree(base)
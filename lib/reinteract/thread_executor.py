@@ -8,11 +8,14 @@
 ########################################################################
 
 import ctypes
-import gobject
+import Queue
 import signal
 import sys
 import thread
+import time
 
+import main_loop
+from signals import SignalObject
 from statement import Statement
 
 #
@@ -22,6 +25,10 @@ from statement import Statement
 # through pthreads.
 #
 _PyThreadState_SetAsyncExc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+_PyThreadState_SetAsyncExc.argtypes = [ctypes.c_long, ctypes.py_object]
+# Passing NULL rather than an exception clears a pending exception
+_PyThreadState_ClearAsyncExc = ctypes.PYFUNCTYPE(ctypes.c_int, ctypes.c_long, ctypes.c_void_p)(
+    ("PyThreadState_SetAsyncExc", ctypes.pythonapi))
 
 #
 # _PyThreadState_SetAsyncExc won't immediately wake up a thread that is blocking
@@ -51,6 +58,8 @@ else:
         _pthreads_dll = ctypes.CDLL("libpthread.so.0")
     
     _pthread_kill = _pthreads_dll.pthread_kill
+    # Thread IDs don't fit in a C int on 64-bit platforms
+    _pthread_kill.argtypes = [ctypes.c_ulong, ctypes.c_int]
 
 if _pthread_kill is not None:
     def _ignore_handler(signum, frame):
@@ -58,7 +67,60 @@ if _pthread_kill is not None:
 
     signal.signal(signal.SIGUSR1, _ignore_handler)
 
-class ThreadExecutor(gobject.GObject):
+# Minimum time between updates of the progress of an execution in the main thread,
+# in seconds. With many fast statements, signalling each statement separately would
+# spend more time updating the user interface than executing the statements.
+UPDATE_INTERVAL = 0.033
+
+class ExecutorWorker(object):
+    """A thread that runs the executions of a series of ThreadExecutor objects
+
+    Starting a new thread for each calculation adds latency to small recalculations,
+    so a worksheet creates one worker and passes it to each ThreadExecutor it
+    creates. Executions run one after another in the order that execute() was
+    called on the executors.
+
+    """
+
+    def __init__(self):
+        self.__queue = Queue.Queue()
+        self.__shutdown = False
+        self.tid = thread.start_new_thread(self.__run, ())
+
+    def __run(self):
+        while True:
+            try:
+                job = self.__queue.get()
+                if job is None:
+                    break
+                job()
+                # An interrupt sent just as the job finished might still be pending;
+                # it mustn't be raised in the next job
+                _PyThreadState_ClearAsyncExc(self.tid, None)
+            except KeyboardInterrupt:
+                pass
+
+    def submit(self, job):
+        """Call job() in the worker thread, after any previously submitted jobs"""
+
+        if self.__shutdown:
+            raise RuntimeError("ExecutorWorker was shut down")
+
+        self.__queue.put(job)
+
+    def shutdown(self):
+        """Make the worker thread exit once it finishes the jobs already submitted.
+
+        This doesn't wait for the thread to exit; to stop a running execution,
+        interrupt its ThreadExecutor.
+
+        """
+
+        if not self.__shutdown:
+            self.__shutdown = True
+            self.__queue.put(None)
+
+class ThreadExecutor(SignalObject):
     """Class to execute Python statements asynchronously in a thread
 
     Signals
@@ -66,56 +128,96 @@ class ThreadExecutor(gobject.GObject):
      -  B{statement-executing}(executor, statement) emitted when the executor starts processing a statement. There is no guarantee that this signal will be emitted for each processed statement.
      -  B{statement-complete}(executor, statement) emitted when the executor is done with all processing it will do on a statement
      -  B{complete}(executor): emitted when the executor is done with all processing
+     -  B{batch-begin}(executor), B{batch-end}(executor): emitted before and after the
+        ::statement-complete and ::statement-executing signals for the progress since
+        the last batch, so that a handler can apply the changes together.
+
+    Progress is signalled at most every UPDATE_INTERVAL seconds, except that
+    completion is signalled immediately.
 
     """
 
-    __gsignals__ = {
-        'statement-executing' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
-        'statement-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
-        'complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+    __signals__ = {
+        'statement-executing' : (Statement,),
+        'statement-complete' : (Statement,),
+        'complete' : (),
+        'batch-begin' : (),
+        'batch-end' : (),
     }
 
-    def __init__(self, parent_statement=None):
+    def __init__(self, parent_statement=None, worker=None):
         """Initialize the ThreadExecutor object
 
         @param parent_statement: prievous statement defining the execution environment for the first statement
+        @param worker: L{ExecutorWorker} to execute the statements in, or None to start a new thread
 
         """
-        gobject.GObject.__init__(self)
+        SignalObject.__init__(self)
 
         self.parent_statement = parent_statement
+        self.worker = worker
         self.statements = []
         self.lock = thread.allocate_lock()
 
         self.idle_id = 0
+        # Whether idle_id is a timeout waiting for UPDATE_INTERVAL to pass
+        self.idle_is_timeout = False
+        self.last_update = 0
+        self.complete_signalled = False
         self.last_complete = -1
         self.last_signalled = -1
         self.complete = False
         self.interrupted = False
+        # Index of the statement being executed, or -1
+        self.executing = -1
+        # Statements from this index on are not executed; see cancel()
+        self.cancel_index = None
 
     def __run_idle(self):
         self.lock.acquire()
         complete = self.complete
         last_complete = self.last_complete
         self.idle_id = 0
+        self.last_update = time.time()
         self.lock.release()
 
-        for i in xrange(self.last_signalled + 1, last_complete + 1):
-            self.emit('statement-complete', self.statements[i])
+        # A timeout removed by __queue_idle() can still be dispatched
+        if self.complete_signalled:
+            return False
+
+        self.emit('batch-begin')
+        try:
+            for i in xrange(self.last_signalled + 1, last_complete + 1):
+                self.emit('statement-complete', self.statements[i])
+
+            self.last_signalled = last_complete
 
-        self.last_signalled = last_complete
+            if not complete and last_complete < len(self.statements) - 1:
+                self.emit('statement-executing', self.statements[last_complete + 1])
+        finally:
+            self.emit('batch-end')
 
-        if self.complete:
+        if complete:
+            self.complete_signalled = True
             self.emit('complete')
-        elif last_complete < len(self.statements) - 1:
-            self.emit('statement-executing', self.statements[last_complete + 1])
 
         return False
 
-    def __queue_idle(self):
-        # Must be called with the lock held
+    def __queue_idle(self, flush=False):
+        # Must be called with the lock held. Unless flush is True, waits until
+        # UPDATE_INTERVAL has passed since the last update
+        if self.idle_id and self.idle_is_timeout and flush:
+            main_loop.source_remove(self.idle_id)
+            self.idle_id = 0
+
         if not self.idle_id:
-            self.idle_id = gobject.idle_add(self.__run_idle)
+            delay = self.last_update + UPDATE_INTERVAL - time.time()
+            if flush or delay <= 0:
+                self.idle_id = main_loop.idle_add(self.__run_idle)
+                self.idle_is_timeout = False
+            else:
+                self.idle_id = main_loop.timeout_add(int(delay * 1000) + 1, self.__run_idle)
+                self.idle_is_timeout = True
 
     def __run_thread(self):
         # The patten used twice here of:
@@ -137,7 +239,11 @@ class ThreadExecutor(gobject.GObject):
         try:
             for i, statement in enumerate(self.statements):
                 self.lock.acquire()
+                if self.cancel_index is not None and i >= self.cancel_index:
+                    self.lock.release()
+                    break
                 statement.before_execute()
+                self.executing = i
                 self.__queue_idle()
                 try:
                     self.lock.release()
@@ -147,9 +253,11 @@ class ThreadExecutor(gobject.GObject):
                     self.lock.acquire()
                 finally:
                     statement.after_execute()
+                    self.executing = -1
                     result_state = statement.state
                     self.last_complete = i;
-                    self.__queue_idle()
+                    # The completion is signalled along with the start of the next
+                    # statement, or the completion of the executor
                     self.lock.release()
 
                     if result_state != Statement.EXECUTE_SUCCESS:
@@ -164,7 +272,7 @@ class ThreadExecutor(gobject.GObject):
         finally:
             self.complete = True
             self.last_complete = len(self.statements) - 1
-            self.__queue_idle()
+            self.__queue_idle(flush=True)
             self.lock.release()
 
     def add_statement(self, statement):
@@ -192,15 +300,21 @@ class ThreadExecutor(gobject.GObject):
             parent = statement
 
         if not success:
+            self.emit('batch-begin')
             for statement in self.statements:
                 self.emit('statement-complete', statement)
+            self.emit('batch-end')
             self.emit('complete')
 
         return success
 
     def execute(self):
         """Execute the statements of the executor asynchronously in a thread."""
-        self.tid = thread.start_new_thread(self.__run_thread, ())
+        if self.worker is not None:
+            self.tid = self.worker.tid
+            self.worker.submit(self.__run_thread)
+        else:
+            self.tid = thread.start_new_thread(self.__run_thread, ())
 
     def interrupt(self):
         """Interrupts the execution of the executor if possible.
@@ -222,18 +336,60 @@ class ThreadExecutor(gobject.GObject):
         # See note in __run_thread() as to why we need to lock and why we need to
         # protect against sending the KeyboardInterrupt exception more than once
         self.lock.acquire()
+        self.__interrupt_locked()
+        self.lock.release()
+
+    def __interrupt_locked(self):
+        # Must be called with the lock held
         if not self.complete and not self.interrupted:
             self.interrupted = True
-            _PyThreadState_SetAsyncExc(self.tid, ctypes.py_object(KeyboardInterrupt))
-            if _pthread_kill is not None:
-                _pthread_kill(self.tid, signal.SIGUSR1)
+            if self.executing >= 0:
+                _PyThreadState_SetAsyncExc(self.tid, ctypes.py_object(KeyboardInterrupt))
+                if _pthread_kill is not None:
+                    _pthread_kill(self.tid, signal.SIGUSR1)
+            else:
+                # Between statements, or waiting for a worker to be free. We mustn't
+                # raise an exception in the thread, since it might be running something
+                # else; just don't execute any more statements
+                next_index = self.last_complete + 1
+                if self.cancel_index is None or next_index < self.cancel_index:
+                    self.cancel_index = next_index
+
+    def cancel(self, statement):
+        """Stop executing at the given statement
+
+        The statement and the statements after it won't be executed. If one of them
+        is currently executing, it is interrupted as for interrupt(). Statements before
+        the given statement continue to execute normally. ::statement-complete is still
+        emitted for the cancelled statements; their states will be Statement.COMPILE_SUCCESS
+        or Statement.INTERRUPTED (or a final state, if they completed before they
+        could be cancelled.)
+
+        @param statement: a statement that was added to the executor
+
+        """
+
+        index = self.statements.index(statement)
+
+        self.lock.acquire()
+        if self.cancel_index is None or index < self.cancel_index:
+            self.cancel_index = index
+            if self.executing >= index:
+                self.__interrupt_locked()
         self.lock.release()
 
+    def is_cancelled(self, statement):
+        """Check whether a statement was cancelled with cancel()"""
+
+        self.lock.acquire()
+        try:
+            return self.cancel_index is not None and self.statements.index(statement) >= self.cancel_index
+        finally:
+            self.lock.release()
+
 ######################################################################
 
 if __name__ == '__main__': #pragma: no cover
-    gobject.threads_init()
-
     import stdout_capture
     stdout_capture.init()
 
@@ -249,8 +405,8 @@ if __name__ == '__main__': #pragma: no cover
     notebook = Notebook()
     worksheet = Worksheet(notebook)
 
-    def test_execute(statements):
-        executor = ThreadExecutor()
+    def test_execute(statements, worker=None):
+        executor = ThreadExecutor(worker=worker)
 
         for s, expected_state, expected_results in statements:
             statement = Statement(s, worksheet)
@@ -259,7 +415,7 @@ if __name__ == '__main__': #pragma: no cover
             statement._got_executing = False
             executor.add_statement(statement)
 
-        loop = gobject.MainLoop()
+        loop = main_loop.MainLoop()
 
         def on_statement_executing(executor, statement):
             if hasattr(statement, '_got_state'):
@@ -290,13 +446,13 @@ if __name__ == '__main__': #pragma: no cover
 
         if executor.compile():
             executor.execute()
-            interrupt_source = gobject.timeout_add(500, interrupt)
-            timeout_source = gobject.timeout_add(1000, timeout)
+            interrupt_source = main_loop.timeout_add(500, interrupt)
+            timeout_source = main_loop.timeout_add(1000, timeout)
             loop.run()
             if timed_out:
                 raise AssertionError("Interrupting ThreadExecutor failed")
-            gobject.source_remove(interrupt_source)
-            gobject.source_remove(timeout_source)
+            main_loop.source_remove(interrupt_source)
+            main_loop.source_remove(timeout_source)
 
         for s in executor.statements:
             assert_equals(s._got_state, s._expected_state)
@@ -333,6 +489,108 @@ if __name__ == '__main__': #pragma: no cover
             ("z = 1", Statement.COMPILE_SUCCESS, None)
         ])
 
+    # The same, executing in a worker thread shared between executors
+    worker = ExecutorWorker()
+    for i in xrange(2):
+        test_execute(
+            [
+                ("y = 1", Statement.EXECUTE_SUCCESS, []),
+                ("for x in xrange(0,100000000): y = y* 2", Statement.INTERRUPTED, None),
+                ("z = 1", Statement.COMPILE_SUCCESS, None)
+            ], worker=worker)
+        test_execute(
+            [
+                ("a = 1", Statement.EXECUTE_SUCCESS, []),
+                ("a", Statement.EXECUTE_SUCCESS, ['1'])
+            ], worker=worker)
+
+    # An executor waiting for the worker to be free can be interrupted without
+    # affecting the one that is executing
+    first = ThreadExecutor(worker=worker)
+    first.add_statement(Statement("import time; time.sleep(0.2)", worksheet))
+    second = ThreadExecutor(worker=worker)
+    second.add_statement(Statement("b = 1", worksheet))
+    loop = main_loop.MainLoop()
+    second.connect('complete', lambda executor: loop.quit())
+    for executor in (first, second):
+        executor.compile()
+        executor.execute()
+    second.interrupt()
+    loop.run()
+    assert_equals(first.statements[0].state, Statement.EXECUTE_SUCCESS)
+    assert_equals(second.statements[0].state, Statement.COMPILE_SUCCESS)
+    worker.shutdown()
+
+    # Test cancelling a suffix of the statements: statements before the cancelled
+    # statement complete normally, the cancelled statements don't execute
+    def test_cancel(cancel_index, expected_states):
+        executor = ThreadExecutor()
+        for s in ("import time", "time.sleep(0.5)", "for x in xrange(0,100000000): pass", "z = 1"):
+            executor.add_statement(Statement(s, worksheet))
+
+        loop = main_loop.MainLoop()
+        def on_statement_executing(executor, statement):
+            if statement is executor.statements[1]:
+                executor.cancel(executor.statements[cancel_index])
+        executor.connect('statement-executing', on_statement_executing)
+        executor.connect('complete', lambda executor: loop.quit())
+
+        executor.compile()
+        executor.execute()
+        timeout_source = main_loop.timeout_add(5000, loop.quit)
+        loop.run()
+        main_loop.source_remove(timeout_source)
+
+        assert_equals([s.state for s in executor.statements], expected_states)
+        assert_equals([executor.is_cancelled(s) for s in executor.statements],
+                      [i >= cancel_index for i in xrange(4)])
+
+    test_cancel(2, [Statement.EXECUTE_SUCCESS, Statement.EXECUTE_SUCCESS,
+                    Statement.COMPILE_SUCCESS, Statement.COMPILE_SUCCESS])
+    test_cancel(1, [Statement.EXECUTE_SUCCESS, Statement.INTERRUPTED,
+                    Statement.COMPILE_SUCCESS, Statement.COMPILE_SUCCESS])
+
+    # With many fast statements, progress is signalled in batches
+    executor = ThreadExecutor()
+    for i in xrange(100):
+        executor.add_statement(Statement("time.sleep(0.002)" if i > 0 else "import time", worksheet))
+    batches = []
+    completed = []
+    executor.connect('batch-begin', lambda executor: batches.append(len(completed)))
+    executor.connect('statement-complete', lambda executor, statement: completed.append(statement))
+    loop = main_loop.MainLoop()
+    executor.connect('complete', lambda executor: loop.quit())
+    executor.compile()
+    start = time.time()
+    executor.execute()
+    loop.run()
+    elapsed = time.time() - start
+    assert_equals(completed, executor.statements)
+    assert len(batches) <= elapsed / UPDATE_INTERVAL + 2, (len(batches), elapsed)
+
+    # Latency of executing a tiny statement, with a new thread each time and with a worker
+    if "-b" in sys.argv:
+        def time_execute(worker, count=1000):
+            # The statement is only compiled once, so we time just the execution
+            statement = Statement("a = 1", worksheet)
+            statement.compile()
+            loop = main_loop.MainLoop()
+            start = time.time()
+            for i in xrange(count):
+                statement.mark_for_execute()
+                executor = ThreadExecutor(worker=worker)
+                executor.add_statement(statement)
+                executor.connect('complete', lambda executor: loop.quit())
+                executor.compile()
+                executor.execute()
+                loop.run()
+            return (time.time() - start) / count
+
+        print "New thread: %.1fus per execution" % (1e6 * time_execute(None))
+        worker = ExecutorWorker()
+        print "Worker:     %.1fus per execution" % (1e6 * time_execute(worker))
+        worker.shutdown()
+
     # Test interrupting a blocking syscall, if support on this platform
     if _pthread_kill is not None:
         test_execute(
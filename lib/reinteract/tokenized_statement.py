@@ -7,6 +7,9 @@
 ########################################################################
 
 import inspect
+import re
+
+from completion_index import ScopeIndex, get_object_index
 from retokenize import *
 
 # These are keywords where completion doesn't make sense afterwords, for
@@ -25,6 +28,12 @@ NO_COMPLETION_TOKENS = set([
         TOKEN_RSQB, TOKEN_BUILTIN_CONSTANT
         ])
 
+# Regular expressions matching the text of an import statement up to the
+# position where we are completing a module name
+IMPORT_MODULE_RE = re.compile(r'^\s*import\s+(?:.*,)?\s*([A-Za-z_][\w.]*|)$', re.DOTALL)
+FROM_MODULE_RE = re.compile(r'^\s*from\s+([A-Za-z_][\w.]*|)$', re.DOTALL)
+FROM_IMPORT_RE = re.compile(r'^\s*from\s+([A-Za-z_][\w.]*)\s+import\s+\(?(?:.*,)?\s*(\w*)$', re.DOTALL)
+
 def get_prefixes(items):
     result = set()
     for s in items:
@@ -43,6 +52,88 @@ KEYWORD_PREFIXES = get_prefixes([
         'pass', 'print', 'raise', 'return', 'try', 'with', 'while', 'yield'
 ])
 
+def resolve_names(names, scope):
+    """Resolve a path of names (as returned by L{TokenizedStatement.get_names_at_location})
+
+    The first name is looked up in scope, subsequent names are looked up as
+    attributes. Note that this calls into user code, since getting an attribute
+    can run arbitrary code.
+
+    Returns the resolved object, or None if the names can't be resolved.
+
+    """
+
+    obj = None
+    for name in names:
+        # First name is resolved against the scope
+        if obj is None:
+            try:
+                obj = scope[name]
+            except KeyError:
+                return None
+        # Subsequent names resolved
+        else:
+            try:
+                obj = getattr(obj, name)
+            except AttributeError:
+                return None
+
+    return obj
+
+def complete_names(names, scope, scope_index=None):
+    """Find completions for a path of names (as returned by L{TokenizedStatement.get_completion_names})
+
+    The leading names are resolved against scope; the last name is
+    completed against the attributes of the resulting object, or
+    against the scope if there is only one name. Like L{resolve_names},
+    this calls into user code.
+
+    Returns a list of tuples of (display_form, text_to_insert, object_completed_to)
+
+    @param scope_index if supplied, a L{ScopeIndex} for scope.
+
+    """
+
+    # We resolve the leading portion of the name path
+    if len(names) > 1:
+        object = resolve_names(names[0:-1], scope)
+        if object is None:
+            return []
+    else:
+        object = None
+
+    # Then we complete the last element of the name path against what we resolved
+    # to, or against the scope (if there was just one name)
+    result = []
+
+    to_complete = names[-1]
+    if object is None:
+        if scope_index is None:
+            scope_index = ScopeIndex(scope)
+
+        for completion in scope_index.find(to_complete):
+            result.append((completion, completion[len(to_complete):], scope_index.lookup(scope, completion)))
+    else:
+        for completion in get_object_index(object).find(to_complete):
+            if inspect.ismodule(object):
+                object_completed_to = getattr(object, completion, None)
+            # We special case these because obj.__class__.__module__/__doc__
+            # are also a strings, not a method/property
+            elif completion != '__module__' and completion != '__doc__':
+                # Using the attribute of the class over the attribute of
+                # the object gives us better docs on properties
+                try:
+                    klass = getattr(object, '__class__')
+                    object_completed_to = getattr(klass, completion)
+                except AttributeError:
+                    object_completed_to = getattr(object, completion)
+            else:
+                object_completed_to = None
+
+            result.append((completion, completion[len(to_complete):], object_completed_to))
+
+    return result
+
 class _TokenIter(object):
     def __init__(self, statement, line, i):
         self.statement = statement
@@ -329,78 +420,16 @@ class TokenizedStatement(object):
 
         return False
 
-    def __resolve_names(self, names, scope):
-        obj = None
-        for name in names:
-            # First name is resolved against the scope
-            if obj is None:
-                try:
-                    obj = scope[name]
-                except KeyError:
-                    return None
-            # Subsequent names resolved
-            else:
-                try:
-                    obj = getattr(obj, name)
-                except AttributeError:
-                    return None
-
-        return obj
-                
-    def __sort_completions(self, completions):
-        # Sort a set of completions with _ and __ names at the end.
-        # (modifies completions and then returns it for convenience)
-        
-        def compare_completions(a, b):
-            n_a = a[0]
-            n_b = b[0]
-
-            if n_a.startswith("__") and not n_b.startswith("__"):
-                return 1
-            elif n_b.startswith("__") and not n_a.startswith("__"):
-                return -1
-            elif n_a.startswith("_") and not n_b.startswith("_"):
-                return 1
-            elif n_b.startswith("_") and not n_a.startswith("_"):
-                return -1
-            else:
-                return cmp(n_a, n_b)
-
-        completions.sort(compare_completions)
-        
-        return completions
-
-    def __list_scope(self, scope):
-        # List possible completions given a scope directionary
-        
-        possible = scope.items()
-        if '__builtins__' in scope:
-            builtins = scope['__builtins__']
-            if not isinstance(builtins, dict):
-                builtins = dir(builtins)
-                
-            for k in builtins:
-                if not k in scope:
-                    possible.append((k, builtins[k]))
-
-        return possible
-    
-    def __find_no_symbol_completions(self, scope):
-        # Return the completions to offer when we don't have a start at a symbol
-        
-        result = []
-        for completion, obj in self.__list_scope(scope):
-            result.append((completion, completion, obj))
+    def get_completion_names(self, line, index, min_length=0):
+        """Find the path of names to complete at the given line and index.
 
-        return self.__sort_completions(result)
-    
-    def find_completions(self, line, index, scope, min_length=0):
-        """Returns a list of possible completions at the given line and index.
+        This only looks at the tokenization of the statement, and not at the
+        objects the names refer to, so it is cheap and doesn't call into
+        user code. See L{complete_names} for the second half of the process.
 
-        Scope is the scope to start calculating the comptions from. Each element
-        in the returned list is a tuple of (display_form, text_to_insert, object_completed_to)'
-        where object_completed_to can be used to determine the type of the completion
-        or get docs about it.
+        Returns None if completion doesn't make sense at the position, otherwise
+        a list of names. The leading names are resolved against the scope, and
+        the last name (which may be empty) is the prefix to complete.
 
         @param min_length if supplied, the minimum length to require for an isolated
            name before we complete against the scope. This is useful if we are suggesting
@@ -412,7 +441,7 @@ class TokenizedStatement(object):
         # than useful to complete to symbols in the current scope. Better would be to
         # actually examine the path and complete to real imports.
         if self.__statement_is_import():
-            return []
+            return None
 
         # We can offer completions if we are at a position of the form:
         # ([TOKEN_NAME|TOKEN_BUILTIN_CONSTANT] TOKEN_DOT)* (TOKEN_NAME|TOKEN_KEYWORD|TOKEN_BUILTIN_CONSTANT)?
@@ -440,26 +469,27 @@ class TokenizedStatement(object):
             if iter is not None and iter.token_type == TOKEN_DOT:
                 names = ['']
             elif min_length > 0:
-                return []
+                return None
             # This is a non-exhaustive list of places where we know that we shouldn't complete to the
             # the scope. (We could do better by special casing actual completions for TOKEN_RSQB, TOKEN_RBRACE,
             # TOKEN_STRING)
             elif iter is not None and iter.token_type in (TOKEN_NAME, TOKEN_BUILTIN_CONSTANT, TOKEN_RPAREN, TOKEN_RSQB, TOKEN_RBRACE,
                                                       TOKEN_STRING, TOKEN_NUMBER):
-                return []
+                return None
             elif iter is not None and self.__check_no_completion_after(iter):
-                return []
+                return None
             else:
-                return self.__find_no_symbol_completions(scope)
+                # Complete everything in the scope
+                return ['']
 
         while iter and iter.token_type == TOKEN_DOT:
             try:
                 iter.prev()
             except StopIteration:
-                return []
+                return None
 
             if iter.token_type != TOKEN_NAME and iter.token_type != TOKEN_BUILTIN_CONSTANT:
-                return []
+                return None
 
             names.insert(0, self.lines[iter.line][iter.start:iter.end])
 
@@ -469,70 +499,104 @@ class TokenizedStatement(object):
                 iter = None
 
         if iter and self.__check_no_completion_after(iter):
-            return []
+            return None
 
-        # We resolve the leading portion of the name path
-        if len(names) > 1:
-            object = self.__resolve_names(names[0:-1], scope)
-            if object is None:
-                return []
-        else:
+        if len(names) == 1:
             if len(names[0]) < min_length:
-                return []
+                return None
             # When we are in "spontaneous mode" (slightly hackish to use min_length
             # for this), we don't want to complete if the user might be typing a keyword
             if min_length > 0 and names[0] in KEYWORD_PREFIXES:
-                return []
+                return None
 
-            object = None
+        return names
 
-        # Then we complete the last element of the name path against what we resolved
-        # to, or against the scope (if there was just one name)
-        result = []
-        
-        to_complete = names[-1]
-        if object is None:
-            for completion, obj in self.__list_scope(scope):
-                if completion.startswith(to_complete):
-                    result.append((completion, completion[len(to_complete):], obj))
+    def get_module_completion_names(self, line, index, min_length=0):
+        """Find the module name to complete at the given line and index in an import statement.
+
+        Returns None if the position isn't one where a module name can be entered,
+        otherwise a list of names. The leading names are the components of the
+        package to look for modules in, and the last name (which may be empty) is
+        the prefix to complete. So for 'import os.pa' the result is ['os', 'pa'],
+        and for 'from os import pa' the result is also ['os', 'pa'].
+
+        Relative imports and the names after 'as' are not completed.
+
+        @param min_length if supplied, the minimum length to require for a toplevel
+           module name before we complete.
+
+        """
+
+        if not self.__statement_is_import():
+            return None
+
+        lines = self.lines[0:line] + [self.lines[line][0:index]]
+        # Import statements can't contain strings, so stripping comments and
+        # joining continued lines is easy
+        text = " ".join(re.sub(r'#.*', '', l).rstrip("\\") for l in lines)
+
+        m = IMPORT_MODULE_RE.match(text)
+        if m is None:
+            m = FROM_MODULE_RE.match(text)
+        if m is not None:
+            names = m.group(1).split('.')
         else:
-            for completion in dir(object):
-                if completion.startswith(to_complete):
-
-                    if inspect.ismodule(object):
-                        object_completed_to = getattr(object, completion, None)
-                    # We special case these because obj.__class__.__module__/__doc__
-                    # are also a strings, not a method/property
-                    elif completion != '__module__' and completion != '__doc__':
-                        # Using the attribute of the class over the attribute of
-                        # the object gives us better docs on properties
-                        try:
-                            klass = getattr(object, '__class__')
-                            object_completed_to = getattr(klass, completion)
-                        except AttributeError:
-                            object_completed_to = getattr(object, completion)
-                    else:
-                        object_completed_to = None
-                        
-                    result.append((completion, completion[len(to_complete):], object_completed_to))
-
-        return self.__sort_completions(result)
+            m = FROM_IMPORT_RE.match(text)
+            if m is None:
+                return None
+            # We only complete submodules; other names in the package would
+            # require importing it
+            names = m.group(1).split('.') + [m.group(2)]
+
+        if '' in names[:-1]: # 'import a..b'
+            return None
+
+        if len(names) == 1 and len(names[0]) < min_length:
+            return None
+
+        return names
+
+    def find_completions(self, line, index, scope, min_length=0, scope_index=None):
+        """Returns a list of possible completions at the given line and index.
+
+        Scope is the scope to start calculating the comptions from. Each element
+        in the returned list is a tuple of (display_form, text_to_insert, object_completed_to)'
+        where object_completed_to can be used to determine the type of the completion
+        or get docs about it.
+
+        @param min_length if supplied, the minimum length to require for an isolated
+           name before we complete against the scope. This is useful if we are suggesting
+           completions without the user explicitly requesting it.
+        @param scope_index if supplied, a L{ScopeIndex} for scope. Passing in an index
+           that is kept around between calls avoids rebuilding the list of names in the
+           scope each time.
+
+        """
+
+        names = self.get_completion_names(line, index, min_length)
+        if names is None:
+            return []
+
+        return complete_names(names, scope, scope_index)
             
-    def get_object_at_location(self, line, index, scope, result_scope=None, include_adjacent=False):
-        """Find the object at a particular location within the statement.
+    def get_names_at_location(self, line, index, include_adjacent=False):
+        """Find the path of names at a particular location within the statement.
 
-        Returns a tuple of (object, token_start_line, token_start_index, token_end_line, token_end_index)
-        or None, None, None, None, None if there is no object
+        Like L{get_completion_names}, this only looks at the tokenization of the
+        statement; use L{resolve_names} to find the object that the names refer to.
+
+        Returns a tuple of (names, is_assigned, token_start_index, token_end_index) or
+        None, None, None, None if there are no names at the location. is_assigned is
+        True if the names are on the left side of an assignment, in which case they
+        should be resolved against the result scope of the statement.
 
-        @param scope: scope dictionary to start resolving names from.
-        @param result_scope: scope to resolve names from on the left side of an assignment
         @param include_adjacent: if False, then line/index identifies a character in the buffer. If True,
            then line/index identifies a position between characters, and symbols before or after that
            position are included.
 
         """
 
-        NO_RESULT = None, None, None, None, None
+        NO_RESULT = None, None, None, None
 
         # Names within an import statement aren't there yet
         if self.__statement_is_import():
@@ -581,22 +645,45 @@ class TokenizedStatement(object):
 
             names.insert(0, self.lines[iter.line][iter.start:iter.end])
 
-        if result_scope is not None:
-            while True:
-                try:
-                    iter.next()
-                except StopIteration:
-                    break
-                
-                if iter.token_type == TOKEN_EQUAL or iter.token_type == TOKEN_AUGEQUAL:
-                    scope = result_scope
-                    break
+        is_assigned = False
+        while True:
+            try:
+                iter.next()
+            except StopIteration:
+                break
+
+            if iter.token_type == TOKEN_EQUAL or iter.token_type == TOKEN_AUGEQUAL:
+                is_assigned = True
+                break
+
+        return names, is_assigned, start_index, end_index
 
-        obj = self.__resolve_names(names, scope)
+    def get_object_at_location(self, line, index, scope, result_scope=None, include_adjacent=False):
+        """Find the object at a particular location within the statement.
+
+        Returns a tuple of (object, token_start_line, token_start_index, token_end_line, token_end_index)
+        or None, None, None, None, None if there is no object
+
+        @param scope: scope dictionary to start resolving names from.
+        @param result_scope: scope to resolve names from on the left side of an assignment
+        @param include_adjacent: if False, then line/index identifies a character in the buffer. If True,
+           then line/index identifies a position between characters, and symbols before or after that
+           position are included.
+
+        """
+
+        names, is_assigned, start_index, end_index = self.get_names_at_location(line, index, include_adjacent)
+        if names is None:
+            return None, None, None, None, None
+
+        if is_assigned and result_scope is not None:
+            scope = result_scope
+
+        obj = resolve_names(names, scope)
         if obj is not None:
             return obj, line, start_index, line, end_index
         else:
-            return NO_RESULT
+            return None, None, None, None, None
 
     def __repr__(self):
         return "TokenizedStatement" + repr([([(t[0], line[t[1]:t[2]]) for t in tokens], stack) for line, tokens, stack in zip(self.lines, self.tokens, self.stacks)])
@@ -805,6 +892,31 @@ if __name__ == '__main__':
     test_completion("for a in", []) # Don't complete to 'indecent', syntax doesn't allow it
     test_completion("in", [], min_length=2) # Don't complete to 'indecent', because we have a keyword prefix
 
+    def test_module_completion(line, expected, min_length=0):
+        ts = TokenizedStatement()
+        ts.set_lines(line.split("\n"))
+        names = ts.get_module_completion_names(len(ts.lines) - 1, len(ts.lines[-1]), min_length)
+        if names != expected:
+            print "For module completion of %r, got %s, expected %s" % (line,names,expected)
+            failed = True
+
+    test_module_completion("import ", [''])
+    test_module_completion("import o", ['o'])
+    test_module_completion("import o", None, min_length=2)
+    test_module_completion("import os.pa", ['os', 'pa'])
+    test_module_completion("import sys, os.", ['os', ''])
+    test_module_completion("import os ", None)
+    test_module_completion("import os as p", None)
+    test_module_completion("from os", ['os'])
+    test_module_completion("from os.", ['os', ''])
+    test_module_completion("from .", None)
+    test_module_completion("from os import pa", ['os', 'pa'])
+    test_module_completion("from os import path, s", ['os', 's'])
+    test_module_completion("from os import path as p", None)
+    test_module_completion("from os import (path, # comment\n  s", ['os', 's'])
+    test_module_completion("from os \\\n  import s", ['os', 's'])
+    test_module_completion("x = os.pa", None)
+
     test_multiline_completion(["(obj.", "m"], 1, 0, ['method', '__doc__', '__module__'])
     test_multiline_completion(["(obj.", "m"], 1, 1, ['method'])
     
@@ -7,19 +7,28 @@
 ########################################################################
 
 import sys
+import thread
 
-import gobject
 import logging
 import os
 import re
 from StringIO import StringIO
 
+from calculation import Calculation
 from change_range import ChangeRange
+from checkpoint_store import CheckpointStore
 from chunks import *
+from completion_index import ScopeIndex
+import main_loop
+import memo_cache
 from notebook import Notebook, NotebookFile
+from execution_scheduler import execution_scheduler, ScheduledRun
 import reunicode
+import saved_results
+from signals import Property, SignalObject
 from statement import Statement
-from thread_executor import ThreadExecutor
+from thread_executor import ExecutorWorker, ThreadExecutor
+from tokenized_statement import complete_names, resolve_names
 from undo_stack import UndoStack, InsertOp, DeleteOp
 
 _debug = logging.getLogger("Worksheet").debug
@@ -40,6 +49,9 @@ CONTINUATION = 3
 
 NEW_LINE_RE = re.compile(r'\n|\r|\r\n')
 
+# How long to wait after the last edit before calculating, when auto_calculate is set (ms)
+AUTO_CALCULATE_DELAY = 500
+
 def calc_line_class(text):
     if BLANK_RE.match(text):
         return BLANK
@@ -62,16 +74,32 @@ def order_positions(start_line, start_offset, end_line, end_offset):
 
     return start_line, start_offset, end_line, end_offset
 
-class Worksheet(gobject.GObject):
-    __gsignals__ = {
+def _import_uses_modules(module, symbols, module_names):
+    # Check if an import, as returned by Rewriter.get_imports(), uses any of
+    # the given modules. Importing a.b.c imports a and a.b as well, and
+    # 'from a import b' may import the submodule a.b.
+    components = module.split('.')
+    for i in xrange(1, len(components) + 1):
+        if '.'.join(components[0:i]) in module_names:
+            return True
+
+    if symbols != '*':
+        for name, _ in symbols:
+            if name != '.' and module + '.' + name in module_names:
+                return True
+
+    return False
+
+class Worksheet(SignalObject):
+    __signals__ = {
         # text-* are emitted before we fix up our internal state, so what can be done
         # in them are limited. They are meant for keeping a UI in sync with the internal
         # state.
-        'text-inserted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int, str)),
-        'text-deleted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int, int, int)),
-        'lines-inserted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int)),
-        'lines-deleted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int)),
-        'chunk-inserted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'text-inserted': (int, int, str),
+        'text-deleted': (int, int, int, int),
+        'lines-inserted': (int, int),
+        'lines-deleted': (int, int),
+        'chunk-inserted': (object,),
         # Chunk changed is emitted when the text or tokenization of a chunk
         # changes. Note that "changes" here specifically includes being
         # replaced by identical text, so if I have the two chunks
@@ -84,22 +112,24 @@ class Worksheet(gobject.GObject):
         # This is because text in a buffering that is shadowing us may
         # be tagged with fonts/styles.
         #
-        'chunk-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT)),
-        'chunk-deleted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
-        'chunk-status-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
-        'chunk-results-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'chunk-changed': (object, object),
+        'chunk-deleted': (object,),
+        'chunk-status-changed': (object,),
+        'chunk-results-changed': (object,),
         # This is only for the convenience of the undo stack; otherwise we ignore cursor position
-        'place-cursor': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int))
+        'place-cursor': (int, int)
     }
 
     def __init__(self, notebook, edit_only=False):
-        gobject.GObject.__init__(self)
+        SignalObject.__init__(self)
 
         self.notebook = notebook
         self.edit_only = edit_only
         self.__file = None
         self.__filename = None
         self.__code_modified = False
+        # Whether the results have changed since we last saved them
+        self.__results_modified = False
 
         self.global_scope = {}
         notebook.setup_globals(self.global_scope)
@@ -124,6 +154,24 @@ class Worksheet(gobject.GObject):
 
         self.__undo_stack = UndoStack(self)
 
+        self.__executor = None
+        # ScheduledRun for __executor
+        self.__run = None
+        # Thread that calculations are executed in, created on the first calculation
+        self.__worker = None
+        self.__auto_calculate = False
+        self.__auto_calculate_source = None
+        # Whether we need to calculate automatically when the current calculation completes
+        self.__auto_calculate_pending = False
+
+        # Map from id(scope) => (scope, ScopeIndex) for the scopes we've completed against
+        # since the last calculation. Completion happens in a lookup thread, so this
+        # is protected by __scope_indexes_lock; __scope_indexes_serial is incremented
+        # when the map is cleared.
+        self.__scope_indexes = {}
+        self.__scope_indexes_lock = thread.allocate_lock()
+        self.__scope_indexes_serial = 0
+
         notebook._add_worksheet(self)
 
     def do_import(self, name, globals, locals, fromlist, level):
@@ -177,13 +225,14 @@ class Worksheet(gobject.GObject):
                 self.emit('chunk-status-changed', chunk)
             if isinstance(chunk, StatementChunk) and chunk.results_changed:
                 chunk.results_changed = False
+                self.__results_modified = True
                 self.emit('chunk-results-changed', chunk)
 
     def __chunk_changed(self, chunk):
         self.__changed_chunks.add(chunk)
 
     def __mark_rest_for_execute(self, start_line):
-        if self.state != NotebookFile.NEEDS_EXECUTE:
+        if self.__executor is None and self.state != NotebookFile.NEEDS_EXECUTE:
             self.__set_state(NotebookFile.NEEDS_EXECUTE)
 
         # Mark all statements starting from start_line as needing execution.
@@ -401,8 +450,8 @@ class Worksheet(gobject.GObject):
         if len(text) == 0:
             return
 
-        if self.state == NotebookFile.EXECUTING:
-            return
+        if self.__executor is not None:
+            self.__cancel_execution(line, offset)
 
         self.__freeze_changes()
 
@@ -472,6 +521,8 @@ class Worksheet(gobject.GObject):
         if self.__user_action_count > 0 and not self.code_modified:
             self.code_modified = True
 
+        self.__queue_auto_calculate()
+
     def __delete_lines(self, start_line, end_line):
         # Delete an integral number of lines, fixing up the affected chunks
         # and the __chunks[]/__lines[] arrays
@@ -505,16 +556,16 @@ class Worksheet(gobject.GObject):
     def delete_range(self, start_line, start_offset, end_line, end_offset):
         _debug("Deleting from %s,%s to %s,%s", start_line, start_offset, end_line, end_offset)
 
-        if self.state == NotebookFile.EXECUTING:
-            return
-
         if start_line == end_line and start_offset == end_offset:
             return
 
-        self.__freeze_changes()
-
         start_line, start_offset, end_line, end_offset = order_positions(start_line, start_offset, end_line, end_offset)
 
+        if self.__executor is not None:
+            self.__cancel_execution(start_line, start_offset)
+
+        self.__freeze_changes()
+
         deleted_text = self.get_text(start_line, start_offset, end_line, end_offset)
 
         self.emit('text-deleted', start_line, start_offset, end_line, end_offset)
@@ -542,6 +593,8 @@ class Worksheet(gobject.GObject):
         if self.__user_action_count > 0 and not self.code_modified:
             self.code_modified = True
 
+        self.__queue_auto_calculate()
+
     def place_cursor(self, line, offset):
         _debug("Place cursor at %s,%s", line, offset)
         self.emit('place-cursor', line, offset)
@@ -552,8 +605,13 @@ class Worksheet(gobject.GObject):
     def redo(self):
         self.__undo_stack.redo()
 
-    def module_changed(self, module_name):
-        """Mark statements for execution after a change to the given module"""
+    def modules_changed(self, module_names):
+        """Mark statements for execution after a change to the given modules
+
+        Everything is re-executed from the first statement that imports
+        any of the modules.
+
+        """
 
         for chunk in self.iterate_chunks():
             if not isinstance(chunk, StatementChunk):
@@ -565,13 +623,125 @@ class Worksheet(gobject.GObject):
             if imports is None:
                 continue
 
-            for module, _ in imports:
-                if module == module_name:
+            for module, symbols in imports:
+                if _import_uses_modules(module, symbols, module_names):
                     self.__mark_rest_for_execute(chunk.start)
+                    return
+
+    def names_changed(self, names):
+        """Mark statements for execution after functions or classes with the given names were updated in place
+
+        Everything is re-executed from the first statement that references
+        any of the names.
+
+        """
+
+        for chunk in self.iterate_chunks():
+            if not isinstance(chunk, StatementChunk):
+                continue
+            if chunk.statement is None:
+                continue
+
+            referenced = chunk.statement.referenced_names
+            if referenced is not None and len(referenced.intersection(names)) > 0:
+                self.__mark_rest_for_execute(chunk.start)
+                return
+
+    def calculate(self, wait=False, up_to_line=None):
+        """Execute the statements in the worksheet that need to be executed
+
+        @param wait: if True, run a main loop until the calculation is complete.
+           Otherwise, the calculation continues in the background.
+        @param up_to_line: see L{calculate_async}
+
+        """
+
+        calculation = self.calculate_async(up_to_line=up_to_line)
+        if wait and not calculation.done():
+            loop = main_loop.MainLoop()
+            calculation.add_done_callback(lambda calculation: loop.quit())
+            loop.run()
+
+    def __needs_execute(self):
+        for chunk in self.iterate_chunks():
+            if isinstance(chunk, StatementChunk) and (chunk.needs_compile or chunk.needs_execute):
+                return True
+
+        return False
+
+    def __cancel_execution(self, line, offset):
+        # Called before an edit at the given position during a calculation. Statements
+        # at or after the line may be affected by the edit, so we stop executing them;
+        # statements before the line continue executing.
+        previous = None
+        for statement in self.__executor.statements:
+            if statement.chunk.end > line:
+                break
+            previous = statement
+        else:
+            statement = None
+
+        # An edit at the start of a line can make the line a continuation of the
+        # statement before it
+        if offset == 0 and previous is not None:
+            statement = previous
+
+        if statement is not None:
+            _debug("Cancelling execution from line %d", statement.chunk.start)
+            self.__executor.cancel(statement)
+
+    def __is_current_statement(self, executor, statement):
+        # Check that a statement being executed is still the statement of its chunk,
+        # and wasn't cancelled because of an edit
+        chunk = statement.chunk
+        return (chunk.statement is statement and
+                chunk.start < len(self.__chunks) and self.__chunks[chunk.start] is chunk and
+                not executor.is_cancelled(statement))
+
+    def __discard_statement(self, statement):
+        # Called when execution of a statement was cancelled. If the statement
+        # is still the statement of its chunk, the chunk needs execution again.
+        chunk = statement.chunk
+        if chunk.statement is not statement:
+            return
+        if chunk.start >= len(self.__chunks) or self.__chunks[chunk.start] is not chunk:
+            return
+
+        statement.mark_for_execute()
+        chunk.executing = False
+        chunk.update_statement()
+        self.__chunk_changed(chunk)
+
+    def calculate_async(self, up_to_line=None, background=False):
+        """Start executing the statements in the worksheet that need to be executed
+
+        The calculation is queued if too many other worksheets are calculating; see
+        L{ExecutionScheduler}. The state of the worksheet is NotebookFile.QUEUED until
+        it starts.
+
+        @param up_to_line: if not None, only execute statements up to and including the
+           chunk containing this line. Later statements are left needing execution.
+        @param background: True if the calculation wasn't explicitly requested by
+           the user. Background calculations are started after other queued calculations.
+        @returns: a L{Calculation} object that can be used to follow the progress of
+           the calculation and wait for it to complete.
+
+        """
 
-    def calculate(self, wait=False):
         _debug("Calculating")
 
+        calculation = Calculation(self)
+
+        # Calculation replaces the result scopes of statements; we don't want to keep
+        # the old scopes alive via our completion indexes
+        self.__scope_indexes_lock.acquire()
+        try:
+            self.__scope_indexes.clear()
+            self.__scope_indexes_serial += 1
+        finally:
+            self.__scope_indexes_lock.release()
+        memo_cache.forget_digests()
+
         self.__freeze_changes()
 
         parent = None
@@ -579,13 +749,29 @@ class Worksheet(gobject.GObject):
 
         executor = None
 
-        for chunk in self.iterate_chunks():
+        start_line = 0
+        if up_to_line is not None:
+            end_line = self.__chunks[min(up_to_line, len(self.__chunks) - 1)].end
+        else:
+            end_line = len(self.__chunks)
+
+        checkpoint_store = self.notebook.get_checkpoint_store()
+        checkpoint_keys = {}
+        if checkpoint_store is not None:
+            restored_chunk = self.__restore_checkpoint(checkpoint_store, checkpoint_keys, end_line)
+            if restored_chunk is not None:
+                start_line = restored_chunk.end
+                parent = restored_chunk.statement
+
+        for chunk in self.iterate_chunks(start_line, end_line):
             if isinstance(chunk, StatementChunk):
                 changed = False
 
                 if chunk.needs_compile or chunk.needs_execute:
                     if not executor:
-                        executor = ThreadExecutor(parent)
+                        if self.__worker is None:
+                            self.__worker = ExecutorWorker()
+                        executor = ThreadExecutor(parent, worker=self.__worker)
 
                 if executor:
                     statement = chunk.get_statement(self)
@@ -594,10 +780,10 @@ class Worksheet(gobject.GObject):
                 parent = chunk.statement
 
         if executor:
-            if wait:
-                loop = gobject.MainLoop()
-
             def on_statement_execution_state_changed(executor, statement):
+                if not self.__is_current_statement(executor, statement):
+                    return
+
                 if (statement.state == Statement.COMPILE_ERROR or
                     statement.state == Statement.EXECUTE_ERROR or
                     statement.state == Statement.INTERRUPTED):
@@ -612,33 +798,186 @@ class Worksheet(gobject.GObject):
                 else:
                     self.__chunk_changed(statement.chunk)
 
+            def on_statement_complete(executor, statement):
+                if self.__is_current_statement(executor, statement):
+                    on_statement_execution_state_changed(executor, statement)
+                    if checkpoint_store is not None:
+                        self.__save_checkpoint(checkpoint_store, checkpoint_keys, statement)
+                else:
+                    self.__freeze_changes()
+                    self.__discard_statement(statement)
+                    self.__thaw_changes()
+                calculation._statement_complete(statement)
+
             def on_complete(executor):
                 self.__executor = None
-                self.__set_state(NotebookFile.ERROR if self.__executor_error else NotebookFile.EXECUTE_SUCCESS)
-                if wait:
-                    loop.quit()
+                self.__run = None
+                if self.__executor_error:
+                    self.__set_state(NotebookFile.ERROR)
+                elif self.__needs_execute():
+                    self.__set_state(NotebookFile.NEEDS_EXECUTE)
+                else:
+                    self.__set_state(NotebookFile.EXECUTE_SUCCESS)
+                calculation._complete(not self.__executor_error)
+
+                if self.__auto_calculate_pending:
+                    self.__auto_calculate_pending = False
+                    self.__queue_auto_calculate()
 
             self.__executor = executor
             self.__executor_error = False
             self.__set_state(NotebookFile.EXECUTING)
             executor.connect('statement-executing', on_statement_execution_state_changed)
-            executor.connect('statement-complete', on_statement_execution_state_changed)
+            executor.connect('statement-complete', on_statement_complete)
             executor.connect('complete', on_complete)
+            # Apply the changes for each batch of progress in one pass
+            executor.connect('batch-begin', lambda executor: self.__freeze_changes())
+            executor.connect('batch-end', lambda executor: self.__thaw_changes())
 
             if executor.compile():
-                executor.execute()
-                if wait:
-                    loop.run()
+                self.__run = execution_scheduler.submit(executor, self, background=background)
+                if self.__run.state == ScheduledRun.QUEUED:
+                    self.__set_state(NotebookFile.QUEUED)
+                    self.__run.connect('notify::state', self.__on_run_state_changed)
         else:
             # Nothing to execute, we could have been in a non-success state if statements were deleted
             # at the end of the file.
-            self.__set_state(NotebookFile.EXECUTE_SUCCESS)
+            if self.__needs_execute():
+                self.__set_state(NotebookFile.NEEDS_EXECUTE)
+            else:
+                self.__set_state(NotebookFile.EXECUTE_SUCCESS)
+            calculation._complete(True)
 
         self.__thaw_changes()
 
+        return calculation
+
+    def __restore_checkpoint(self, store, keys, end_line):
+        # Fill keys with the checkpoint keys for all statement chunks before end_line. Then
+        # if any statement has a checkpoint and doesn't come before the first statement that
+        # needs to be executed, restore the last such statement from its checkpoint
+        # and return its chunk, so that execution can start after it.
+        # Statements before that chunk that need to be executed are left unexecuted.
+        chunks = []
+        first_needed = None
+        key = None
+        for chunk in self.iterate_chunks(0, end_line):
+            if isinstance(chunk, StatementChunk):
+                key = CheckpointStore.make_key(key, chunk.tokenized.get_text())
+                keys[chunk] = key
+                if first_needed is None and (chunk.needs_compile or chunk.needs_execute):
+                    first_needed = len(chunks)
+                chunks.append(chunk)
+
+        if first_needed is None:
+            return None
+
+        for i in xrange(len(chunks) - 1, first_needed - 1, -1):
+            chunk = chunks[i]
+            if not store.contains(keys[chunk]):
+                continue
+
+            if not (chunk.needs_compile or chunk.needs_execute):
+                # Restored by a previous calculation
+                return chunk
+
+            scope = store.restore(keys[chunk], self.global_scope, self.notebook)
+            if scope is None:
+                continue
+
+            # The statements up to the restored statement are compiled, since the
+            # following statements depend on the features they import from __future__
+            parent = None
+            for previous in chunks[0:i + 1]:
+                statement = previous.get_statement(self)
+                statement.set_parent(parent)
+                if not statement.compile():
+                    return None
+                if previous.needs_compile:
+                    previous.update_statement()
+                    self.__chunk_changed(previous)
+                parent = statement
+
+            chunk.statement.restore(scope)
+            chunk.update_statement()
+            self.__chunk_changed(chunk)
+
+            return chunk
+
+        return None
+
+    def __save_checkpoint(self, store, keys, statement):
+        if statement.state != Statement.EXECUTE_SUCCESS or statement.execution_time < store.threshold:
+            return
+
+        # Find the closest previous checkpoint to save the changes relative to; if
+        # there is a statement without a result scope in between, we save the
+        # complete scope
+        base_key = None
+        base_scope = self.global_scope
+        line = statement.chunk.start - 1
+        while line >= 0:
+            chunk = self.__chunks[line]
+            if isinstance(chunk, StatementChunk):
+                if chunk.statement is None or chunk.statement.result_scope is None:
+                    break
+                if store.contains(keys[chunk]):
+                    base_key = keys[chunk]
+                    base_scope = chunk.statement.result_scope
+                    break
+            line = chunk.start - 1
+
+        store.save(keys[statement.chunk], base_key, base_scope, statement.result_scope, self.notebook)
+
+    def __on_run_state_changed(self, run, *args):
+        if run is self.__run and run.state == ScheduledRun.RUNNING:
+            self.__set_state(NotebookFile.EXECUTING)
+
     def interrupt(self):
-        if self.state == NotebookFile.EXECUTING:
-            self.__executor.interrupt()
+        if self.state == NotebookFile.EXECUTING or self.state == NotebookFile.QUEUED:
+            self.__run.interrupt()
+
+    def __queue_auto_calculate(self):
+        if not self.__auto_calculate or self.edit_only:
+            return
+
+        if self.__auto_calculate_source is not None:
+            main_loop.source_remove(self.__auto_calculate_source)
+        self.__auto_calculate_source = main_loop.timeout_add(AUTO_CALCULATE_DELAY, self.__on_auto_calculate)
+
+    def __on_auto_calculate(self):
+        self.__auto_calculate_source = None
+
+        if self.__executor is not None:
+            # Restarted when the current calculation completes; the part of the
+            # calculation affected by edits has already been cancelled
+            self.__auto_calculate_pending = True
+        elif self.__user_action_count > 0:
+            self.__queue_auto_calculate()
+        elif self.__needs_execute():
+            _debug("Calculating automatically")
+            self.calculate_async(background=True)
+
+        return False
+
+    def __get_auto_calculate(self):
+        return self.__auto_calculate
+
+    def __set_auto_calculate(self, auto_calculate):
+        if auto_calculate == self.__auto_calculate:
+            return
+
+        self.__auto_calculate = auto_calculate
+        if auto_calculate:
+            self.__queue_auto_calculate()
+        elif self.__auto_calculate_source is not None:
+            main_loop.source_remove(self.__auto_calculate_source)
+            self.__auto_calculate_source = None
+
+    #: If True, the worksheet is calculated automatically shortly after each edit.
+    #: Edits can be made while the worksheet is calculating; statements that may
+    #: be affected by an edit stop executing and are executed again.
+    auto_calculate = Property(getter=__get_auto_calculate, setter=__set_auto_calculate, type=bool, default=False)
 
     def __get_last_scope(self, chunk):
         # Get the last result scope we have that precedes the specified chunk
@@ -658,6 +997,105 @@ class Worksheet(gobject.GObject):
 
         return self.global_scope
 
+    def __get_scope_index(self, scope):
+        # Get a (cached) ScopeIndex for the given scope. Can be called from any thread
+
+        self.__scope_indexes_lock.acquire()
+        try:
+            cached_scope, index = self.__scope_indexes.get(id(scope), (None, None))
+            serial = self.__scope_indexes_serial
+        finally:
+            self.__scope_indexes_lock.release()
+
+        if cached_scope is scope and index.is_valid_for(scope):
+            return index
+
+        # Building the index may be slow, so we don't hold the lock for it. If a
+        # calculation started meanwhile, the scope is stale and we don't keep the index
+        index = ScopeIndex(scope)
+
+        self.__scope_indexes_lock.acquire()
+        try:
+            if self.__scope_indexes_serial == serial:
+                self.__scope_indexes[id(scope)] = (scope, index)
+        finally:
+            self.__scope_indexes_lock.release()
+
+        return index
+
+    def get_completion_names(self, line, offset, min_length=0):
+        """Find the scope and path of names to complete at the given position.
+
+        This doesn't call into user code, so is always fast. Completions can then
+        be found using complete_names(), which may be slow.
+
+        Returns a tuple of (scope, names), or (None, None) if completion doesn't
+        make sense at the position. See L{TokenizedStatement.get_completion_names}
+
+        @param min_length if supplied, the minimum length to require for an isolated
+           name before we complete against the scope. This is useful if we are suggesting
+           completions without the user explicitly requesting it.
+
+        """
+
+        chunk = self.__chunks[line]
+        if not isinstance(chunk, StatementChunk) and not isinstance(chunk, BlankChunk):
+            return None, None
+
+        if isinstance(chunk, StatementChunk):
+            names = chunk.tokenized.get_completion_names(line - chunk.start,
+                                                         offset,
+                                                         min_length=min_length)
+        else:
+            # A BlankChunk Create a dummy TokenizedStatement to get the completions
+            # appropriate for the start of a line
+            ts = TokenizedStatement()
+            ts.set_lines([''])
+            names = ts.get_completion_names(0, 0, min_length=min_length)
+
+        if names is None:
+            return None, None
+
+        return self.__get_last_scope(chunk), names
+
+    def complete_names(self, scope, names):
+        """Return a list of possible completions for a path of names returned by get_completion_names()
+
+        This calls into user code, so can be slow. Apart from scope, it only
+        uses the worksheet's cache of completion indexes, which is protected by
+        a lock, so it can be called from a thread other than the main thread.
+        The elements of the returned list are as for find_completions().
+
+        """
+
+        return complete_names(names, scope, self.__get_scope_index(scope))
+
+    def find_module_completions(self, line, offset, min_length=0):
+        """Returns a list of possible module names at a position within an import statement.
+
+        The module names are found from an index of the notebook's path and sys.path,
+        without importing anything. The elements of the returned list are as for
+        find_completions(), with None as the object completed to.
+
+        @returns: the list of completions, or None if the position isn't one where
+           a module name can be entered
+
+        """
+
+        chunk = self.__chunks[line]
+        if not isinstance(chunk, StatementChunk):
+            return None
+
+        names = chunk.tokenized.get_module_completion_names(line - chunk.start,
+                                                            offset,
+                                                            min_length=min_length)
+        if names is None:
+            return None
+
+        prefix = names[-1]
+        return [(name, name[len(prefix):], None)
+                for name in self.notebook.find_modules(names[0:-1], prefix)]
+
     def find_completions(self, line, offset, min_length=0):
         """Returns a list of possible completions at the given position.
 
@@ -672,23 +1110,45 @@ class Worksheet(gobject.GObject):
 
         """
 
-        chunk = self.__chunks[line]
-        if not isinstance(chunk, StatementChunk) and not isinstance(chunk, BlankChunk):
+        completions = self.find_module_completions(line, offset, min_length)
+        if completions is not None:
+            return completions
+
+        scope, names = self.get_completion_names(line, offset, min_length)
+        if names is None:
             return []
 
-        scope = self.__get_last_scope(chunk)
+        return self.complete_names(scope, names)
 
-        if isinstance(chunk, StatementChunk):
-            return chunk.tokenized.find_completions(line - chunk.start,
-                                                    offset,
-                                                    scope,
-                                                    min_length=min_length)
+    def get_names_at_location(self, line, offset, include_adjacent=False):
+        """Find the path of names at a particular location within the worksheet
+
+        Like get_completion_names(), this doesn't call into user code. The names
+        can be resolved to an object with L{resolve_names}.
+
+        @param include_adjacent: see get_object_at_location()
+
+        @returns: a tuple of (names, scope, start_line, start_offset, end_line, end_offset)
+           or (None, None, None, None, None, None)
+
+        """
+
+        chunk = self.__chunks[line]
+        if not isinstance(chunk, StatementChunk):
+            return None, None, None, None, None, None
+
+        names, is_assigned, start_index, end_index = \
+            chunk.tokenized.get_names_at_location(line - chunk.start, offset, include_adjacent)
+
+        if names is None:
+            return None, None, None, None, None, None
+
+        if is_assigned and chunk.statement is not None and chunk.statement.result_scope is not None:
+            scope = chunk.statement.result_scope
         else:
-            # A BlankChunk Create a dummy TokenizedStatement to get the completions
-            # appropriate for the start of a line
-            ts = TokenizedStatement()
-            ts.set_lines([''])
-            return ts.find_completions(0, 0, scope, min_length=min_length)
+            scope = self.__get_last_scope(chunk)
+
+        return names, scope, line, start_index, line, end_index
 
     def get_object_at_location(self, line, offset, include_adjacent=False):
         """Find the object at a particular location within the worksheet
@@ -701,27 +1161,17 @@ class Worksheet(gobject.GObject):
 
         """
 
-        chunk = self.__chunks[line]
-        if not isinstance(chunk, StatementChunk):
-            return None, None, None, None, None
-
-        if chunk.statement is not None and chunk.statement.result_scope is not None:
-            result_scope = chunk.statement.result_scope
-        else:
-            result_scope = None
+        names, scope, start_line, start_offset, end_line, end_offset = \
+            self.get_names_at_location(line, offset, include_adjacent)
 
-        obj, start_line, start_index, end_line, end_index = \
-            chunk.tokenized.get_object_at_location(line - chunk.start, offset,
-                                                   self.__get_last_scope(chunk),
-                                                   result_scope, include_adjacent)
+        if names is None:
+            return None, None, None, None, None
 
+        obj = resolve_names(names, scope)
         if obj is None:
             return None, None, None, None, None
 
-        start_line += chunk.start
-        end_line += chunk.start
-
-        return obj, start_line, start_index, end_line, end_index
+        return obj, start_line, start_offset, end_line, end_offset
 
     def __do_clear(self):
         self.delete_range(0, 0, len(self.__lines) - 1, len(self.__lines[len(self.__lines) - 1]));
@@ -827,9 +1277,9 @@ class Worksheet(gobject.GObject):
     def __get_filename(self):
         return self.__filename
 
-    filename = gobject.property(getter=__get_filename, setter=__set_filename, type=str, default=None)
+    filename = Property(getter=__get_filename, setter=__set_filename, type=str, default=None)
 
-    @gobject.property
+    @Property
     def file(self):
         return self.__file
 
@@ -844,8 +1294,8 @@ class Worksheet(gobject.GObject):
     def __get_code_modified(self):
         return self.__code_modified
 
-    code_modified = gobject.property(getter=__get_code_modified, setter=__set_code_modified, type=bool, default=False)
-    state = gobject.property(type=int, default=NotebookFile.EXECUTE_SUCCESS)
+    code_modified = Property(getter=__get_code_modified, setter=__set_code_modified, type=bool, default=False)
+    state = Property(type=int, default=NotebookFile.EXECUTE_SUCCESS)
 
     def __set_filename_and_modified(self, filename, modified):
         self.freeze_notify()
@@ -853,7 +1303,7 @@ class Worksheet(gobject.GObject):
         self.code_modified = modified
         self.thaw_notify()
 
-    def load(self, filename, escape=False):
+    def load(self, filename, escape=False, with_results=True):
         """Load a file from disk into the worksheet. Can raise IOError if the
         file cannot be read, and reunicode.ConversionError if the file contains
         invalid characters. (reunicode.ConversionError will not be raised if
@@ -862,14 +1312,27 @@ class Worksheet(gobject.GObject):
         @param filename the file to load
         @param escape if true, invalid byte and character sequences in the input
            will be converted into \\x<nn> and \\u<nnnn> escape sequences.
+        @param with_results if true, the results saved when the worksheet was last
+           saved are shown for the statements, which are marked as needing execution.
+           (See the saved_results module.)
 
         """
         f = open(filename)
         text = f.read()
         f.close()
 
-        self.__do_clear()
-        self.insert(0, 0, reunicode.decode(text, escape=escape))
+        self.__freeze_changes()
+        try:
+            self.__do_clear()
+            self.insert(0, 0, reunicode.decode(text, escape=escape))
+            if with_results and not self.edit_only:
+                self.rescan()
+                self.__restore_results(filename)
+        finally:
+            self.__thaw_changes()
+
+        # The results shown are now the same as the saved results
+        self.__results_modified = False
         # A bit of a hack - we assume that if escape was passed we *did* escape.
         # this is the way that things work currently - first the GUI loads with
         # escape=False, and if that fails, prompts the user and loads with escape=True
@@ -884,6 +1347,8 @@ class Worksheet(gobject.GObject):
             filename = self.__filename
 
         if not self.code_modified and filename == self.__filename:
+            if self.__results_modified:
+                self.__save_results(filename)
             return
 
         filename_changed = filename != self.__filename
@@ -912,6 +1377,8 @@ class Worksheet(gobject.GObject):
             os.rename(tmpname, filename)
             success = True
 
+            self.__save_results(filename)
+
             # Need to refresh the notebook before saving so that we find the NotebookFile
             # properly in __set_filename_and_modified
             if filename_changed:
@@ -927,7 +1394,50 @@ class Worksheet(gobject.GObject):
                 except:
                     pass
 
+    def __restore_results(self, filename):
+        saved = saved_results.load_results(filename)
+        if len(saved) == 0:
+            return
+
+        occurrences = {}
+        for chunk in self.iterate_chunks():
+            if not isinstance(chunk, StatementChunk):
+                continue
+
+            key = saved_results.get_statement_key(chunk.tokenized.get_text())
+            index = occurrences.get(key, 0)
+            occurrences[key] = index + 1
+            entries = saved.get(key, ())
+            if index >= len(entries) or entries[index] is None:
+                continue
+
+            chunk.results, chunk.error_message, chunk.error_line = entries[index]
+            chunk.needs_execute = True
+            chunk.results_changed = True
+            chunk.status_changed = True
+            self.__chunk_changed(chunk)
+
+    def __save_results(self, filename):
+        if self.edit_only:
+            return
+
+        chunks = [chunk for chunk in self.iterate_chunks() if isinstance(chunk, StatementChunk)]
+        if saved_results.save_results(filename, chunks):
+            self.__results_modified = False
+
     def close(self):
+        if self.__auto_calculate_source is not None:
+            main_loop.source_remove(self.__auto_calculate_source)
+            self.__auto_calculate_source = None
+
+        if self.__run is not None:
+            self.__run.interrupt()
+        if execution_scheduler.focused_worksheet is self:
+            execution_scheduler.focused_worksheet = None
+        if self.__worker is not None:
+            self.__worker.shutdown()
+            self.__worker = None
+
         if self.__file:
             self.__file.worksheet = None
             self.__file.modified = False
@@ -942,8 +1452,6 @@ if __name__ == '__main__': #pragma: no cover
     if "-d" in sys.argv:
         logging.basicConfig(level=logging.DEBUG, format="DEBUG: %(message)s")
 
-    gobject.threads_init()
-
     import stdout_capture
     stdout_capture.init()
 
@@ -1300,6 +1808,21 @@ if __name__ == '__main__': #pragma: no cover
     insert(1, 0, "#")
     assert worksheet.get_chunk(2).needs_execute
 
+    # Test that a change to an imported module marks statements from the first
+    # import of it for recalculation
+    clear()
+
+    insert(0, 0, "a = 1\nimport os.path\nfrom re import match\nb = 2")
+    calculate()
+    worksheet.modules_changed(set(["re"]))
+    assert not worksheet.get_chunk(1).needs_execute
+    assert worksheet.get_chunk(2).needs_execute
+    assert worksheet.get_chunk(3).needs_execute
+    calculate()
+    worksheet.modules_changed(set(["os"]))
+    assert not worksheet.get_chunk(0).needs_execute
+    assert worksheet.get_chunk(1).needs_execute
+
     # Test that we don't send out ::chunk-deleted signal for chunks for
     # which we never sent a ::chunk-inserted signal
 
@@ -1444,14 +1967,234 @@ b = 2"""
         if saved != SAVE_TEST:
             raise AssertionError("Got '%s', expected '%s'", saved, SAVE_TEST)
 
+        # The saved results are shown before calculating
         worksheet.load(fname)
+        assert worksheet.get_chunk(1).results == ['1']
+        assert worksheet.get_chunk(1).needs_execute
+
         calculate()
 
         expect_text(SAVE_TEST)
         expect([S(0,1), S(1,2), C(2,3), B(3,4), S(4,5)])
         expect_results([[], ['1'], None, None, []])
+
+        worksheet.load(fname, with_results=False)
+        assert worksheet.get_chunk(1).results is None
     finally:
         os.remove(fname)
+        saved_results.remove_results(fname)
 
     clear()
     expect([B(0,1)])
+
+    #
+    # Calculating only up to a line
+    #
+    insert(0, 0, "a = 1\na\n\nb = a + 1\nb")
+    worksheet.calculate(wait=True, up_to_line=1)
+    expect_results([[], ['1'], None, None, None])
+    assert worksheet.get_chunk(3).needs_compile
+    assert worksheet.state == NotebookFile.NEEDS_EXECUTE
+
+    # A line that isn't in a statement executes everything before it
+    worksheet.calculate(wait=True, up_to_line=2)
+    assert worksheet.get_chunk(3).needs_compile
+
+    calculate()
+    expect_results([[], ['1'], None, [], ['2']])
+    assert worksheet.state == NotebookFile.EXECUTE_SUCCESS
+
+    # Later statements that were executed are left stale
+    delete(0, 4, 0, 5)
+    insert(0, 4, "2")
+    worksheet.calculate(wait=True, up_to_line=1)
+    expect_results([[], ['2'], None, [], ['2']])
+    assert worksheet.get_chunk(3).needs_execute
+
+    clear()
+
+    #
+    # Editing during a calculation
+    #
+    from test_utils import assert_equals
+
+    def run_until(condition, timeout=5000):
+        loop = main_loop.MainLoop()
+        def check():
+            if condition():
+                loop.quit()
+                return False
+            return True
+        check_source = main_loop.timeout_add(10, check)
+        timeout_source = main_loop.timeout_add(timeout, loop.quit)
+        loop.run()
+        main_loop.source_remove(check_source)
+        main_loop.source_remove(timeout_source)
+        assert condition()
+
+    insert(0, 0, "import time\na = 1\ntime.sleep(0.5)\nb = a + 1\nb")
+    worksheet.calculate()
+    run_until(lambda: worksheet.get_chunk(2).executing)
+
+    # Statements before the edit continue executing, the rest are left stale
+    delete(3, 8, 3, 9)
+    insert(3, 8, "2")
+    assert_equals(worksheet.state, NotebookFile.EXECUTING)
+    run_until(lambda: worksheet.state != NotebookFile.EXECUTING)
+    expect_results([[], [], [], None, None])
+    assert not worksheet.get_chunk(2).needs_execute
+    assert worksheet.get_chunk(3).needs_compile
+    assert_equals(worksheet.state, NotebookFile.NEEDS_EXECUTE)
+
+    calculate()
+    expect_results([[], [], [], [], ['3']])
+
+    # An edit above a running statement cancels it
+    delete(1, 4, 1, 5)
+    insert(1, 4, "2")
+    worksheet.calculate()
+    run_until(lambda: worksheet.get_chunk(2).executing)
+    delete(1, 4, 1, 5)
+    insert(1, 4, "3")
+    run_until(lambda: worksheet.state != NotebookFile.EXECUTING, timeout=400)
+    assert worksheet.get_chunk(1).needs_compile
+    assert worksheet.get_chunk(2).needs_execute
+    assert not worksheet.get_chunk(2).executing
+    expect_results([[], [], [], [], ['3']])
+
+    # With auto_calculate, the worksheet is calculated after an edit
+    worksheet.auto_calculate = True
+    run_until(lambda: worksheet.state == NotebookFile.EXECUTE_SUCCESS)
+    expect_results([[], [], [], [], ['5']])
+
+    delete(3, 8, 3, 9)
+    insert(3, 8, "3")
+    run_until(lambda: worksheet.state == NotebookFile.EXECUTE_SUCCESS)
+    expect_results([[], [], [], [], ['6']])
+    worksheet.auto_calculate = False
+
+    clear()
+
+    #
+    # Calculations queued behind the calculations of other worksheets
+    #
+    other = Worksheet(worksheet.notebook)
+    other.insert(0, 0, "import time\ntime.sleep(0.3)")
+    max_running = execution_scheduler.max_running
+    execution_scheduler.max_running = 1
+    try:
+        insert(0, 0, "a = 1\na")
+        other.calculate()
+        worksheet.calculate()
+        assert_equals(worksheet.state, NotebookFile.QUEUED)
+        assert_equals([run.worksheet for run in execution_scheduler.get_runs()], [other, worksheet])
+        run_until(lambda: other.state == NotebookFile.EXECUTE_SUCCESS)
+        run_until(lambda: worksheet.state == NotebookFile.EXECUTE_SUCCESS)
+        expect_results([[], ['1']])
+
+        # Interrupting a queued calculation
+        other.delete_range(1, 13, 1, 14)
+        other.insert(1, 13, "4")
+        other.calculate_async()
+        worksheet.delete_range(1, 0, 1, 1)
+        worksheet.insert(1, 0, "a + 1")
+        worksheet.calculate()
+        assert_equals(worksheet.state, NotebookFile.QUEUED)
+        worksheet.interrupt()
+        assert worksheet.state != NotebookFile.QUEUED
+        run_until(lambda: worksheet.state == NotebookFile.NEEDS_EXECUTE)
+        assert worksheet.get_chunk(1).needs_execute
+    finally:
+        execution_scheduler.max_running = max_running
+        other.close()
+
+    clear()
+
+    #
+    # The timings of executions are kept for each chunk across calculations
+    #
+    insert(0, 0, "a = 1\nb = a + 1")
+    calculate()
+    assert_equals([len(worksheet.get_chunk(i).timings) for i in (0, 1)], [1, 1])
+    delete(0, 4, 0, 5)
+    insert(0, 4, "2")
+    calculate()
+    assert_equals([len(worksheet.get_chunk(i).timings) for i in (0, 1)], [2, 2])
+    timing = worksheet.get_chunk(1).timings[-1]
+    assert timing.wall_time >= 0 and timing.finish_time > 0
+
+    clear()
+
+    #
+    # Following a calculation from another thread
+    #
+    import thread
+    from test_utils import assert_equals
+
+    insert(0, 0, "a = 1\nb = a + 1\nb")
+    calculation = worksheet.calculate_async()
+    loop = main_loop.MainLoop()
+    followed = []
+    def follow():
+        for statement in calculation.iter_statements(timeout=10):
+            followed.append(statement.results)
+        followed.append(calculation.result(timeout=10))
+        main_loop.idle_add(loop.quit)
+    thread.start_new_thread(follow, ())
+    loop.run()
+    assert_equals(followed, [[], [], ['2'], True])
+
+    insert(2, 0, "1/0 + ")
+    calculation = worksheet.calculate_async()
+    completed = []
+    calculation.add_statement_callback(lambda calculation, statement: completed.append(statement.state))
+    calculation.add_done_callback(lambda calculation: loop.quit())
+    loop.run()
+    assert_equals(completed, [Statement.EXECUTE_ERROR])
+    assert not calculation.result()
+
+    #
+    # Restoring checkpoints of statements when a worksheet is reopened
+    #
+    import shutil
+
+    clear()
+
+    base = tempfile.mkdtemp("", "reinteract_worksheet")
+    try:
+        f = open(os.path.join(base, "index.rnb"), "w")
+        f.write("[Notebook]\ncheckpoints = true\ncheckpoint_threshold = 0\n")
+        f.close()
+        log_file = os.path.join(base, "log")
+
+        def run_checkpointed(text):
+            nb = Notebook(base)
+            worksheet = Worksheet(nb)
+            worksheet.insert(0, 0, text)
+            worksheet.calculate(wait=True)
+            chunks = [c for c in worksheet.iterate_chunks() if isinstance(c, StatementChunk)]
+            results = [(c.needs_execute, c.results) for c in chunks]
+            worksheet.close()
+            nb.close()
+            return results
+
+        CHECKPOINT_TEST = """def record(s):
+    f = open(%r, "a")
+    f.write(s)
+    f.close()
+record("1")
+a = 10
+record("2")
+a * %d"""
+
+        assert_equals(run_checkpointed(CHECKPOINT_TEST % (log_file, 2)),
+                      [(False, []), (False, []), (False, []), (False, []), (False, ['20'])])
+        assert_equals(open(log_file).read(), "12")
+
+        # Only the changed last statement is executed; the statements before the
+        # restored statement are left unexecuted
+        assert_equals(run_checkpointed(CHECKPOINT_TEST % (log_file, 3)),
+                      [(True, None), (True, None), (True, None), (False, []), (False, ['30'])])
+        assert_equals(open(log_file).read(), "12")
+    finally:
+        shutil.rmtree(base)
@@ -13,10 +13,12 @@ import gtk
 import pango
 
 from application import application
+from chunks import StatementChunk
 from editor import Editor
 from global_settings import global_settings
 from shell_buffer import ShellBuffer
 from shell_view import ShellView
+import statement_timing
 
 class WorksheetEditor(Editor):
     DISCARD_FORMAT = 'Discard unsaved changes to worksheet "%s"?'
@@ -32,6 +34,12 @@ class WorksheetEditor(Editor):
         self.__font_name_connection = global_settings.connect('notify::editor-font-name', self.__update_font)
         self.__update_font()
 
+        self.__auto_calculate_connection = global_settings.connect('notify::auto-calculate', self.__update_auto_calculate)
+        self.__update_auto_calculate()
+
+        self.__show_timings_connection = global_settings.connect('notify::show-timings', self.__update_show_timings)
+        self.__update_show_timings()
+
         self.widget = gtk.ScrolledWindow()
         self.widget.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
 
@@ -55,6 +63,12 @@ class WorksheetEditor(Editor):
 
         self.view.modify_font(pango.FontDescription(font_name))
 
+    def __update_auto_calculate(self, *arg):
+        self.buf.worksheet.auto_calculate = global_settings.auto_calculate
+
+    def __update_show_timings(self, *arg):
+        self.view.set_show_timings(global_settings.show_timings)
+
     #######################################################
     # Overrides
     #######################################################
@@ -92,14 +106,22 @@ class WorksheetEditor(Editor):
         self.buf.worksheet.close()
         global_settings.disconnect(self.__font_is_custom_connection)
         global_settings.disconnect(self.__font_name_connection)
+        global_settings.disconnect(self.__auto_calculate_connection)
+        global_settings.disconnect(self.__show_timings_connection)
 
     def load(self, filename, escape=False):
         self.buf.worksheet.load(filename, escape=escape)
         self.buf.place_cursor(self.buf.get_start_iter())
         self.calculate()
 
-    def calculate(self):
-        self.view.calculate()
+    def calculate(self, up_to_cursor=False):
+        self.view.calculate(up_to_cursor=up_to_cursor)
+
+    def export_timings(self, filename):
+        """Save the timings of the statements of the worksheet as CSV or JSON; see L{statement_timing.export_timings}"""
+
+        chunks = [chunk for chunk in self.buf.worksheet.iterate_chunks() if isinstance(chunk, StatementChunk)]
+        statement_timing.export_timings(chunks, filename)
 
     def undo(self):
         self.buf.worksheet.undo()
@@ -15,6 +15,7 @@ import sys
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_cairo import RendererCairo, FigureCanvasCairo
 import numpy
+from cStringIO import StringIO
 
 from reinteract.recorded_object import RecordedObject, default_filter
 import reinteract.custom_result as custom_result
@@ -348,6 +349,22 @@ class AxesBase(RecordedObject, custom_result.CustomResult):
         self._replay(widget.axes)
         return widget
 
+    def render_png(self):
+        # Imported here, since the Agg backend isn't needed for display
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        figure = Figure(facecolor='white', figsize=(6,4.5))
+        canvas = FigureCanvasAgg(figure)
+        if isinstance(self, Axes3D):
+            axes = mplot3d.axes3d.Axes3D(figure)
+        else:
+            axes = figure.add_subplot(111)
+        self._replay(axes)
+
+        f = StringIO()
+        canvas.print_png(f)
+        return f.getvalue()
+
 class Axes(AxesBase):
     pass
 Axes._set_target_class(matplotlib.axes.Axes, filter_method)